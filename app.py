@@ -1,7 +1,21 @@
+import json
+import os
+import click
+from flask import current_app
 from flask.cli import FlaskGroup
 from server.api.index import create_app
-from server.api.helpers import db_seed
+from server.api.helpers import db_seed, validate_pricing_data
 from server.api.db import db
+from server.api.cache import pricing_cache
+from server.api.simulation import simulate_repricing
+from server.api.export import iter_quotes_ndjson
+from server.api.extras_mask import migrate_extras_mask
+from server.api.rollups import rebuild_rollups
+from server.api.serving import serve
+from server.api.idempotency import sweep_expired_keys
+from server.api.params_io import import_params, iter_params_ndjson, read_params_records
+from server.api.queries import parse_quote_filters
+from server.database.models import PricingParams, State
 
 cli = FlaskGroup(create_app())
 
@@ -14,5 +28,114 @@ def create_db():
     db.session.commit()
 
 
+@cli.command("simulate_pricing")
+@click.argument("params_file", type=click.File())
+def simulate_pricing(params_file):
+    """Prints the revenue impact of the proposed PricingParams in PARAMS_FILE (JSON, same
+    format as seed.json entries) on all the stored quotes of that state
+    """
+    data = json.load(params_file)
+    valid, error = validate_pricing_data(data)
+    if not valid:
+        raise click.ClickException(f"Data formated incorrectly: {error}")
+    current = pricing_cache.get(data["state"])
+    if current is None:
+        raise click.ClickException(f"no PricingParams for {data['state']}")
+    proposed = PricingParams(
+        state=data["state"],
+        tax=data["tax"],
+        coverage_type_prices=data["coverage_type_prices"],
+        extras=data["extras"],
+    )
+    click.echo(json.dumps(simulate_repricing(current, proposed), indent=2))
+
+
+@cli.command("export_quotes")
+@click.option("--state", help="only export quotes of this state")
+@click.option("--coverage-type", help="only export quotes of this coverage type")
+@click.option("--lastname", help="only export quotes whose lastname starts with this")
+@click.option("--created-from", help="only export quotes created at or after (ISO 8601)")
+@click.option("--created-to", help="only export quotes created before (ISO 8601)")
+@click.option("--gzip", "compress", is_flag=True, help="gzip the output")
+@click.option("-o", "--output", type=click.File("wb"), default="-")
+def export_quotes(compress, output, **args):
+    """Streams all quotes with their pricing as NDJSON"""
+    filters, error = parse_quote_filters(args)
+    if filters is None:
+        raise click.ClickException(f"Data formated incorrectly: {error}")
+    for chunk in iter_quotes_ndjson(filters, compress=compress):
+        output.write(chunk)
+
+
+@cli.command("import_params")
+@click.argument("params_file", type=click.File("rb"))
+@click.option("--dry-run", is_flag=True, help="only print what would change")
+def import_pricing_params(params_file, dry_run):
+    """Upserts all the PricingParams of PARAMS_FILE (JSON array like seed.json, or NDJSON) in
+    one transaction, nothing is written if a record is invalid
+    """
+    records, parse_errors = read_params_records(params_file)
+    report = import_params(records, dry_run=dry_run, parse_errors=parse_errors)
+    click.echo(json.dumps(report, indent=2))
+    if report["errors"]:
+        raise click.ClickException("invalid records, nothing was imported")
+
+
+@cli.command("export_params")
+@click.option("-o", "--output", type=click.File("wb"), default="-")
+def export_pricing_params(output):
+    """Streams all PricingParams as NDJSON, in the format of import_params"""
+    for chunk in iter_params_ndjson():
+        output.write(chunk)
+
+
+@cli.command("migrate_extras_mask")
+@click.option("--chunk-size", default=1000, help="quotes updated per transaction")
+def migrate_quote_extras_mask(chunk_size):
+    """Adds Quote.extras_mask to an existing database and computes it for the existing quotes"""
+    updated = migrate_extras_mask(pricing_cache.get_many(list(State)), chunk_size)
+    click.echo(f"{updated} quotes updated")
+
+
+@cli.command("rollups")
+@click.option("--check", is_flag=True, help="only report the drift, don't rewrite the rollups")
+def rollups(check):
+    """Recomputes the quote rollups from the quotes, prints the rows that drifted and rewrites
+    them (unless --check). Exits with an error when --check finds drift
+    """
+    drift = rebuild_rollups(check_only=check)
+    click.echo(json.dumps(drift, indent=2))
+    if check and drift:
+        raise click.ClickException(f"{len(drift)} rollup rows drifted")
+
+
+@cli.command("sweep_idempotency_keys")
+@click.option("--batch-size", default=1000, help="keys deleted per transaction")
+def sweep_idempotency_keys(batch_size):
+    """Deletes the expired Idempotency-Keys of POST /api/quote/"""
+    click.echo(f"{sweep_expired_keys(batch_size)} keys deleted")
+
+
+@cli.command("serve")
+@click.option("-b", "--bind", default=lambda: os.environ.get("BIND", "0.0.0.0:5000"))
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=lambda: int(os.environ.get("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1)),
+    help="worker processes (env WEB_CONCURRENCY, default 2 x CPUs + 1)",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=lambda: int(os.environ.get("WEB_THREADS", 4)),
+    help="threads per worker (env WEB_THREADS)",
+)
+@click.option("--timeout", type=int, default=30, help="seconds before a stuck worker is restarted")
+def serve_app(bind, workers, threads, timeout):
+    """Serves the app with gunicorn: loaded once in the master, warmed up in every worker"""
+    serve(current_app._get_current_object(), bind, workers, threads, timeout)
+
+
 if __name__ == "__main__":
     cli()
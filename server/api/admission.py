@@ -0,0 +1,236 @@
+""" Admission control and load shedding.
+
+Each limiter lets a bounded number of requests run at once, the others wait in a bounded queue
+for at most its timeout and are then answered 503 with a Retry-After header, instead of piling
+up behind the database pool until the clients give up. Waiting requests are admitted by
+priority, reads (GET and HEAD) before writes, and when the queue is full a read takes the place
+of the last queued write: a spike of writes is shed first. A cheap read endpoint can also get a
+limiter of its own so that it never waits behind the rest of its blueprint.
+
+ADMISSION_LIMITS configures the limiters, by blueprint ("quote") or by endpoint
+("pricing_params.get_all", which then gets a limiter of its own):
+
+    {"quote": {"concurrency": 8, "queue": 16, "timeout": 1.0, "retry_after": 1}}
+
+A client can send the time it stops waiting as X-Request-Deadline (Unix time in seconds): a
+request is not queued past its deadline, and once the deadline is over its next SQL statement
+raises DeadlineExceeded, so no more work is done for a response nobody reads.
+"""
+import heapq
+import itertools
+import threading
+import time
+from flask import Flask, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from server.api.metrics import registry
+
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# admitted first, lower is sooner
+READ_PRIORITY = 0
+WRITE_PRIORITY = 1
+
+
+class DeadlineExceeded(Exception):
+    """The deadline of the request is over"""
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "event", "admitted")
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.event = threading.Event()
+        self.admitted = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Limiter:
+    """Concurrency limit with a bounded priority queue of waiting requests"""
+
+    def __init__(self, name: str, concurrency: int, queue: int, timeout: float, retry_after: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiters = []
+        self.seq = itertools.count()
+
+    def acquire(self, priority: int, timeout: float) -> str:
+        """Waits for a slot at most timeout seconds
+
+        Args:
+            priority (int): lower is admitted sooner
+            timeout (float): seconds to wait
+
+        Returns:
+            str: None once admitted, else why not ("queue_full", "shed" or "timeout")
+        """
+        with self.lock:
+            if self.active < self.concurrency and not self.waiters:
+                self.active += 1
+                return None
+            if timeout <= 0:
+                return "timeout"
+            if len(self.waiters) >= self.queue:
+                worst = max(self.waiters, default=None)
+                if worst is None or worst.priority <= priority:
+                    return "queue_full"
+                # the last queued request of lower priority gives its place
+                self.waiters.remove(worst)
+                heapq.heapify(self.waiters)
+                worst.event.set()
+            waiter = _Waiter(priority, next(self.seq))
+            heapq.heappush(self.waiters, waiter)
+        if waiter.event.wait(timeout) and waiter.admitted:
+            return None
+        with self.lock:
+            if waiter.admitted:
+                # admitted right at the timeout
+                return None
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+                return "timeout"
+            return "shed"
+
+    def release(self):
+        """Frees a slot, handing it over to the first waiting request"""
+        with self.lock:
+            if self.waiters:
+                waiter = heapq.heappop(self.waiters)
+                waiter.admitted = True
+                waiter.event.set()
+            else:
+                self.active -= 1
+
+
+class _AdmissionState:
+    """Per app limiters, created on first use from ADMISSION_LIMITS, kept in app.extensions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limiters = {}
+
+
+class AdmissionControl:
+    """Flask extension limiting the concurrent requests per blueprint or endpoint, see the module
+    docstring. ADMISSION_LIMITS is empty (no limit) by default, ADMISSION_QUEUE_TIMEOUT and
+    ADMISSION_RETRY_AFTER are the defaults of the limiters
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("ADMISSION_LIMITS", {})
+        app.config.setdefault("ADMISSION_QUEUE_TIMEOUT", 1.0)
+        app.config.setdefault("ADMISSION_RETRY_AFTER", 1)
+        app.extensions["admission"] = _AdmissionState()
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.register_error_handler(DeadlineExceeded, self._deadline_exceeded)
+
+    def limiter(self, endpoint: str) -> Limiter:
+        """Returns the limiter of an endpoint, None when it has no limit"""
+        limits = current_app.config["ADMISSION_LIMITS"]
+        name = endpoint if endpoint in limits else endpoint.partition(".")[0]
+        if name not in limits:
+            return None
+        state = current_app.extensions["admission"]
+        with state.lock:
+            if name not in state.limiters:
+                config = limits[name]
+                state.limiters[name] = Limiter(
+                    name,
+                    concurrency=int(config["concurrency"]),
+                    queue=int(config.get("queue", config["concurrency"])),
+                    timeout=float(
+                        config.get("timeout", current_app.config["ADMISSION_QUEUE_TIMEOUT"])
+                    ),
+                    retry_after=int(
+                        config.get("retry_after", current_app.config["ADMISSION_RETRY_AFTER"])
+                    ),
+                )
+            return state.limiters[name]
+
+    def _before_request(self):
+        if request.endpoint in (None, "metrics", "static"):
+            return
+        try:
+            g.deadline = float(request.headers[DEADLINE_HEADER])
+        except (KeyError, ValueError):
+            g.deadline = None
+        limiter = self.limiter(request.endpoint)
+        labels = {"limiter": limiter.name if limiter else request.blueprint or ""}
+        if g.deadline is not None and g.deadline <= time.time():
+            # the client is not waiting any more
+            registry.inc("admission_rejected_total", {**labels, "reason": "deadline"})
+            return _reject("deadline", current_app.config["ADMISSION_RETRY_AFTER"])
+        if limiter is None:
+            return
+        config = current_app.config["ADMISSION_LIMITS"][limiter.name]
+        priority = config.get(
+            "priority", READ_PRIORITY if request.method in ("GET", "HEAD") else WRITE_PRIORITY
+        )
+        timeout = limiter.timeout
+        if g.deadline is not None:
+            timeout = min(timeout, g.deadline - time.time())
+        registry.add_gauge("admission_queued", labels)
+        start = time.perf_counter()
+        try:
+            reason = limiter.acquire(priority, timeout)
+        finally:
+            registry.add_gauge("admission_queued", labels, -1)
+        registry.observe("admission_wait_seconds", time.perf_counter() - start, labels)
+        if reason is not None:
+            if reason == "timeout" and g.deadline is not None and g.deadline <= time.time():
+                reason = "deadline"
+            registry.inc("admission_rejected_total", {**labels, "reason": reason})
+            return _reject(reason, limiter.retry_after)
+        g.admission_limiter = limiter
+        registry.add_gauge("admission_in_flight", labels)
+
+    def _teardown_request(self, exc):
+        limiter = g.pop("admission_limiter", None)
+        if limiter is not None:
+            limiter.release()
+            registry.add_gauge("admission_in_flight", {"limiter": limiter.name}, -1)
+
+    def _deadline_exceeded(self, error):
+        limiter = g.get("admission_limiter")
+        registry.inc(
+            "admission_rejected_total",
+            {"limiter": limiter.name if limiter else request.blueprint or "", "reason": "deadline"},
+        )
+        return _reject("deadline", current_app.config["ADMISSION_RETRY_AFTER"])
+
+
+def _reject(reason: str, retry_after: int):
+    """503 answer of a request that is not served, reason is queue_full, shed, timeout or deadline"""
+    message = "deadline exceeded" if reason == "deadline" else f"overloaded ({reason})"
+    return f"Service unavailable: {message}, retry later", 503, {"Retry-After": str(retry_after)}
+
+
+def remaining() -> float:
+    """Returns the seconds left before the deadline of the current request, None without one"""
+    deadline = g.get("deadline") if has_request_context() else None
+    return None if deadline is None else deadline - time.time()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _check_deadline(conn, cursor, statement, parameters, context, executemany):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(statement)
+
+
+admission_control = AdmissionControl()
@@ -0,0 +1,124 @@
+""" Async SQLAlchemy engine for the async app (see create_async_app in server/api/index.py).
+
+Flask runs an async view by creating a new event loop for every request, so connections could
+never be pooled. AsyncFlask runs the async views on a single event loop per process instead:
+the request thread waits on its coroutine while the loop keeps the DB round trips of all the
+in flight requests going over one pooled async engine.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+from flask import Flask, current_app
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+# sync driver -> async driver used when SQLALCHEMY_ASYNC_DATABASE_URI is not set
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def async_database_uri(uri: str, instance_path: str) -> str:
+    """Returns the async driver version of a sync database URI, relative SQLite paths are
+    made relative to the instance folder like Flask-SQLAlchemy does
+    """
+    url = make_url(uri)
+    if url.drivername.startswith("sqlite") and url.database not in (None, "", ":memory:"):
+        if not os.path.isabs(url.database):
+            url = url.set(database=os.path.join(instance_path, url.database))
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+    return url.render_as_string(hide_password=False)
+
+
+class _EventLoopThread:
+    """A single event loop running in a daemon thread, recreated after a fork"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self._loop.run_forever, name="async-views", daemon=True
+                ).start()
+            return self._loop
+
+    def run(self, coro):
+        """Runs a coroutine on the loop and waits for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+class AsyncFlask(Flask):
+    """Flask app that runs its async views on a shared event loop instead of one loop per request"""
+
+    def async_to_sync(self, func):
+        def wrapper(*args, **kwargs):
+            # the app and request contexts are context variables, copy them into the task
+            context = contextvars.copy_context()
+
+            async def run():
+                for var, value in context.items():
+                    var.set(value)
+                return await func(*args, **kwargs)
+
+            return self.extensions["async_db"].loop_thread.run(run())
+
+        return wrapper
+
+
+class _AsyncDBState:
+    def __init__(self, uri: str, engine_options: dict):
+        self.uri = uri
+        self.engine_options = engine_options
+        self.loop_thread = _EventLoopThread()
+        self.engine = None
+        self.engine_pid = None
+        self.sessionmaker = None
+
+
+class AsyncDatabase:
+    """Flask extension holding the async engine.
+    SQLALCHEMY_ASYNC_DATABASE_URI defaults to SQLALCHEMY_DATABASE_URI with its async driver
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        uri = app.config.setdefault(
+            "SQLALCHEMY_ASYNC_DATABASE_URI",
+            async_database_uri(app.config["SQLALCHEMY_DATABASE_URI"], app.instance_path),
+        )
+        app.extensions["async_db"] = _AsyncDBState(
+            uri, dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        )
+
+    def session(self) -> AsyncSession:
+        """Returns a new AsyncSession, to use as `async with async_db.session() as session`"""
+        state = current_app.extensions["async_db"]
+        if state.engine is None or state.engine_pid != os.getpid():
+            state.engine = create_async_engine(state.uri, **state.engine_options)
+            state.engine_pid = os.getpid()
+            state.sessionmaker = async_sessionmaker(state.engine, expire_on_commit=False)
+        return state.sessionmaker()
+
+    def dispose(self, app: Flask):
+        """Closes the pooled connections of the async engine of app"""
+        state = app.extensions["async_db"]
+        if state.engine is not None:
+            state.loop_thread.run(state.engine.dispose())
+            state.engine = None
+
+
+async_db = AsyncDatabase()
@@ -0,0 +1,220 @@
+""" In-process cache of PricingParams, one entry per state.
+
+Pricing params almost never change, so the quote endpoints read them from here
+instead of querying the database on every request. Each PricingParams row carries a
+version (bumped by SQLAlchemy on every UPDATE), which lets every worker process
+notice changes made by other processes without restarting.
+"""
+import json
+import threading
+import time
+from datetime import datetime
+from types import MappingProxyType
+from dataclasses import dataclass, field
+from flask import Flask, abort, current_app
+from sqlalchemy import select
+from server.api.db import db
+from server.api.pricing import PricingPlan
+from server.api.extras_mask import extra_bits
+from server.database.models import PricingParams, State
+
+
+@dataclass(frozen=True)
+class PricingSnapshot:
+    """Immutable, session independent copy of a PricingParams row.
+    It has the same attributes calculate_pricing reads from PricingParams plus the
+    extras registry of the state and the PricingPlan (with its PriceTable) compiled for this version
+    """
+
+    id: int
+    state: State
+    version: int
+    tax: float
+    coverage_type_prices: dict
+    extras: list
+    updated_at: datetime
+    extra_bits: MappingProxyType
+    plan: PricingPlan = field(repr=False, compare=False)
+
+    @classmethod
+    def from_model(cls, pricing: PricingParams) -> "PricingSnapshot":
+        return cls(
+            id=pricing.id,
+            state=State(pricing.state),
+            version=pricing.version,
+            tax=pricing.tax,
+            # round trip through json so we keep plain dicts/lists and not the mutable wrappers
+            coverage_type_prices=json.loads(json.dumps(pricing.coverage_type_prices)),
+            extras=json.loads(json.dumps(pricing.extras)),
+            updated_at=pricing.updated_at or pricing.created_at,
+            extra_bits=extra_bits(pricing.extras),
+            plan=PricingPlan.compile(pricing).with_table(),
+        )
+
+
+class _CacheState:
+    """Per app cache storage, kept in app.extensions so that each app (and each test) has its own"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.last_check = 0.0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "version_checks": 0}
+
+
+class PricingParamsCache:
+    """Flask extension that caches PricingParams per state.
+
+    Reads go through get/get_or_404. Every PRICING_CACHE_TTL seconds the cache runs a single
+    lightweight query for the (state, id, version) of every row and drops the entries that
+    changed. Writers in this process call invalidate after they commit so they see their
+    own changes right away.
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("PRICING_CACHE_TTL", 1.0)
+        app.extensions["pricing_cache"] = _CacheState(
+            float(app.config["PRICING_CACHE_TTL"])
+        )
+
+    @property
+    def _state(self) -> _CacheState:
+        return current_app.extensions["pricing_cache"]
+
+    def get(self, state) -> PricingSnapshot:
+        """Returns the cached pricing for a state, loading it on a miss
+
+        Args:
+            state (State | str): State enum or its value
+
+        Returns:
+            PricingSnapshot: snapshot of the params, None if the state has no PricingParams
+        """
+        state = State(state)
+        cache = self._state
+        if self._versions_due(cache):
+            self._drop_stale(cache, db.session.execute(_VERSIONS_QUERY).all())
+        snapshot = self._lookup(cache, state)
+        if snapshot is None:
+            pricing = PricingParams.query.filter_by(state=state).first()
+            snapshot = self._store(cache, pricing)
+        return snapshot
+
+    async def get_async(self, state, session) -> PricingSnapshot:
+        """Same as get, for the async app
+
+        Args:
+            state (State | str): State enum or its value
+            session (AsyncSession): session used on a miss or a version check
+
+        Returns:
+            PricingSnapshot: snapshot of the params, None if the state has no PricingParams
+        """
+        state = State(state)
+        cache = self._state
+        if self._versions_due(cache):
+            self._drop_stale(cache, (await session.execute(_VERSIONS_QUERY)).all())
+        snapshot = self._lookup(cache, state)
+        if snapshot is None:
+            pricing = await session.scalar(
+                select(PricingParams).where(PricingParams.state == state)
+            )
+            snapshot = self._store(cache, pricing)
+        return snapshot
+
+    def get_many(self, states) -> dict:
+        """Returns the cached pricing for several states, loading all the misses in one query
+
+        Args:
+            states (iterable): State enums or their values
+
+        Returns:
+            dict: State -> PricingSnapshot, states without PricingParams are left out
+        """
+        states = {State(state) for state in states}
+        cache = self._state
+        if self._versions_due(cache):
+            self._drop_stale(cache, db.session.execute(_VERSIONS_QUERY).all())
+        result = {}
+        with cache.lock:
+            for state in states:
+                snapshot = cache.entries.get(state)
+                if snapshot is not None:
+                    cache.stats["hits"] += 1
+                    result[state] = snapshot
+                else:
+                    cache.stats["misses"] += 1
+        missing = states - result.keys()
+        if missing:
+            pricings = PricingParams.query.filter(PricingParams.state.in_(missing)).all()
+            loaded = {State(p.state): PricingSnapshot.from_model(p) for p in pricings}
+            with cache.lock:
+                cache.entries.update(loaded)
+            result.update(loaded)
+        return result
+
+    def get_or_404(self, state) -> PricingSnapshot:
+        """Same as get but aborts with 404 when the state has no PricingParams"""
+        snapshot = self.get(state)
+        if snapshot is None:
+            abort(404)
+        return snapshot
+
+    def invalidate(self, state=None):
+        """Drops the cached entry for a state, or all entries when state is None"""
+        cache = self._state
+        with cache.lock:
+            if state is None:
+                cache.entries.clear()
+            else:
+                cache.entries.pop(State(state), None)
+
+    def stats(self) -> dict:
+        """Returns the hit/miss/staleness counters and the number of cached states"""
+        cache = self._state
+        with cache.lock:
+            return {**cache.stats, "size": len(cache.entries)}
+
+    def _lookup(self, cache: _CacheState, state: State) -> PricingSnapshot:
+        """Returns the cached entry of a state (None on a miss) and counts the hit or miss"""
+        with cache.lock:
+            snapshot = cache.entries.get(state)
+            cache.stats["hits" if snapshot is not None else "misses"] += 1
+            return snapshot
+
+    def _store(self, cache: _CacheState, pricing: PricingParams) -> PricingSnapshot:
+        """Caches a loaded PricingParams row, returns None if there is no row"""
+        if pricing is None:
+            return None
+        snapshot = PricingSnapshot.from_model(pricing)
+        with cache.lock:
+            cache.entries[snapshot.state] = snapshot
+        return snapshot
+
+    def _versions_due(self, cache: _CacheState) -> bool:
+        """True when the versions were last checked more than PRICING_CACHE_TTL seconds ago"""
+        now = time.monotonic()
+        if now - cache.last_check < cache.ttl:
+            return False
+        cache.last_check = now
+        return True
+
+    def _drop_stale(self, cache: _CacheState, rows: list):
+        """Drops entries whose row version changed in the database (i.e by another process)"""
+        current = {State(row.state): (row.id, row.version) for row in rows}
+        with cache.lock:
+            cache.stats["version_checks"] += 1
+            for state, snapshot in list(cache.entries.items()):
+                if current.get(state) != (snapshot.id, snapshot.version):
+                    del cache.entries[state]
+                    cache.stats["stale"] += 1
+
+
+_VERSIONS_QUERY = select(PricingParams.state, PricingParams.id, PricingParams.version)
+
+pricing_cache = PricingParamsCache()
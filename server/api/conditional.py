@@ -0,0 +1,58 @@
+""" Conditional GET helpers.
+
+The polled read endpoints compute their ETag and Last-Modified from a few small columns (the
+PricingParams versions, the stored quote price) and answer 304 Not Modified before loading and
+serializing the full rows. Responses are marked no-cache: clients and proxies may keep them but
+have to revalidate, which is what makes the 304 cheap.
+"""
+import hashlib
+from datetime import datetime, timezone
+from flask import Response, request
+
+
+def make_etag(*parts) -> str:
+    """Returns a strong ETag from the values that identify the content of a response"""
+    return hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+
+
+def not_modified(etag: str, last_modified: datetime) -> bool:
+    """Returns True when the conditional headers of the request match the current version
+
+    Args:
+        etag (str): strong ETag of the current content
+        last_modified (datetime): naive UTC time of the last change, or None
+    """
+    # If-None-Match wins over If-Modified-Since when both are sent (RFC 9110)
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return bool(since and last_modified and _http_date(last_modified) <= since)
+
+
+def conditional_response(etag: str, last_modified: datetime, build, private: bool = False):
+    """Answers 304 when the client has the current version, else builds the response
+
+    Args:
+        etag (str): strong ETag of the current content
+        last_modified (datetime): naive UTC time of the last change, or None
+        build (callable): returns the full response, only called when it has to be sent
+        private (bool, optional): the response is specific to a user. Defaults to False.
+
+    Returns:
+        Response
+    """
+    response = Response(status=304) if not_modified(etag, last_modified) else build()
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _http_date(last_modified)
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+
+def _http_date(value: datetime) -> datetime:
+    # HTTP dates have a one second precision
+    return value.replace(microsecond=0, tzinfo=timezone.utc)
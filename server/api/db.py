@@ -1,5 +1,223 @@
 """ This created the database that will be used to make database transactions
 """
+import collections
+import contextlib
+import re
+import time
+from flask import Flask, current_app, g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, create_engine, event
+from sqlalchemy.engine import Engine
 
-db = SQLAlchemy()
+# cookie set after a write: until that time the reads of the client go to the primary
+PIN_COOKIE = "db_primary_until"
+
+
+class RoutingSession(Session):
+    """db.session class sending the plain SELECTs of GET requests to the replica engine, and
+    everything else (writes, flushes, SELECT FOR UPDATE, reads outside of a request or of a
+    client pinned to the primary) to the primary
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _reads_from_replica(self, clause):
+            replica = current_app.extensions.get("db_replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _reads_from_replica(session, clause) -> bool:
+    if session._flushing or not has_request_context():
+        return False
+    if request.method not in ("GET", "HEAD") or g.get("read_primary", False):
+        return False
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# callables (statement, parameters, seconds) called after every statement executed by any
+# engine (sync or async), used by the metrics and the query accounting
+query_observers = []
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    for observer in query_observers:
+        observer(statement, parameters, elapsed)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_start_time"):
+        context.connection.info["query_start_time"].pop()
+
+
+# placeholders of an expanded IN list, (?, ?, ?) and (?) are the same statement shape
+_IN_LIST = re.compile(r"\((?:\?|%\(\w+\)s|\$\d+)(?:,\s*(?:\?|%\(\w+\)s|\$\d+))*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """Returns the statement with its whitespace and IN lists normalized"""
+    return _IN_LIST.sub("(?)", _SPACES.sub(" ", statement).strip())
+
+
+class QueryStats:
+    """Statements executed while serving one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = collections.Counter()
+        # > 0 while the statements are a polling loop, not checked for N+1
+        self.polling = 0
+
+    def repeated(self, threshold: int) -> list:
+        """Returns (shape, count) of the statements executed more than threshold times"""
+        return [(shape, n) for shape, n in self.shapes.most_common() if n > threshold]
+
+
+class QueryAccounting:
+    """Flask extension counting the statements and the DB time of every request.
+
+    Statements slower than SQL_SLOW_QUERY_SECONDS are logged with their parameters, requests
+    running the same statement shape more than SQL_REPEATED_STATEMENT_LIMIT times (usually a
+    query per row loop) are logged as N+1. In debug mode (or with SQL_QUERY_HEADERS) the
+    counts are also returned in the X-DB-Statements and X-DB-Time headers.
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("SQL_SLOW_QUERY_SECONDS", 0.1)
+        app.config.setdefault("SQL_REPEATED_STATEMENT_LIMIT", 10)
+        app.config.setdefault("SQL_QUERY_HEADERS", None)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if _account_query not in query_observers:
+            query_observers.append(_account_query)
+
+    @staticmethod
+    def stats() -> "QueryStats | None":
+        """Returns the QueryStats of the current request, None outside of a request"""
+        return g.get("query_stats") if has_request_context() else None
+
+    @staticmethod
+    @contextlib.contextmanager
+    def polling():
+        """Statements executed in the block are counted but not reported as N+1, for loops
+        polling the same row on purpose
+        """
+        stats = QueryAccounting.stats()
+        if stats is None:
+            yield
+            return
+        stats.polling += 1
+        try:
+            yield
+        finally:
+            stats.polling -= 1
+
+    def _before_request(self):
+        g.query_stats = QueryStats()
+
+    def _after_request(self, response):
+        stats = g.pop("query_stats", None)
+        if stats is None:
+            return response
+        limit = current_app.config["SQL_REPEATED_STATEMENT_LIMIT"]
+        repeated = stats.repeated(limit)
+        for shape, count in repeated:
+            current_app.logger.warning(
+                "possible N+1 in %s: statement executed %d times: %s",
+                request.endpoint,
+                count,
+                shape,
+            )
+        headers = current_app.config["SQL_QUERY_HEADERS"]
+        if headers or (headers is None and current_app.debug):
+            response.headers["X-DB-Statements"] = str(stats.count)
+            response.headers["X-DB-Time"] = f"{stats.seconds * 1000:.3f}ms"
+            if repeated:
+                response.headers["X-DB-Repeated-Statements"] = str(len(repeated))
+        return response
+
+
+def _account_query(statement, parameters, seconds):
+    if not has_request_context():
+        return
+    stats = g.get("query_stats")
+    if stats is None:
+        return
+    stats.count += 1
+    stats.seconds += seconds
+    if not stats.polling:
+        stats.shapes[statement_shape(statement)] += 1
+    if seconds >= current_app.config["SQL_SLOW_QUERY_SECONDS"]:
+        current_app.logger.warning(
+            "slow query (%.3fs) in %s: %s parameters: %r",
+            seconds,
+            request.endpoint,
+            statement,
+            parameters,
+        )
+
+
+query_accounting = QueryAccounting()
+
+
+class ReplicaRouting:
+    """Flask extension creating the replica engine of SQLALCHEMY_REPLICA_DATABASE_URI used by
+    RoutingSession, and giving read-your-writes on top of it: after a request that writes, the
+    client gets a cookie pinning its reads to the primary for READ_REPLICA_PIN_SECONDS, longer
+    than the replica is expected to lag.
+    The replica is not a Flask-SQLAlchemy bind: binds register their metadata on the shared db
+    for every app, while the models of the replica are the ones of the primary
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("READ_REPLICA_PIN_SECONDS", 5.0)
+        uri = app.config.setdefault("SQLALCHEMY_REPLICA_DATABASE_URI", None)
+        if uri:
+            app.extensions["db_replica"] = create_engine(
+                uri, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+            )
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        try:
+            pinned_until = float(request.cookies.get(PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+        g.read_primary = pinned_until > time.time()
+
+    def _after_request(self, response):
+        if (
+            "db_replica" in current_app.extensions
+            and request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 400
+        ):
+            seconds = float(current_app.config["READ_REPLICA_PIN_SECONDS"])
+            response.set_cookie(
+                PIN_COOKIE, f"{time.time() + seconds:.3f}", max_age=int(seconds) + 1, httponly=True
+            )
+        return response
+
+
+replica_routing = ReplicaRouting()
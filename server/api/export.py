@@ -0,0 +1,63 @@
+""" Streaming NDJSON export of the stored quotes with their computed prices.
+
+Quotes are read with a server-side cursor in chunks (yield_per) and written out as they are
+read, so memory stays flat no matter how big the Quote table is.
+"""
+import zlib
+from flask import current_app
+from sqlalchemy import select
+from server.api.db import db
+from server.api.cache import pricing_cache
+from server.api.queries import apply_quote_filters
+from server.database.models import Quote, State
+
+
+def iter_quotes_ndjson(filters: dict, chunk_size=1000, compress=False):
+    """Generator of the NDJSON export, one quote (with pricing) per line
+
+    Args:
+        filters (dict): Quote filters parsed by parse_quote_filters
+        chunk_size (int, optional): rows fetched per round trip and lines per yielded chunk
+        compress (bool, optional): gzip the output
+
+    Yields:
+        bytes: chunks of the (optionally gzipped) NDJSON output
+    """
+    stmt = select(
+        Quote.id,
+        Quote.created_at,
+        Quote.firstname,
+        Quote.lastname,
+        Quote.state,
+        Quote.coverage_type,
+        Quote.extras,
+    ).order_by(Quote.id)
+    stmt = apply_quote_filters(stmt, filters)
+
+    # the params stay the same for the whole export so that the output is consistent
+    pricings = pricing_cache.get_many(
+        [filters["state"]] if "state" in filters else list(State)
+    )
+    dumps = current_app.json.dumps
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+
+    lines = []
+    rows = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for row in rows:
+        quote = row._asdict()
+        pricing = pricings.get(row.state)
+        if pricing is not None:
+            quote.update(pricing.plan.price(row.coverage_type, row.extras or []))
+        lines.append(dumps(quote, separators=(",", ":")))
+        if len(lines) >= chunk_size:
+            yield _encode(lines, compressor)
+            lines = []
+    if lines:
+        yield _encode(lines, compressor)
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _encode(lines: list, compressor) -> bytes:
+    data = ("\n".join(lines) + "\n").encode()
+    return compressor.compress(data) if compressor is not None else data
@@ -0,0 +1,137 @@
+""" Bitmask of the enabled extras of a quote.
+
+The extras registry of a state gives every extra of its PricingParams a bit, in the order of
+the params extras (updates keep the position of an extra, new extras are appended, so the bits
+of a state are stable). Quote.extras_mask holds the bits of the enabled extras next to the
+extras JSON, which stays the source of the API shape and of the pricing order. Filters like
+"all texas quotes with flood" are then a bitwise test on the (state, extras_mask) index instead
+of a scan of the JSON.
+
+The mask is written with the stored price (store_price and the bulk inserts) and recomputed by
+the repricer whenever the params of a state change.
+"""
+from types import MappingProxyType
+from sqlalchemy import and_, bindparam, false, inspect, or_, select, text, update
+from server.api.db import db
+from server.api.rules import BOUND_TYPES
+from server.database.models import Quote
+
+# extras_mask is a signed 64 bits integer
+MAX_EXTRA_BITS = 63
+
+
+def extra_bits(extras: list) -> MappingProxyType:
+    """Returns the extras registry of a state, extra name -> bit
+
+    Args:
+        extras (list): PricingParams extras, in order
+
+    Returns:
+        MappingProxyType: extra name -> bit, the extras past MAX_EXTRA_BITS have none (caps and
+        floors are not quote extras and have none either)
+    """
+    names = dict.fromkeys(
+        extra["name"] for extra in extras if extra.get("type") not in BOUND_TYPES
+    )
+    return MappingProxyType(
+        {name: bit for bit, name in enumerate(names) if bit < MAX_EXTRA_BITS}
+    )
+
+
+def extras_mask(extras: list, bits) -> int:
+    """Returns the bitmask of the enabled extras of a quote
+
+    Args:
+        extras (list): quote extras ({"name": ..., "value": bool})
+        bits (Mapping): extras registry of the quote state
+
+    Returns:
+        int: the bitmask, extras that are not in the registry are left out
+    """
+    mask = 0
+    for extra in extras or []:
+        if extra["value"]:
+            bit = bits.get(extra["name"])
+            if bit is not None:
+                mask |= 1 << bit
+    return mask
+
+
+def has_extra(name: str, pricings: dict):
+    """Returns the WHERE clause selecting the quotes with the extra name enabled
+
+    Args:
+        name (str): extra name
+        pricings (dict): State -> PricingSnapshot of the states to search
+
+    Returns:
+        the clause, false when no state has this extra
+    """
+    clauses = [
+        and_(Quote.state == state, Quote.extras_mask.op("&")(1 << pricing.extra_bits[name]) != 0)
+        for state, pricing in pricings.items()
+        if name in pricing.extra_bits
+    ]
+    return or_(*clauses) if clauses else false()
+
+
+def backfill_extras_masks(pricings: dict, chunk_size: int = 1000) -> int:
+    """Computes the extras_mask of the quotes that don't have one, chunk by chunk
+
+    Args:
+        pricings (dict): State -> PricingSnapshot
+        chunk_size (int, optional): quotes updated and committed at a time
+
+    Returns:
+        int: number of quotes updated
+    """
+    table = Quote.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("quote_id"))
+        .values(extras_mask=bindparam("mask"))
+    )
+    updated = 0
+    for state, pricing in pricings.items():
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                select(Quote.id, Quote.extras)
+                .where(Quote.state == state, Quote.extras_mask.is_(None), Quote.id > last_id)
+                .order_by(Quote.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            db.session.execute(
+                stmt,
+                [
+                    {"quote_id": row.id, "mask": extras_mask(row.extras, pricing.extra_bits)}
+                    for row in rows
+                ],
+            )
+            db.session.commit()
+            last_id = rows[-1].id
+            updated += len(rows)
+    return updated
+
+
+def migrate_extras_mask(pricings: dict, chunk_size: int = 1000) -> int:
+    """Adds the extras_mask column and its index to a Quote table created before them, then
+    backfills the masks
+
+    Args:
+        pricings (dict): State -> PricingSnapshot
+        chunk_size (int, optional): quotes updated and committed at a time
+
+    Returns:
+        int: number of quotes updated
+    """
+    columns = {column["name"] for column in inspect(db.engine).get_columns("quote")}
+    if "extras_mask" not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE quote ADD COLUMN extras_mask BIGINT"))
+    for index in Quote.__table__.indexes:
+        if index.name == "ix_quote_state_extras_mask":
+            index.create(db.engine, checkfirst=True)
+    return backfill_extras_masks(pricings, chunk_size)
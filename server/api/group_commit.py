@@ -0,0 +1,117 @@
+""" Group commit of the quotes created by POST /api/quote/.
+
+With GROUP_COMMIT on, the request threads don't commit their own quote: they queue the row to a
+writer thread which inserts everything queued within GROUP_COMMIT_MAX_DELAY seconds (or
+GROUP_COMMIT_MAX_BATCH rows) with one bulk insert and one commit. Each request waits until the
+transaction holding its quote is committed, so it still answers with a durable id, but the
+database syncs its log once per group instead of once per quote.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from flask import Flask, current_app
+from sqlalchemy import insert
+from server.api.db import db
+from server.api.metrics import registry
+from server.api.rollups import RollupDeltas, apply_rollup_deltas
+from server.database.models import Quote
+
+
+class _WriterState:
+    """Per app queue and writer thread, kept in app.extensions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = None
+        self.pid = None
+
+
+class QuoteWriter:
+    """Flask extension batching the quote inserts of concurrent requests into one transaction.
+
+    GROUP_COMMIT turns it on, GROUP_COMMIT_MAX_BATCH and GROUP_COMMIT_MAX_DELAY (seconds) bound
+    the size of a group and how long its first quote waits for others.
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("GROUP_COMMIT", False)
+        app.config.setdefault("GROUP_COMMIT_MAX_BATCH", 100)
+        app.config.setdefault("GROUP_COMMIT_MAX_DELAY", 0.005)
+        app.extensions["quote_writer"] = _WriterState()
+
+    def insert(self, row: dict) -> int:
+        """Queues a quote and waits for the commit of its group
+
+        Args:
+            row (dict): Quote column values
+
+        Returns:
+            int: the id of the new quote
+        """
+        future = Future()
+        self._queue().put((row, future))
+        return future.result()
+
+    def _queue(self) -> queue.Queue:
+        """Returns the queue of the writer thread, started on first use (and after a fork)"""
+        app = current_app._get_current_object()
+        writer = app.extensions["quote_writer"]
+        with writer.lock:
+            if writer.queue is None or writer.pid != os.getpid():
+                writer.queue = queue.Queue()
+                writer.pid = os.getpid()
+                threading.Thread(
+                    target=self._run,
+                    args=(app, writer.queue),
+                    name="quote-writer",
+                    daemon=True,
+                ).start()
+            return writer.queue
+
+    def _run(self, app: Flask, pending: queue.Queue):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + float(app.config["GROUP_COMMIT_MAX_DELAY"])
+            max_batch = int(app.config["GROUP_COMMIT_MAX_BATCH"])
+            while len(batch) < max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(pending.get(timeout=max(timeout, 0)))
+                except queue.Empty:
+                    break
+            self._flush(app, batch)
+
+    def _flush(self, app: Flask, batch: list):
+        """Inserts and commits a group, then wakes up the requests waiting on it"""
+        start = time.perf_counter()
+        with app.app_context():
+            try:
+                ids = db.session.scalars(
+                    insert(Quote).returning(Quote.id, sort_by_parameter_order=True),
+                    [row for row, _ in batch],
+                ).all()
+                deltas = RollupDeltas()
+                for row, _ in batch:
+                    deltas.add(
+                        row["state"], row["coverage_type"], row["extras"], row["monthly_total"]
+                    )
+                apply_rollup_deltas(deltas)
+                db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                for _, future in batch:
+                    future.set_exception(error)
+                return
+        registry.observe("group_commit_batch_size", len(batch))
+        registry.observe("group_commit_flush_seconds", time.perf_counter() - start)
+        for (_, future), quote_id in zip(batch, ids):
+            future.set_result(quote_id)
+
+
+quote_writer = QuoteWriter()
@@ -1,6 +1,16 @@
 import json
 from flask_sqlalchemy import SQLAlchemy
-from server.database.models import PricingParams, Quote, State, CoverageType
+from server.database.models import PricingParams, Quote
+from server.api.pricing import PricingPlan, format_float
+from server.api.params_io import upsert_params
+from server.api.validation import (
+    PRICING_VALIDATOR,
+    COVERAGE_VALIDATOR,
+    COVERAGE_UPDATE_VALIDATOR,
+    EXTRAS_VALIDATOR,
+    EXTRA_VALIDATOR,
+    QUOTE_VALIDATOR,
+)
 
 
 def db_seed(db: SQLAlchemy):
@@ -10,22 +20,15 @@ def db_seed(db: SQLAlchemy):
         db (SQLAlchemy): takes in a databse instance as a parameter. This allows us to use it in
         testing via a fixture
     """
-    pricing_params = PricingParams.query.all()
-    pricing_params_states = [pricing.state.value for pricing in pricing_params]
     with open("seed.json") as json_file:
         seed_data = json.load(json_file)
-        for pricing_param in seed_data:
-            valid, error = validate_pricing_data(pricing_param)
-            # here we check if the state already exists, if so we dont add the seed vals
-            if valid and pricing_param["state"] not in pricing_params_states:
-                new_pricing = PricingParams(
-                    state=pricing_param["state"],
-                    tax=pricing_param["tax"],
-                    coverage_type_prices=pricing_param["coverage_type_prices"],
-                    extras=pricing_param["extras"],
-                )
-                db.session.add(new_pricing)
-        db.session.commit()
+    # the valid states are inserted with one statement, the states that already exist are
+    # left as they are
+    upsert_params(
+        [pricing_param for pricing_param in seed_data if validate_pricing_data(pricing_param)[0]],
+        update=False,
+    )
+    db.session.commit()
 
 
 def validate_pricing_data(data) -> (bool, str):
@@ -43,23 +46,7 @@ def validate_pricing_data(data) -> (bool, str):
         bool: Returns True is data is valid else False
         str: If data is not valid, it returns the error str
     """
-    # validate that the state name is in our enum
-    states = [state.value for state in State]
-    if data["state"] not in states:
-        return False, "invalid state"
-    # validate that we have base values for coverage types
-    status, err = validate_coverage(data["coverage_type_prices"])
-    if not status:
-        return False, f"coverage_type_prices{err}"
-    # validate extras
-    status, err = validate_extras(data["extras"])
-    if not status:
-        return False, f"extras{err}"
-    # validate tax info
-    if not is_float(data["tax"]):
-        return False, f"tax should be a float"
-
-    return True, None
+    return PRICING_VALIDATOR.validate(data)
 
 
 def validate_coverage(data) -> (bool, str):
@@ -72,13 +59,21 @@ def validate_coverage(data) -> (bool, str):
         bool: Returns True is data is valid else False
         str: If data is not valid, it returns the error str
     """
-    coverage_types = set([coverage_type.value for coverage_type in CoverageType])
-    if set(data.keys()) != coverage_types:
-        return False, "[coverage_name]"
-    for val in data.values():
-        if not is_float(val):
-            return False, "[value]"
-    return True, None
+    return COVERAGE_VALIDATOR.validate(data)
+
+
+def validate_coverage_update(data) -> (bool, str):
+    """Validates the coverages of add_or_update_coverage, ensures that every key is a coverage
+    type and the values are numbers >= 0
+
+    Args:
+        data (json): data needed to be validated
+
+    Returns:
+        bool: Returns True is data is valid else False
+        str: If data is not valid, it returns the error str
+    """
+    return COVERAGE_UPDATE_VALIDATOR.validate(data)
 
 
 def validate_extras(data) -> (bool, str):
@@ -94,16 +89,7 @@ def validate_extras(data) -> (bool, str):
         bool: Returns True is data is valid else False
         str: If data is not valid, it returns the error str
     """
-    # validate extra types
-    valid_extra_types = {"add", "multiply"}
-    for extra in data:
-        if "name" not in extra or "type" not in extra or "value" not in extra:
-            return False, " key missing, ensure you have name, type, and value"
-        if extra["type"] not in valid_extra_types:
-            return False, "[type]"
-        if not is_float(extra["value"]):
-            return False, "[value]"
-    return True, None
+    return EXTRAS_VALIDATOR.validate(data)
 
 
 def validate_extra(data) -> (bool, str):
@@ -116,11 +102,64 @@ def validate_extra(data) -> (bool, str):
         bool: Returns True is data is valid else False
         str: If data is not valid, it returns the error str
     """
-    if "name" not in data or "value" not in data:
-        return False, " key missing, ensure you have name, type, and value"
-    if not type(data["value"]) == bool:
-        return False, " value is wrong format"
-    return True, None
+    return EXTRA_VALIDATOR.validate(data)
+
+
+def parse_extra_changes(data) -> (list, list, str):
+    """Reads the body of add_extra_or_update: one extra, a list of extras or
+    {"extras": [...], "remove": [names]}, every extra is validated with validate_extra
+
+    Args:
+        data (json): request body
+
+    Returns:
+        list: extras to add or update
+        list: names of the extras to remove
+        str: If data is not valid, it returns the error str (the lists are then None)
+    """
+    removals = []
+    if isinstance(data, dict) and ("extras" in data or "remove" in data):
+        changes = data.get("extras", [])
+        removals = data.get("remove", [])
+        if not isinstance(removals, list) or not all(
+            isinstance(name, str) for name in removals
+        ):
+            return None, None, "remove should be a list of extra names"
+    elif isinstance(data, list):
+        changes = data
+    else:
+        changes = [data]
+    if not isinstance(changes, list):
+        return None, None, "extras should be a list"
+    for extra in changes:
+        valid, err = validate_extra(extra)
+        if not valid:
+            return None, None, err
+    return changes, removals, None
+
+
+def apply_extra_changes(extras: list, changes: list, removals: list) -> list:
+    """Returns the quote extras with the changes applied: an extra with the name of an existing
+    one replaces it, the others are appended, then the removed names are dropped
+
+    Args:
+        extras (list): current quote extras
+        changes (list): validated extras ({"name": ..., "value": bool})
+        removals (list): names of the extras to remove
+
+    Returns:
+        list: the new quote extras
+    """
+    updated = [dict(extra) for extra in extras]
+    index = {extra["name"]: i for i, extra in enumerate(updated)}
+    for extra in changes:
+        if extra["name"] in index:
+            updated[index[extra["name"]]] = extra
+        else:
+            index[extra["name"]] = len(updated)
+            updated.append(extra)
+    removed = set(removals)
+    return [extra for extra in updated if extra["name"] not in removed]
 
 
 def validate_quotes_data(data) -> (bool, str):
@@ -128,6 +167,7 @@ def validate_quotes_data(data) -> (bool, str):
     1. It has firstname, lastname, state and coverage_type
     2. Ensures that state is a valid state
     3. Ensures that coverage type a type that is supported (for now basic and premium)
+    4. Ensures that the optional extras are a list of {"name": str, "value": bool}
 
     Args:
         data (json): data needed to be validated
@@ -136,20 +176,7 @@ def validate_quotes_data(data) -> (bool, str):
         bool: Returns True is data is valid else False
         str: If data is not valid, it returns the error str
     """
-    if (
-        "firstname" not in data
-        or "lastname" not in data
-        or "state" not in data
-        or "coverage_type" not in data
-    ):
-        return False, "missing quote key"
-    states = [state.value for state in State]
-    if data["state"] not in states:
-        return False, "invalid state"
-    coverage_types = set([coverage_type.value for coverage_type in CoverageType])
-    if data["coverage_type"] not in coverage_types:
-        return False, "invalid coverage_type"
-    return True, None
+    return QUOTE_VALIDATOR.validate(data)
 
 
 def calculate_pricing(quote: Quote, pricing_params: PricingParams) -> dict:
@@ -157,6 +184,7 @@ def calculate_pricing(quote: Quote, pricing_params: PricingParams) -> dict:
     It calculates the cost based on all the extras in the pricing params (not just the dog and the flood additive)
     It ensures that the extras in the quote are valid extras.
     This performs all additive operations first, then the multiplier ones (i.e: dog first then flood)
+    Cached params (PricingSnapshot) carry a precompiled PricingPlan, otherwise the plan is compiled here
 
     Args:
         quote (Quote): The quote we want to calculate the cost for
@@ -165,63 +193,8 @@ def calculate_pricing(quote: Quote, pricing_params: PricingParams) -> dict:
     Returns:
         dict: With pricing (id, monthly_subtotal, monthly_tax ,monthly_total)
     """
-    # Get the base pricing (basic or premium)
-    amount = pricing_params.coverage_type_prices[quote.coverage_type]
-
-    # Get the possible additive extras based on the pricing params
-    additive_names = [
-        extra["name"] for extra in pricing_params.extras if extra["type"] == "add"
-    ]
-    # Get the possible multiplier extras based on the pricing params
-    mul_names = [
-        extra["name"] for extra in pricing_params.extras if extra["type"] == "multiply"
-    ]
-    # list of multipliers that will happen at the end, thsi is because we should do
-    # all additive extras first
-    quote_multipliers = []
-    # create a dictinary to easily retrieve the value of the extra
-    extra_name_to_value = {
-        extra["name"]: extra["value"] for extra in pricing_params.extras
-    }
-
-    # we look through all the quote extras
-    # we ensure that they are valid ones (i.e in the pricing params) and True
-    for extra in quote.extras:
-        # if they are additive we simply add the value
-        if extra["name"] in additive_names and extra["value"]:
-            amount += extra_name_to_value[extra["name"]]
-        # if they are multipliers we add to the multipier list to do at the end
-        if extra["name"] in mul_names and extra["value"]:
-            quote_multipliers.append(extra_name_to_value[extra["name"]])
-    # we take care of the multipliers
-    for val in quote_multipliers:
-        amount *= 1 + val
-    # result
-    result = {
-        "id": quote.id,
-        "monthly_subtotal": format_float(amount),
-        "monthly_tax": format_float(amount * pricing_params.tax),
-    }
-    result["monthly_total"] = round(
-        result["monthly_subtotal"] + result["monthly_tax"], 2
-    )
-    return result
-
-
-def format_float(float_val, digits=2) -> float:
-    """This helper is needed so that we can truncate floats to two decimal places. We dont want to use
-    the round method because based on the example Quote 1, the monthly taxes are $0.408 which
-    rounds to $0.41 and the solution says it should be $0.40 therefore truncating not rounding
-
-    Args:
-        float_val (float): Float we want to perform this operation on
-        digits (int, optional): Determines the number of numbers after the decimal. Defaults to 2.
-
-    Returns:
-        float: floast truncated after 2 decimal places
-    """
-    fnum = str(float_val)
-    return float(fnum[: fnum.find(".") + digits + 1])
+    plan = getattr(pricing_params, "plan", None) or PricingPlan.compile(pricing_params)
+    return {"id": quote.id, **plan.price(quote.coverage_type, quote.extras)}
 
 
 def is_float(string) -> bool:
@@ -0,0 +1,300 @@
+""" Idempotency keys of POST /api/quote/.
+
+A client retrying a POST sends the same Idempotency-Key header. The first request claims the
+key (a row without a response, committed right away) and stores its response in the transaction
+that inserts the quote. A retry finds the key by its primary key and gets the stored response
+back, with the Idempotent-Replayed header, without inserting another quote. A retry arriving
+while the first request is still in progress polls the key until the response is stored (or
+answers 409 after IDEMPOTENCY_WAIT_SECONDS). A claim whose request died is taken over after
+IDEMPOTENCY_LOCK_SECONDS.
+
+Keys expire after IDEMPOTENCY_TTL seconds. The expired keys are deleted in batches by a sweeper
+thread of each process and by `python app.py sweep_idempotency_keys`.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import Flask, current_app, g, jsonify
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from server.api.db import db, query_accounting
+from server.api.admission import remaining
+from server.database.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKeyReused(Exception):
+    """The key was already used for a request with another body"""
+
+
+class IdempotencyKeyInProgress(Exception):
+    """The request holding the key did not finish in time"""
+
+
+def parse_idempotency_key(headers) -> (str, str):
+    """Returns the Idempotency-Key of a request (None without one) and the error if it is invalid"""
+    key = headers.get(IDEMPOTENCY_HEADER)
+    if key is not None and not 0 < len(key) <= MAX_KEY_LENGTH:
+        return None, f"invalid {IDEMPOTENCY_HEADER}"
+    return key, None
+
+
+def request_hash(data) -> str:
+    """Returns the sha256 of a JSON request body, independent of the order of its keys"""
+    body = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def try_claim(session, key: str, digest: str, ttl: float, lock_seconds: float):
+    """One attempt to claim a key, committed when it succeeds
+
+    Args:
+        session (Session): a sync session
+        key (str): the Idempotency-Key
+        digest (str): request_hash of the request
+        ttl (float): seconds the key is kept
+        lock_seconds (float): seconds after which a claim without response is taken over
+
+    Returns:
+        bool: True when the current request now holds the key
+        Row: status_code and response of the finished request with this key, or None
+    """
+    now = datetime.utcnow()
+    row = session.execute(
+        select(
+            IdempotencyKey.request_hash,
+            IdempotencyKey.status_code,
+            IdempotencyKey.response,
+            IdempotencyKey.created_at,
+            IdempotencyKey.expires_at,
+        ).where(IdempotencyKey.key == key)
+    ).first()
+    if row is not None and row.expires_at > now:
+        if row.request_hash != digest:
+            raise IdempotencyKeyReused(key)
+        if row.status_code is not None:
+            return False, row
+        if row.created_at > now - timedelta(seconds=lock_seconds):
+            # in progress
+            return False, None
+    values = {
+        "request_hash": digest,
+        "status_code": None,
+        "response": None,
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=ttl),
+    }
+    if row is None:
+        dialect = session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = (
+            insert(IdempotencyKey)
+            .values(key=key, **values)
+            .on_conflict_do_nothing(index_elements=[IdempotencyKey.key])
+        )
+    else:
+        # expired or abandoned, taken over unless another request did it first
+        statement = (
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key, IdempotencyKey.created_at == row.created_at)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+    claimed = session.execute(statement).rowcount == 1
+    session.commit()
+    return claimed, None
+
+
+def store_response(session, key: str, status_code: int, response: dict):
+    """Stores the response of the request holding key, committed with the quote"""
+    session.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key)
+        .values(status_code=status_code, response=response)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def replay(stored):
+    """Returns the stored response of a key"""
+    return jsonify(stored.response), stored.status_code, {REPLAYED_HEADER: "true"}
+
+
+def sweep_expired_keys(batch_size: int = 1000) -> int:
+    """Deletes the expired keys, batch_size keys per transaction
+
+    Returns:
+        int: number of keys deleted
+    """
+    deleted = 0
+    while True:
+        expired = (
+            select(IdempotencyKey.key)
+            .where(IdempotencyKey.expires_at <= datetime.utcnow())
+            .limit(batch_size)
+        )
+        count = db.session.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.key.in_(expired.scalar_subquery()))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+class _SweeperState:
+    """Per app sweeper thread, kept in app.extensions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+
+
+class IdempotencyKeys:
+    """Flask extension holding the idempotency settings and the sweeper of the expired keys.
+
+    IDEMPOTENCY_TTL (seconds a key is kept), IDEMPOTENCY_WAIT_SECONDS (how long a retry waits for
+    the request in progress), IDEMPOTENCY_LOCK_SECONDS, IDEMPOTENCY_SWEEP_INTERVAL (seconds
+    between sweeps, 0 turns the sweeper off) and IDEMPOTENCY_SWEEP_BATCH
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("IDEMPOTENCY_TTL", 86400)
+        app.config.setdefault("IDEMPOTENCY_WAIT_SECONDS", 5.0)
+        app.config.setdefault("IDEMPOTENCY_LOCK_SECONDS", 30.0)
+        app.config.setdefault("IDEMPOTENCY_POLL_INTERVAL", 0.02)
+        app.config.setdefault("IDEMPOTENCY_SWEEP_INTERVAL", 300)
+        app.config.setdefault("IDEMPOTENCY_SWEEP_BATCH", 1000)
+        app.extensions["idempotency_keys"] = _SweeperState()
+        app.teardown_request(self._teardown_request)
+        app.register_error_handler(IdempotencyKeyReused, self._key_reused)
+        app.register_error_handler(IdempotencyKeyInProgress, self._key_in_progress)
+
+    def claim(self, key: str, digest: str):
+        """Claims key for the current request, waiting for the request in progress with this key
+
+        Args:
+            key (str): the Idempotency-Key
+            digest (str): request_hash of the request
+
+        Returns:
+            Row: the stored response when the key was already used, None once it is claimed
+        """
+        self._start_sweeper()
+        wait_until = self._wait_until()
+        config = current_app.config
+        with query_accounting.polling():
+            while True:
+                claimed, stored = try_claim(
+                    db.session,
+                    key,
+                    digest,
+                    config["IDEMPOTENCY_TTL"],
+                    config["IDEMPOTENCY_LOCK_SECONDS"],
+                )
+                if claimed:
+                    g.idempotency_key = key
+                if claimed or stored is not None:
+                    return stored
+                if time.monotonic() >= wait_until:
+                    raise IdempotencyKeyInProgress(key)
+                time.sleep(config["IDEMPOTENCY_POLL_INTERVAL"])
+
+    async def claim_async(self, session, key: str, digest: str):
+        """claim for an AsyncSession"""
+        self._start_sweeper()
+        wait_until = self._wait_until()
+        config = current_app.config
+        with query_accounting.polling():
+            while True:
+                claimed, stored = await session.run_sync(
+                    try_claim,
+                    key,
+                    digest,
+                    config["IDEMPOTENCY_TTL"],
+                    config["IDEMPOTENCY_LOCK_SECONDS"],
+                )
+                if claimed:
+                    g.idempotency_key = key
+                if claimed or stored is not None:
+                    return stored
+                if time.monotonic() >= wait_until:
+                    raise IdempotencyKeyInProgress(key)
+                await asyncio.sleep(config["IDEMPOTENCY_POLL_INTERVAL"])
+
+    def _wait_until(self) -> float:
+        wait = float(current_app.config["IDEMPOTENCY_WAIT_SECONDS"])
+        left = remaining()
+        return time.monotonic() + (wait if left is None else min(wait, left))
+
+    def _teardown_request(self, exc):
+        key = g.pop("idempotency_key", None)
+        if key is not None:
+            # a claim still without response when the request ends belongs to a request that
+            # failed (an exception, handled or not, e.g. a 503 past the deadline): released so
+            # that a retry doesn't have to wait for the lock to expire. The cleanup runs even
+            # past the deadline of the request
+            g.deadline = None
+            db.session.rollback()
+            db.session.execute(
+                delete(IdempotencyKey).where(
+                    IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)
+                )
+            )
+            db.session.commit()
+
+    def _key_reused(self, error):
+        return (
+            f"Data formated incorrectly: {IDEMPOTENCY_HEADER} already used for another request",
+            422,
+        )
+
+    def _key_in_progress(self, error):
+        return (
+            f"Conflict: a request with this {IDEMPOTENCY_HEADER} is in progress, retry later",
+            409,
+            {"Retry-After": "1"},
+        )
+
+    def _start_sweeper(self):
+        """Starts the sweeper thread of this process on first use (and after a fork)"""
+        app = current_app._get_current_object()
+        interval = float(app.config["IDEMPOTENCY_SWEEP_INTERVAL"])
+        state = app.extensions["idempotency_keys"]
+        if interval <= 0 or state.pid == os.getpid():
+            return
+        with state.lock:
+            if state.pid != os.getpid():
+                state.pid = os.getpid()
+                threading.Thread(
+                    target=self._sweep_forever,
+                    args=(app, interval),
+                    name="idempotency-sweeper",
+                    daemon=True,
+                ).start()
+
+    def _sweep_forever(self, app: Flask, interval: float):
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    sweep_expired_keys(int(app.config["IDEMPOTENCY_SWEEP_BATCH"]))
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("sweep of the expired idempotency keys failed")
+
+
+idempotency_keys = IdempotencyKeys()
@@ -2,34 +2,152 @@ from dotenv import load_dotenv
 
 load_dotenv()
 import os
+import json
 from flask import Flask
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from flask.json.provider import DefaultJSONProvider
 
-from server.api.db import db
+from server.api.db import db, query_accounting, replica_routing
+from server.api.json_provider import FastJSONProvider
+from server.api.cache import pricing_cache
+from server.api.repricing import quote_repricer
+from server.api.metrics import metrics
+from server.api.group_commit import quote_writer
+from server.api.serving import warmup
+from server.api.admission import admission_control
+from server.api.idempotency import idempotency_keys
 from server.api.routes.pricing_params import pricing_params_blueprint
 from server.api.routes.quote import quotes_blueprint
+from server.api.routes import quote_async, pricing_params_async
+from server.api.async_db import AsyncFlask, async_db
 
+# engine pool options and the env vars setting them, an option that is not set keeps the
+# SQLAlchemy default (the SQLite in memory pool doesn't take the size, overflow and timeout)
+POOL_OPTIONS = {
+    "pool_size": ("DB_POOL_SIZE", int),
+    "max_overflow": ("DB_MAX_OVERFLOW", int),
+    "pool_timeout": ("DB_POOL_TIMEOUT", float),
+    "pool_recycle": ("DB_POOL_RECYCLE", int),
+    "pool_pre_ping": ("DB_POOL_PRE_PING", lambda value: value == "1"),
+}
 
-def create_app(database_uri=None):
+
+def create_app(
+    database_uri=None, app_class=Flask, replica_database_uri=None, engine_options=None
+):
     """This created the main app and to create the app for testing
 
     Args:
         database_uri (str, optional): Database URI, this is used in our app and also to test. Defaults to None.
+        app_class (type, optional): Flask class to instantiate. Defaults to Flask.
+        replica_database_uri (str, optional): Read replica URI, used by GET requests. Defaults to None.
+        engine_options (dict, optional): pool options (pool_size, max_overflow, pool_timeout,
+            pool_recycle, pool_pre_ping), they override the env vars. Defaults to None.
 
     Returns:
         app(Flask):  the app
     """
-    app = Flask(__name__)
+    app = app_class(__name__)
+    app.json = FastJSONProvider(app)
     uri = database_uri if database_uri else os.environ["SQLALCHEMY_DATABASE_URI"]
     app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    # the GET requests read from the replica when there is one, the env var is only used
+    # together with the env primary
+    if database_uri is None and replica_database_uri is None:
+        replica_database_uri = os.environ.get("SQLALCHEMY_REPLICA_DATABASE_URI")
+    app.config["SQLALCHEMY_REPLICA_DATABASE_URI"] = replica_database_uri
+    # seconds a client reads from the primary after a write, for read-your-writes
+    app.config["READ_REPLICA_PIN_SECONDS"] = float(os.environ.get("READ_REPLICA_PIN_SECONDS", 5))
+    # connection pool of the primary and replica engines of each process, see POOL_OPTIONS
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        option: parse(os.environ[env])
+        for option, (env, parse) in POOL_OPTIONS.items()
+        if env in os.environ
+    }
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(engine_options or {})
+    # connections a worker opens before taking traffic, unset opens the whole pool
+    if "WARMUP_CONNECTIONS" in os.environ:
+        app.config["WARMUP_CONNECTIONS"] = int(os.environ["WARMUP_CONNECTIONS"])
     app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
+    # seconds between checks of the PricingParams versions made by other processes
+    app.config["PRICING_CACHE_TTL"] = float(os.environ.get("PRICING_CACHE_TTL", 1.0))
+    # max number of quotes accepted by POST /api/quote/batch
+    app.config["QUOTE_BATCH_MAX_SIZE"] = int(os.environ.get("QUOTE_BATCH_MAX_SIZE", 1000))
+    # max page size of GET /api/quote/list
+    app.config["QUOTE_LIST_MAX_LIMIT"] = int(os.environ.get("QUOTE_LIST_MAX_LIMIT", 500))
+    # threads repricing the stored quote prices after a params change (0 reprices inline)
+    app.config["REPRICING_WORKERS"] = int(os.environ.get("REPRICING_WORKERS", 2))
+    app.config["REPRICING_CHUNK_SIZE"] = int(os.environ.get("REPRICING_CHUNK_SIZE", 1000))
+    # POST /api/quote/ commits the quotes of concurrent requests together, in groups of at most
+    # GROUP_COMMIT_MAX_BATCH quotes collected for at most GROUP_COMMIT_MAX_DELAY seconds
+    app.config["GROUP_COMMIT"] = os.environ.get("GROUP_COMMIT", "0") == "1"
+    app.config["GROUP_COMMIT_MAX_BATCH"] = int(os.environ.get("GROUP_COMMIT_MAX_BATCH", 100))
+    app.config["GROUP_COMMIT_MAX_DELAY"] = float(os.environ.get("GROUP_COMMIT_MAX_DELAY", 0.005))
+    # directory shared by the worker processes to aggregate /metrics, unset for a single process
+    app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+    # statements slower than this many seconds are logged with their parameters
+    app.config["SQL_SLOW_QUERY_SECONDS"] = float(os.environ.get("SQL_SLOW_QUERY_SECONDS", 0.1))
+    # a request running the same statement more times than this is logged as a N+1
+    app.config["SQL_REPEATED_STATEMENT_LIMIT"] = int(
+        os.environ.get("SQL_REPEATED_STATEMENT_LIMIT", 10)
+    )
+    # concurrency limits per blueprint or endpoint (JSON), see server/api/admission.py
+    app.config["ADMISSION_LIMITS"] = json.loads(os.environ.get("ADMISSION_LIMITS", "{}"))
+    # default seconds a request waits for admission and Retry-After of the 503 answers
+    app.config["ADMISSION_QUEUE_TIMEOUT"] = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 1.0))
+    app.config["ADMISSION_RETRY_AFTER"] = int(os.environ.get("ADMISSION_RETRY_AFTER", 1))
+    # seconds the Idempotency-Keys of POST /api/quote/ are kept, and a retry waits for the
+    # request in progress with its key
+    app.config["IDEMPOTENCY_TTL"] = int(os.environ.get("IDEMPOTENCY_TTL", 86400))
+    app.config["IDEMPOTENCY_WAIT_SECONDS"] = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", 5))
+    # seconds between two sweeps of the expired keys in each process (0 turns it off)
+    app.config["IDEMPOTENCY_SWEEP_INTERVAL"] = float(
+        os.environ.get("IDEMPOTENCY_SWEEP_INTERVAL", 300)
+    )
     # Adds CORS
     cors = CORS(app)
     # Attaches DB to app
     db.init_app(app)
+    # Pins the clients that just wrote to the primary
+    replica_routing.init_app(app)
+    # Attaches the PricingParams cache to app
+    pricing_cache.init_app(app)
+    # Attaches the background quote repricing to app
+    quote_repricer.init_app(app)
+    # Counts the statements and DB time of every request
+    query_accounting.init_app(app)
+    # Attaches the group commit quote writer to app
+    quote_writer.init_app(app)
+    # Records the per endpoint metrics served at /metrics
+    metrics.init_app(app)
+    # Sheds the requests over the concurrency limits and past their deadline
+    admission_control.init_app(app)
+    # Replays the responses of the retried POST /api/quote/ with an Idempotency-Key
+    idempotency_keys.init_app(app)
+    # Warms up the workers of `python app.py serve` and reports the cold start
+    warmup.init_app(app)
     # Add blueprints
     app.register_blueprint(pricing_params_blueprint, url_prefix="/api/pricing_params")
     app.register_blueprint(quotes_blueprint, url_prefix="/api/quote")
     return app
+
+
+def create_async_app(database_uri=None):
+    """Creates the app in async mode: the hot quote and pricing_params endpoints are served by
+    async views on an async SQLAlchemy engine (aiosqlite/asyncpg), everything else is the same app.
+    The database has to be a file or a server, an in memory SQLite database is not shared
+    between the sync and async engines.
+
+    Args:
+        database_uri (str, optional): Database URI, the async driver is derived from it. Defaults to None.
+
+    Returns:
+        app(AsyncFlask):  the app
+    """
+    app = create_app(database_uri, app_class=AsyncFlask)
+    # Attaches the async engine to app
+    async_db.init_app(app)
+    # Replaces the sync views with their async versions
+    app.view_functions.update(quote_async.ASYNC_VIEWS)
+    app.view_functions.update(pricing_params_async.ASYNC_VIEWS)
+    return app
@@ -0,0 +1,107 @@
+""" JSON provider with precomputed serializers for the dataclass models.
+
+Flask's DefaultJSONProvider serializes dataclasses with dataclasses.asdict, which deep copies
+every field (including the NestedMutableJson wrappers) on every response. This provider builds
+one serializer per dataclass type, the first time it sees it, and uses orjson when it is
+installed. The output is the same as DefaultJSONProvider: sorted keys, ASCII only and
+datetimes as HTTP dates. orjson writes some floats differently (1e16 and 1e-05 as 1e16 and
+0.00001, NaN and Infinity as null), the stdlib json module serializes the responses holding them.
+"""
+import dataclasses
+import enum
+import math
+import re
+import typing as t
+from datetime import date
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib json module is used without it
+    orjson = None
+
+_COMPACT_SEPARATORS = (",", ":")
+# floats that orjson writes in exponent form or that the json module does (below 1e-4), may
+# also match inside a string which only costs the fallback
+_EXPONENT_FLOAT = re.compile(r"[0-9]e|(?<![0-9])0\.0000")
+
+
+def _convert(value):
+    """Converts the values that need the same treatment as DefaultJSONProvider"""
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, date):
+        return http_date(value)
+    return value
+
+
+def _build_serializer(cls) -> t.Callable[[t.Any], dict]:
+    """Builds the serializer of a dataclass type, a dict of its fields like dataclasses.asdict"""
+    names = tuple(field.name for field in dataclasses.fields(cls))
+
+    def serialize(obj) -> dict:
+        return {name: _convert(getattr(obj, name)) for name in names}
+
+    return serialize
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider using the precomputed dataclass serializers, and orjson if installed"""
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._serializers = {}
+
+    def default(self, o):
+        """Serializes what json/orjson do not know about, dataclass models first"""
+        serializer = self._serializers.get(type(o))
+        if serializer is None and dataclasses.is_dataclass(o) and not isinstance(o, type):
+            serializer = self._serializers[type(o)] = _build_serializer(type(o))
+        if serializer is not None:
+            return serializer(o)
+        return DefaultJSONProvider.default(o)
+
+    def _has_non_finite(self, obj) -> bool:
+        """Tells if obj holds a NaN or infinite float, which orjson writes as null"""
+        if isinstance(obj, float):
+            return not math.isfinite(obj)
+        if isinstance(obj, dict):
+            values = obj.values()
+        elif isinstance(obj, (list, tuple)):
+            values = obj
+        elif dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+            values = self.default(obj).values()
+        else:
+            return False
+        return any(self._has_non_finite(value) for value in values)
+
+    def dumps(self, obj: t.Any, **kwargs: t.Any) -> str:
+        """Serializes with orjson for compact output (what responses use outside debug),
+        anything else goes through the stdlib json module like DefaultJSONProvider
+        """
+        if orjson is not None and kwargs == {"separators": _COMPACT_SEPARATORS}:
+            try:
+                result = orjson.dumps(
+                    obj,
+                    default=self.default,
+                    option=orjson.OPT_SORT_KEYS
+                    | orjson.OPT_PASSTHROUGH_DATACLASS
+                    | orjson.OPT_PASSTHROUGH_DATETIME,
+                ).decode()
+            except TypeError:
+                result = None
+            # DefaultJSONProvider escapes non ASCII characters, orjson does not
+            if (
+                result is not None
+                and (result.isascii() or not self.ensure_ascii)
+                and not _EXPONENT_FLOAT.search(result)
+                and ("null" not in result or not self._has_non_finite(obj))
+            ):
+                return result
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s: t.Union[str, bytes], **kwargs: t.Any) -> t.Any:
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
@@ -0,0 +1,287 @@
+""" Per endpoint request metrics exposed in the Prometheus text format at /metrics.
+
+Counters, histograms and gauges live in a process wide registry (like prometheus_client's
+default registry). When METRICS_DIR is set, every process writes a snapshot of its registry to
+that directory at most every METRICS_FLUSH_INTERVAL seconds and /metrics adds up the snapshots
+of all the processes, so the numbers are right behind a multi worker server.
+"""
+import bisect
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from flask import Flask, Response, current_app, g, request
+from server.api.db import query_observers
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+HELP = {
+    "http_requests_total": ("counter", "Requests by endpoint, method and status"),
+    "http_request_duration_seconds": ("histogram", "Request latency by endpoint"),
+    "http_requests_in_flight": ("gauge", "Requests being served by endpoint"),
+    "pricing_duration_seconds": ("histogram", "Time spent pricing quotes"),
+    "db_query_duration_seconds": ("histogram", "Time spent executing SQL statements"),
+    "group_commit_batch_size": ("histogram", "Quotes inserted per group commit transaction"),
+    "group_commit_flush_seconds": ("histogram", "Time spent inserting and committing a group"),
+    "cold_start_seconds": ("histogram", "Time from the start of a process to its first response"),
+    "admission_in_flight": ("gauge", "Requests admitted and being served by limiter"),
+    "admission_queued": ("gauge", "Requests waiting for admission by limiter"),
+    "admission_wait_seconds": ("histogram", "Time spent waiting for admission by limiter"),
+    "admission_rejected_total": ("counter", "Requests answered 503 by limiter and reason"),
+}
+
+# histograms that don't measure seconds, with their own buckets
+BUCKETS = {
+    "group_commit_batch_size": (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+    "cold_start_seconds": (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+}
+
+
+class Registry:
+    """Thread safe store of the metric values of this process.
+    Every metric value is keyed by (name, labels) where labels is a sorted tuple of pairs
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # histogram value: [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, labels: dict = None, value: float = 1):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, labels: dict = None):
+        key = (name, _labels(labels))
+        buckets = BUCKETS.get(name, self.buckets)
+        index = bisect.bisect_left(buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def snapshot(self) -> dict:
+        """Returns a JSON serializable copy of the values"""
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "buckets": list(self.buckets),
+                "counters": [[n, list(l), v] for (n, l), v in self.counters.items()],
+                "gauges": [[n, list(l), v] for (n, l), v in self.gauges.items()],
+                "histograms": [[n, list(l), v] for (n, l), v in self.histograms.items()],
+            }
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+registry = Registry()
+
+
+def timed(name: str):
+    """Decorator recording the duration of every call in the histogram name"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def merge_snapshots(snapshots: list) -> dict:
+    """Adds up the snapshots of several processes, gauges of dead processes are left out"""
+    merged = {"counters": {}, "gauges": {}, "histograms": {}}
+    for snapshot in snapshots:
+        for kind in ("counters", "gauges", "histograms"):
+            if kind == "gauges" and not _is_alive(snapshot["pid"]):
+                continue
+            for name, labels, value in snapshot[kind]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if kind == "histograms":
+                    current = merged[kind].get(key, [0] * len(value))
+                    merged[kind][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[kind][key] = merged[kind].get(key, 0) + value
+    return merged
+
+
+def _is_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def render(merged: dict, buckets: tuple) -> str:
+    """Renders merged values in the Prometheus text exposition format"""
+    by_name = {}
+    for kind in ("counters", "gauges", "histograms"):
+        for (name, labels), value in merged[kind].items():
+            by_name.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text = HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(by_name[name]):
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS.get(name, buckets) + ("+Inf",), value[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                bucket_labels = _format_labels(labels + (("le", le),))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Flask extension recording latency, counts, status codes and in flight requests of every
+    endpoint, and serving them at /metrics
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("METRICS_DIR", None)
+        app.config.setdefault("METRICS_FLUSH_INTERVAL", 1.0)
+        app.extensions["metrics"] = {"last_flush": 0.0, "lock": threading.Lock()}
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+        if _observe_query not in query_observers:
+            query_observers.append(_observe_query)
+
+    def metrics_view(self):
+        """GET /metrics in the Prometheus text format"""
+        directory = current_app.config["METRICS_DIR"]
+        snapshots = [registry.snapshot()]
+        if directory:
+            self._flush(force=True)
+            snapshots = _read_snapshots(directory)
+        return Response(
+            render(merge_snapshots(snapshots), registry.buckets),
+            mimetype="text/plain; version=0.0.4",
+        )
+
+    def _before_request(self):
+        if request.endpoint == "metrics":
+            return
+        g.metrics_start = time.perf_counter()
+        g.metrics_endpoint = request.endpoint or "unmatched"
+        registry.add_gauge("http_requests_in_flight", {"endpoint": g.metrics_endpoint})
+
+    def _after_request(self, response):
+        start = g.get("metrics_start")
+        if start is not None:
+            endpoint = g.metrics_endpoint
+            registry.observe(
+                "http_request_duration_seconds",
+                time.perf_counter() - start,
+                {"endpoint": endpoint},
+            )
+            registry.inc(
+                "http_requests_total",
+                {
+                    "endpoint": endpoint,
+                    "method": request.method,
+                    "status": str(response.status_code),
+                },
+            )
+        return response
+
+    def _teardown_request(self, exc):
+        if g.pop("metrics_start", None) is not None:
+            registry.add_gauge(
+                "http_requests_in_flight", {"endpoint": g.metrics_endpoint}, -1
+            )
+            self._flush()
+
+    def _flush(self, force=False):
+        """Writes the snapshot of this process to METRICS_DIR, at most every flush interval"""
+        directory = current_app.config["METRICS_DIR"]
+        if not directory:
+            return
+        state = current_app.extensions["metrics"]
+        now = time.monotonic()
+        if not force and now - state["last_flush"] < current_app.config["METRICS_FLUSH_INTERVAL"]:
+            return
+        with state["lock"]:
+            state["last_flush"] = now
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(registry.snapshot(), f)
+            os.replace(tmp, os.path.join(directory, f"metrics_{os.getpid()}.json"))
+
+
+def _read_snapshots(directory: str) -> list:
+    snapshots = []
+    for filename in os.listdir(directory):
+        if filename.startswith("metrics_") and filename.endswith(".json"):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return snapshots
+
+
+def _observe_query(statement, parameters, seconds):
+    registry.observe("db_query_duration_seconds", seconds)
+
+
+metrics = Metrics()
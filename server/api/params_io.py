@@ -0,0 +1,199 @@
+""" Bulk import and export of PricingParams.
+
+An import reads a JSON array (like seed.json) or NDJSON (one PricingParams per line, the format
+of the export), validates every record and upserts all the states with a single
+INSERT ... ON CONFLICT (state) DO UPDATE in one transaction: either every state is written or,
+if any record is invalid, none is. A dry run reports what would change without writing.
+"""
+import itertools
+import json
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from server.api.db import db
+from server.api.cache import pricing_cache
+from server.api.repricing import quote_repricer
+from server.api.validation import PRICING_VALIDATOR
+from server.database.models import PricingParams, State
+
+# the fields of a PricingParams record in the import/export files
+FIELDS = ("state", "tax", "coverage_type_prices", "extras")
+
+
+def read_params_records(lines) -> (list, list):
+    """Parses an import file, a JSON array or NDJSON
+
+    Args:
+        lines (iterable): lines of the file (str or bytes)
+
+    Returns:
+        list: the records
+        list: {"record": index, "errors": {...}} of the lines that are not valid JSON
+    """
+    records = []
+    errors = []
+    lines = iter(lines)
+    for first in lines:
+        first = first.decode() if isinstance(first, bytes) else first
+        if first.strip():
+            break
+    else:
+        return records, errors
+    if first.lstrip().startswith("["):
+        # a JSON document, the file has to be read whole
+        rest = "".join(line.decode() if isinstance(line, bytes) else line for line in lines)
+        try:
+            data = json.loads(first + rest)
+        except ValueError:
+            return records, [{"record": 0, "errors": {"": "invalid JSON"}}]
+        return (data if isinstance(data, list) else [data]), errors
+    for line in itertools.chain([first], lines):
+        line = line.decode() if isinstance(line, bytes) else line
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            errors.append({"record": len(records) + len(errors), "errors": {"": "invalid JSON"}})
+    return records, errors
+
+
+def import_params(records: list, dry_run: bool = False, parse_errors: list = None) -> dict:
+    """Validates and upserts PricingParams records, in one transaction
+
+    Args:
+        records (list): PricingParams records ({"state", "tax", "coverage_type_prices", "extras"})
+        dry_run (bool, optional): only report the changes. Defaults to False.
+        parse_errors (list, optional): errors of read_params_records, reported with the others
+
+    Returns:
+        dict: created, updated (state -> changed fields) and unchanged states, and the errors
+        of the invalid records (nothing is written when there are errors)
+    """
+    errors = list(parse_errors or [])
+    by_state = {}
+    for i, record in enumerate(records):
+        record_errors = PRICING_VALIDATOR.errors(record)
+        if not record_errors and record["state"] in by_state:
+            record_errors = {"state": "duplicate state"}
+        if record_errors:
+            errors.append({"record": i, "errors": record_errors})
+            continue
+        by_state[record["state"]] = {field: record[field] for field in FIELDS}
+
+    current = {
+        row.state.value: {
+            "state": row.state.value,
+            "tax": row.tax,
+            "coverage_type_prices": row.coverage_type_prices,
+            "extras": row.extras,
+        }
+        for row in db.session.execute(
+            select(
+                PricingParams.state,
+                PricingParams.tax,
+                PricingParams.coverage_type_prices,
+                PricingParams.extras,
+            ).where(PricingParams.state.in_([State(state) for state in by_state]))
+        )
+    }
+    report = {"dry_run": dry_run, "created": [], "updated": {}, "unchanged": [], "errors": errors}
+    changed = []
+    for state, record in by_state.items():
+        if state not in current:
+            report["created"].append(state)
+            changed.append(record)
+            continue
+        fields = [f for f in FIELDS if _normalize(record[f]) != _normalize(current[state][f])]
+        if fields:
+            report["updated"][state] = fields
+            changed.append(record)
+        else:
+            report["unchanged"].append(state)
+
+    if errors or dry_run or not changed:
+        return report
+    upsert_params(changed)
+    db.session.commit()
+    for state in report["created"]:
+        pricing_cache.invalidate(state)
+    for state in report["updated"]:
+        pricing_cache.invalidate(state)
+        quote_repricer.schedule(state)
+    return report
+
+
+def _normalize(value):
+    return json.loads(json.dumps(value))
+
+
+def upsert_params(records: list, update: bool = True):
+    """Inserts validated PricingParams records with one statement, existing states are
+    updated (their version bumped) or, with update=False, left as they are. Not committed
+
+    Args:
+        records (list): validated PricingParams records
+        update (bool, optional): update the existing states. Defaults to True.
+    """
+    if not records:
+        return
+    table = PricingParams.__table__
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    statement = insert(table)
+    if update:
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.state],
+            set_={
+                "tax": statement.excluded.tax,
+                "coverage_type_prices": statement.excluded.coverage_type_prices,
+                "extras": statement.excluded.extras,
+                "updated_at": statement.excluded.updated_at,
+                "version": table.c.version + 1,
+            },
+        )
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=[table.c.state])
+    now = datetime.utcnow()
+    db.session.execute(
+        statement,
+        [
+            {
+                "state": State(record["state"]),
+                "tax": record["tax"],
+                "coverage_type_prices": record["coverage_type_prices"],
+                "extras": record["extras"],
+                "version": 1,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for record in records
+        ],
+    )
+
+
+def iter_params_ndjson(chunk_size=100):
+    """Generator of the NDJSON export of all the PricingParams, in the import format
+
+    Args:
+        chunk_size (int, optional): rows fetched per round trip and lines per yielded chunk
+
+    Yields:
+        bytes: chunks of the NDJSON output
+    """
+    stmt = select(
+        PricingParams.state,
+        PricingParams.tax,
+        PricingParams.coverage_type_prices,
+        PricingParams.extras,
+    ).order_by(PricingParams.state)
+    dumps = current_app.json.dumps
+    lines = []
+    for row in db.session.execute(stmt.execution_options(yield_per=chunk_size)):
+        lines.append(dumps({**row._asdict(), "state": row.state.value}, separators=(",", ":")))
+        if len(lines) >= chunk_size:
+            yield ("\n".join(lines) + "\n").encode()
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode()
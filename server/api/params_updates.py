@@ -0,0 +1,243 @@
+""" Atomic updates of the PricingParams coverage and extras.
+
+The JSON documents are changed inside the database by a single conditional UPDATE (json_replace
+and json_each on SQLite, jsonb_set and jsonb_array_elements on Postgres) which also bumps the
+version column, so two concurrent updates of a state can't lose each other's changes. The extras
+update first reads the extras to find the rule each change updates (several rules can share a
+name), its UPDATE then only applies at the version it read. A caller that read the params at a
+version can pass it as expected_version: if another update went in first, StaleVersionError is
+raised instead.
+"""
+import json
+from datetime import datetime
+from flask import abort
+from sqlalchemy import DateTime, Integer, bindparam, cast, func, select, text, update
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.types import JSON, Text
+from server.api.db import db
+from server.database.models import PricingParams, State
+
+
+class AmbiguousExtraError(Exception):
+    """A change of the extras doesn't tell which of the rules sharing its name it updates"""
+
+    def __init__(self, name: str, rules: int):
+        super().__init__(
+            f"{rules} rules are named {name}, give the type and coverage_types of the one to update"
+        )
+        self.name = name
+
+
+class StaleVersionError(Exception):
+    """The PricingParams were updated since the version the caller read"""
+
+    def __init__(self, state: State, expected_version: int):
+        super().__init__(
+            f"PricingParams of {state.value} are no longer at version {expected_version}, "
+            "fetch them again and retry"
+        )
+        self.state = state
+        self.expected_version = expected_version
+
+
+# merges the changes (JSON array of {"position": index of the extra to patch or null to
+# append, "change": {...}}) into the extras array, in place or appended in order
+_MERGE_EXTRAS = {
+    "sqlite": """
+        UPDATE pricing_params SET version = version + 1, updated_at = :updated_at, extras = (
+            SELECT json_group_array(json(merged.value)) FROM (
+                SELECT coalesce(json_patch(e.value, json_extract(c.value, '$.change')), e.value)
+                    AS value, 0 AS part, e.key AS position
+                FROM json_each(pricing_params.extras) AS e
+                LEFT JOIN json_each(:changes) AS c
+                    ON json_extract(c.value, '$.position') = e.key
+                UNION ALL
+                SELECT json_extract(c.value, '$.change'), 1, c.key FROM json_each(:changes) AS c
+                WHERE json_extract(c.value, '$.position') IS NULL
+                ORDER BY part, position
+            ) AS merged
+        )
+        WHERE state = :state AND version = :expected_version
+        RETURNING version
+    """,
+    "postgresql": """
+        UPDATE pricing_params SET version = version + 1, updated_at = :updated_at, extras = (
+            SELECT coalesce(jsonb_agg(merged.value ORDER BY part, position), '[]'::jsonb)::json
+            FROM (
+                SELECT coalesce(e.value || (c.value->'change'), e.value) AS value,
+                    0 AS part, e.position
+                FROM jsonb_array_elements(pricing_params.extras::jsonb)
+                    WITH ORDINALITY AS e(value, position)
+                LEFT JOIN jsonb_array_elements(CAST(:changes AS jsonb)) AS c(value)
+                    ON (c.value->>'position')::bigint = e.position - 1
+                UNION ALL
+                SELECT c.value->'change', 1, c.position
+                FROM jsonb_array_elements(CAST(:changes AS jsonb))
+                    WITH ORDINALITY AS c(value, position)
+                WHERE c.value->>'position' IS NULL
+            ) AS merged
+        )
+        WHERE state = :state AND version = CAST(:expected_version AS integer)
+        RETURNING version
+    """,
+}
+
+
+def update_coverage(state: State, prices: dict, expected_version: int = None) -> int:
+    """Sets the price of the coverage types of a state, coverage types not already in the
+    params are ignored
+
+    Args:
+        state (State): state of the PricingParams
+        prices (dict): validated coverage type -> price
+        expected_version (int, optional): version the caller read. Defaults to None (any).
+
+    Returns:
+        int: the new version
+    """
+    document = coverage_document(prices, db.session.get_bind().dialect.name)
+    statement = (
+        update(PricingParams)
+        .where(PricingParams.state == state)
+        .values(coverage_type_prices=document, version=PricingParams.version + 1)
+        .returning(PricingParams.version)
+        .execution_options(synchronize_session=False)
+    )
+    if expected_version is not None:
+        statement = statement.where(PricingParams.version == expected_version)
+    return _execute(statement, state, expected_version)
+
+
+def coverage_document(prices: dict, dialect: str):
+    """Returns the SQL expression of coverage_type_prices with the validated prices set
+
+    Args:
+        prices (dict): coverage type -> price
+        dialect (str): name of the database dialect
+
+    Returns:
+        ColumnElement: the new document
+    """
+    column = PricingParams.coverage_type_prices
+    if dialect == "postgresql":
+        document = cast(column, JSONB)
+        for name, price in prices.items():
+            # the JSONB bind processor dumps the price, it must not be dumped before
+            document = func.jsonb_set(
+                document, cast([name], ARRAY(Text)), cast(price, JSONB), False
+            )
+        return cast(document, JSON)
+    pairs = []
+    for name, price in prices.items():
+        pairs += [f'$."{name}"', func.json(json.dumps(price))]
+    return func.json_replace(column, *pairs) if pairs else column
+
+
+def match_extra(extras: list, change: dict) -> int:
+    """Returns the position of the extra a change updates, None when it adds a new one.
+
+    An extra is found by its name. When several rules share the name (see server/api/rules.py)
+    the change must also give the type of the one it updates, and its coverage_types when the
+    type isn't enough. A change with coverage_types that no rule of the name has adds a rule.
+
+    Args:
+        extras (list): extras of the PricingParams
+        change (dict): validated extra
+
+    Raises:
+        AmbiguousExtraError: the change matches several rules, or none of several
+
+    Returns:
+        int: index in extras, or None
+    """
+    candidates = [i for i, extra in enumerate(extras) if extra["name"] == change["name"]]
+    matches = candidates
+    if len(matches) > 1:
+        matches = [i for i in matches if extras[i]["type"] == change["type"]]
+    if "coverage_types" in change:
+        coverage_types = set(change["coverage_types"] or ())
+        matches = [
+            i for i in matches if set(extras[i].get("coverage_types") or ()) == coverage_types
+        ]
+    if len(matches) == 1:
+        return matches[0]
+    if not matches and (not candidates or "coverage_types" in change):
+        return None
+    raise AmbiguousExtraError(change["name"], len(candidates))
+
+
+def update_extras(state: State, extras: list, expected_version: int = None) -> int:
+    """Adds or updates many extras of a state in one statement. A change updates the extra it
+    matches (see match_extra), the others are appended
+
+    The positions of the extras to update are resolved on the params read at their current
+    version and the UPDATE only applies at that version: without expected_version a concurrent
+    update makes it resolve them again.
+
+    Args:
+        state (State): state of the PricingParams
+        extras (list): validated extras ({"name": ..., "type": ..., "value": ...})
+        expected_version (int, optional): version the caller read. Defaults to None (any).
+
+    Raises:
+        AmbiguousExtraError: a change matches several rules
+
+    Returns:
+        int: the new version
+    """
+    dialect = db.session.get_bind().dialect.name
+    statement = text(_MERGE_EXTRAS.get(dialect, _MERGE_EXTRAS["sqlite"])).bindparams(
+        bindparam("state", type_=PricingParams.__table__.c.state.type),
+        bindparam("expected_version", type_=Integer),
+        bindparam("updated_at", type_=DateTime()),
+    )
+    while True:
+        current = db.session.execute(
+            select(PricingParams.extras, PricingParams.version).where(
+                PricingParams.state == state
+            )
+        ).first()
+        if current is None:
+            db.session.rollback()
+            abort(404)
+        if expected_version is not None and current.version != expected_version:
+            db.session.rollback()
+            raise StaleVersionError(state, expected_version)
+        # changes of the same extra: the later change wins, at the position of the first
+        changes = {}
+        for extra in extras:
+            position = match_extra(current.extras, extra)
+            target = position
+            if position is None:
+                coverage_types = extra.get("coverage_types")
+                target = (extra["name"], coverage_types and tuple(sorted(coverage_types)))
+            changes.setdefault(target, {"position": position, "change": {}})["change"].update(
+                extra
+            )
+        params = {
+            "state": state,
+            "changes": json.dumps(list(changes.values())),
+            "expected_version": current.version,
+            "updated_at": datetime.utcnow(),
+        }
+        version = db.session.execute(statement, params).scalar()
+        if version is not None:
+            db.session.commit()
+            return version
+        db.session.rollback()
+        if expected_version is not None:
+            raise StaleVersionError(state, expected_version)
+
+
+def _execute(statement, state: State, expected_version: int, params: dict = None) -> int:
+    version = db.session.execute(statement, params).scalar()
+    if version is None:
+        db.session.rollback()
+        exists = db.session.scalar(
+            select(PricingParams.id).where(PricingParams.state == state)
+        )
+        if exists is None:
+            abort(404)
+        raise StaleVersionError(state, expected_version)
+    db.session.commit()
+    return version
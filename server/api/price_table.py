@@ -0,0 +1,115 @@
+""" Precomputed price lookup tables.
+
+Quote extras are booleans, so under one PricingPlan the price only depends on the coverage type
+and on which of the priced extras are on. A PriceTable gives every priced extra a bit (additive
+extras first, then the multipliers, in the order of the params extras, see
+PricingPlan.priced_names) and holds the price of
+every (coverage_type, extras bitmask), so pricing a quote is building its bitmask and one list
+index. When there are too many extras for
+a full table, prices are computed on demand and kept in a bounded LRU instead.
+
+Table prices are computed with PricingPlan.subtotal on the enabled extras in bit order, so they
+are exactly the prices of quotes listing their enabled extras in that order. Float additions
+and multiplications depend on their order, so a quote listing them in another order (or the
+same extra twice) is not looked up and gets priced by the plan as before.
+"""
+import threading
+from collections import OrderedDict
+
+# full tables are built up to this many (coverage_type, bitmask) entries (2 coverages, 11 extras)
+MAX_TABLE_ENTRIES = 4096
+# entries kept per plan when the table is too large to be built
+LRU_SIZE = 4096
+
+
+class PriceTable:
+    """Prices of every (coverage_type, enabled extras) of a PricingPlan
+
+    Attributes:
+        bits (dict): priced extra name -> bit, additive extras first then the multipliers
+        coverage_index (dict): coverage type -> index of its block of 2 ** len(bits) prices
+        prices (list): the full table, None when it would have more than max_entries entries
+    """
+
+    def __init__(self, plan, max_entries: int = MAX_TABLE_ENTRIES, lru_size: int = LRU_SIZE):
+        self.plan = plan
+        self.bits = {name: bit for bit, name in enumerate(plan.priced_names)}
+        self.names = tuple(self.bits)
+        self.coverage_index = {name: i for i, name in enumerate(plan.base_prices)}
+        self.width = len(self.bits)
+        self.prices = None
+        self.lru = None
+        if len(self.coverage_index) << self.width <= max_entries:
+            self.prices = [
+                self._compute(coverage_type, mask)
+                for coverage_type in self.coverage_index
+                for mask in range(1 << self.width)
+            ]
+        else:
+            self.lru_size = lru_size
+            self.lru = OrderedDict()
+            self.lock = threading.Lock()
+
+    def mask(self, extras) -> int:
+        """Returns the bitmask of the enabled priced extras, None if they are not in bit order
+        (or one is given twice) so the table price may differ from the plan price
+
+        Args:
+            extras (list): quote extras ({"name": ..., "value": bool})
+
+        Returns:
+            int: the bitmask or None
+        """
+        bits = self.bits
+        mask = 0
+        last = -1
+        for extra in extras:
+            if not extra["value"]:
+                continue
+            bit = bits.get(extra["name"])
+            if bit is None:
+                continue  # not priced
+            if bit <= last:
+                return None
+            last = bit
+            mask |= 1 << bit
+        return mask
+
+    def lookup(self, coverage_type, extras) -> dict:
+        """Returns the price of a quote, None when it has to be priced by the plan
+
+        Args:
+            coverage_type (CoverageType | str): coverage type of the quote
+            extras (list): quote extras ({"name": ..., "value": bool})
+
+        Returns:
+            dict: With pricing (monthly_subtotal, monthly_tax ,monthly_total) or None
+        """
+        coverage = self.coverage_index.get(coverage_type)
+        if coverage is None:
+            return None
+        mask = self.mask(extras)
+        if mask is None:
+            return None
+        if self.prices is not None:
+            return dict(self.prices[coverage << self.width | mask])
+        key = (coverage, mask)
+        with self.lock:
+            price = self.lru.get(key)
+            if price is not None:
+                self.lru.move_to_end(key)
+                return dict(price)
+        price = self._compute(coverage_type, mask)
+        with self.lock:
+            self.lru[key] = price
+            if len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+        return dict(price)
+
+    def _compute(self, coverage_type, mask: int) -> dict:
+        extras = [
+            {"name": name, "value": True}
+            for bit, name in enumerate(self.names)
+            if mask >> bit & 1
+        ]
+        return self.plan.finalize(self.plan.subtotal(coverage_type, extras))
@@ -0,0 +1,164 @@
+""" Compiled pricing plans.
+
+A PricingPlan is built once per PricingParams version (see server/api/cache.py) so pricing a
+quote is a single pass over the quote extras with dict lookups, instead of rebuilding the
+lists of extras from the params on every call. Params using the rule format (tiers, caps and
+floors, conditions, see server/api/rules.py) are compiled into a RuleSet of closures instead of
+the additive/multipliers lookups. Cached plans also carry a PriceTable (see
+server/api/price_table.py) holding their precomputed prices.
+"""
+import dataclasses
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from server.api.metrics import timed
+from server.api.price_table import PriceTable
+from server.api.rules import RuleSet, compile_rules, is_rule_set
+
+
+@dataclass(frozen=True, eq=False)
+class PricingPlan:
+    """Immutable pricing plan compiled from PricingParams
+
+    Attributes:
+        base_prices (Mapping): coverage type -> base price
+        additive (Mapping): extra name -> value added to the price
+        multipliers (Mapping): extra name -> multiplier, in the order of the params extras
+        tax (float): tax rate applied to the subtotal
+        table (PriceTable): precomputed prices, None unless built with with_table
+        rules (RuleSet): compiled rules of params in the rule format, then additive and
+            multipliers are empty
+    """
+
+    base_prices: MappingProxyType
+    additive: MappingProxyType
+    multipliers: MappingProxyType
+    tax: float
+    table: PriceTable = field(default=None, repr=False)
+    rules: RuleSet = field(default=None, repr=False)
+
+    @classmethod
+    def compile(cls, pricing_params) -> "PricingPlan":
+        """Builds the plan from a PricingParams (or anything with the same attributes)
+
+        Args:
+            pricing_params (PricingParams): The pricing params we want to compile
+
+        Returns:
+            PricingPlan: the compiled plan
+        """
+        if is_rule_set(pricing_params.extras):
+            return cls(
+                base_prices=MappingProxyType(dict(pricing_params.coverage_type_prices)),
+                additive=MappingProxyType({}),
+                multipliers=MappingProxyType({}),
+                tax=pricing_params.tax,
+                rules=compile_rules(pricing_params.extras),
+            )
+        # same semantics as looking the extra up by name: the last extra with a name wins
+        values = {extra["name"]: extra["value"] for extra in pricing_params.extras}
+        additive = {}
+        multipliers = {}
+        for extra in pricing_params.extras:
+            if extra["type"] == "add":
+                additive[extra["name"]] = values[extra["name"]]
+            elif extra["type"] == "multiply":
+                multipliers[extra["name"]] = values[extra["name"]]
+        return cls(
+            base_prices=MappingProxyType(dict(pricing_params.coverage_type_prices)),
+            additive=MappingProxyType(additive),
+            multipliers=MappingProxyType(multipliers),
+            tax=pricing_params.tax,
+        )
+
+    def with_table(self) -> "PricingPlan":
+        """Returns a copy of the plan pricing from a PriceTable built now"""
+        plan = dataclasses.replace(self, table=None)
+        object.__setattr__(plan, "table", PriceTable(plan))
+        return plan
+
+    @property
+    def priced_names(self) -> tuple:
+        """The quote extras the price depends on, additive first then the multipliers"""
+        if self.rules is not None:
+            return self.rules.names
+        return tuple(dict.fromkeys([*self.additive, *self.multipliers]))
+
+    def subtotal(self, coverage_type, extras) -> float:
+        """Calculates the untruncated subtotal, all additive extras first then the multipliers
+        (then the caps and floors of a rule set)
+
+        Args:
+            coverage_type (CoverageType | str): coverage type of the quote
+            extras (list): quote extras ({"name": ..., "value": bool})
+
+        Returns:
+            float: the subtotal
+        """
+        amount = self.base_prices[coverage_type]
+        if self.rules is not None:
+            return self.rules.subtotal(amount, coverage_type, extras)
+        additive = self.additive
+        multipliers = self.multipliers
+        quote_multipliers = []
+        for extra in extras:
+            if not extra["value"]:
+                continue
+            name = extra["name"]
+            if name in additive:
+                amount += additive[name]
+            if name in multipliers:
+                quote_multipliers.append(multipliers[name])
+        for val in quote_multipliers:
+            amount *= 1 + val
+        return amount
+
+    @timed("pricing_duration_seconds")
+    def price(self, coverage_type, extras) -> dict:
+        """Prices a quote
+
+        Args:
+            coverage_type (CoverageType | str): coverage type of the quote
+            extras (list): quote extras ({"name": ..., "value": bool})
+
+        Returns:
+            dict: With pricing (monthly_subtotal, monthly_tax ,monthly_total)
+        """
+        if self.table is not None:
+            price = self.table.lookup(coverage_type, extras)
+            if price is not None:
+                return price
+        return self.finalize(self.subtotal(coverage_type, extras))
+
+    def finalize(self, amount) -> dict:
+        """Applies tax and truncation to an untruncated subtotal
+
+        Args:
+            amount (float): untruncated subtotal
+
+        Returns:
+            dict: With pricing (monthly_subtotal, monthly_tax ,monthly_total)
+        """
+        result = {
+            "monthly_subtotal": format_float(amount),
+            "monthly_tax": format_float(amount * self.tax),
+        }
+        result["monthly_total"] = round(
+            result["monthly_subtotal"] + result["monthly_tax"], 2
+        )
+        return result
+
+
+def format_float(float_val, digits=2) -> float:
+    """This helper is needed so that we can truncate floats to two decimal places. We dont want to use
+    the round method because based on the example Quote 1, the monthly taxes are $0.408 which
+    rounds to $0.41 and the solution says it should be $0.40 therefore truncating not rounding
+
+    Args:
+        float_val (float): Float we want to perform this operation on
+        digits (int, optional): Determines the number of numbers after the decimal. Defaults to 2.
+
+    Returns:
+        float: floast truncated after 2 decimal places
+    """
+    fnum = str(float_val)
+    return float(fnum[: fnum.find(".") + digits + 1])
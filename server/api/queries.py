@@ -0,0 +1,103 @@
+""" Shared Quote filters used by the listing and export endpoints.
+
+Every filter is written so it can be answered from the indexes declared on Quote:
+state/coverage_type equality, a created_at range, a lastname prefix (as a range) and an
+enabled extra (a bitwise test on extras_mask).
+"""
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import tuple_
+from server.api.cache import pricing_cache
+from server.api.extras_mask import has_extra
+from server.database.models import Quote, State, CoverageType
+
+
+def parse_quote_filters(args) -> (dict, str):
+    """Parses the Quote filters from request args or CLI options
+
+    Args:
+        args (dict): state, coverage_type, lastname (prefix), created_from and created_to (ISO 8601)
+            and extra (name of an enabled extra)
+
+    Returns:
+        dict: filters to pass to apply_quote_filters
+        str: If the filters are not valid, it returns the error str
+    """
+    filters = {}
+    if args.get("state"):
+        if args["state"] not in {state.value for state in State}:
+            return None, "invalid state"
+        filters["state"] = State(args["state"])
+    if args.get("coverage_type"):
+        if args["coverage_type"] not in {c.value for c in CoverageType}:
+            return None, "invalid coverage_type"
+        filters["coverage_type"] = CoverageType(args["coverage_type"])
+    if args.get("lastname"):
+        filters["lastname"] = args["lastname"]
+    if args.get("extra"):
+        filters["extra"] = args["extra"]
+    for key in ("created_from", "created_to"):
+        if args.get(key):
+            try:
+                filters[key] = datetime.fromisoformat(args[key])
+            except ValueError:
+                return None, f"{key} should be an ISO 8601 datetime"
+    return filters, None
+
+
+def apply_quote_filters(stmt, filters: dict):
+    """Adds the WHERE clauses of the filters parsed by parse_quote_filters to a select"""
+    if "state" in filters:
+        stmt = stmt.where(Quote.state == filters["state"])
+    if "coverage_type" in filters:
+        stmt = stmt.where(Quote.coverage_type == filters["coverage_type"])
+    if "lastname" in filters:
+        prefix = filters["lastname"]
+        # the range lets the database use the lastname index, LIKE keeps it case sensitive
+        stmt = stmt.where(
+            Quote.lastname >= prefix,
+            Quote.lastname < prefix[:-1] + chr(ord(prefix[-1]) + 1),
+            Quote.lastname.startswith(prefix, autoescape=True),
+        )
+    if "extra" in filters:
+        # bitwise test on the extras_mask, with the bit of the extra in each state
+        states = [filters["state"]] if "state" in filters else list(State)
+        stmt = stmt.where(has_extra(filters["extra"], pricing_cache.get_many(states)))
+    if "created_from" in filters:
+        stmt = stmt.where(Quote.created_at >= filters["created_from"])
+    if "created_to" in filters:
+        stmt = stmt.where(Quote.created_at < filters["created_to"])
+    return stmt
+
+
+def apply_keyset(stmt, cursor: str, limit: int):
+    """Orders by (created_at, id) and starts after the cursor, instead of using OFFSET
+
+    Args:
+        stmt (Select): select on Quote
+        cursor (str): opaque cursor returned by encode_cursor, None for the first page
+        limit (int): page size, one extra row is fetched to know if there is a next page
+
+    Returns:
+        Select: the paginated select
+    """
+    if cursor:
+        created_at, quote_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(Quote.created_at, Quote.id) > (created_at, quote_id))
+    return stmt.order_by(Quote.created_at, Quote.id).limit(limit + 1)
+
+
+def encode_cursor(quote: Quote) -> str:
+    """Encodes the (created_at, id) position of the last quote of a page"""
+    raw = json.dumps([quote.created_at.isoformat(), quote.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> (datetime, int):
+    """Decodes a cursor made by encode_cursor, raises ValueError if it is not valid"""
+    try:
+        created_at, quote_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(quote_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid cursor") from e
@@ -0,0 +1,266 @@
+""" Background repricing of the materialized quote prices.
+
+Quote stores the price it was last priced at together with the PricingParams version it
+was priced under. When the params of a state change, the stored prices of that state are
+recomputed in chunks by a thread pool, and GET /api/quote/price serves the stored price as
+long as it was priced under the current version.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from flask import Flask, current_app
+from sqlalchemy import DateTime, Integer, bindparam, func, or_, select, text
+from server.api.db import db
+from server.api.cache import pricing_cache
+from server.api.extras_mask import extras_mask
+from server.api.rollups import RollupDeltas, apply_rollup_deltas
+from server.database.models import Quote, State
+
+
+# reprices a chunk of quotes (JSON array of {"quote_id", "read_updated_at", "subtotal", "tax",
+# "total", "mask"}) in one statement, a quote written since it was read (e.g. by add_extra, which
+# moved its rollups) is skipped and RETURNING tells which quotes were repriced
+_REPRICE_CHUNK = {
+    "sqlite": """
+        UPDATE quote SET
+            monthly_subtotal = json_extract(v.value, '$.subtotal'),
+            monthly_tax = json_extract(v.value, '$.tax'),
+            monthly_total = json_extract(v.value, '$.total'),
+            extras_mask = json_extract(v.value, '$.mask'),
+            pricing_params_version = :version,
+            updated_at = :updated_at
+        FROM json_each(:rows) AS v
+        WHERE quote.id = json_extract(v.value, '$.quote_id')
+            AND quote.updated_at IS json_extract(v.value, '$.read_updated_at')
+            AND (quote.pricing_params_version IS NULL OR quote.pricing_params_version != :version)
+        RETURNING quote.id
+    """,
+    "postgresql": """
+        UPDATE quote SET
+            monthly_subtotal = v.subtotal,
+            monthly_tax = v.tax,
+            monthly_total = v.total,
+            extras_mask = v.mask,
+            pricing_params_version = :version,
+            updated_at = :updated_at
+        FROM jsonb_to_recordset(CAST(:rows AS jsonb)) AS v(
+            quote_id integer, read_updated_at timestamp, subtotal float, tax float, total float,
+            mask bigint
+        )
+        WHERE quote.id = v.quote_id
+            AND quote.updated_at IS NOT DISTINCT FROM v.read_updated_at
+            AND (quote.pricing_params_version IS NULL OR quote.pricing_params_version != :version)
+        RETURNING quote.id
+    """,
+}
+
+
+def stored_price(quote: Quote, pricing_params) -> dict:
+    """Returns the materialized price of a quote if it was priced under the current params version
+
+    Args:
+        quote (Quote): the quote
+        pricing_params (PricingSnapshot): current params of the quote state
+
+    Returns:
+        dict: With pricing (id, monthly_subtotal, monthly_tax ,monthly_total), None if stale
+    """
+    if (
+        quote.pricing_params_version != pricing_params.version
+        or quote.monthly_total is None
+    ):
+        return None
+    return {
+        "id": quote.id,
+        "monthly_subtotal": quote.monthly_subtotal,
+        "monthly_tax": quote.monthly_tax,
+        "monthly_total": quote.monthly_total,
+    }
+
+
+def store_price(quote: Quote, pricing: dict, pricing_params):
+    """Materializes a price on a quote, it is saved on the next commit"""
+    quote.monthly_subtotal = pricing["monthly_subtotal"]
+    quote.monthly_tax = pricing["monthly_tax"]
+    quote.monthly_total = pricing["monthly_total"]
+    quote.pricing_params_version = pricing_params.version
+    quote.extras_mask = extras_mask(quote.extras, pricing_params.extra_bits)
+
+
+class _RepricerState:
+    """Per app executor and progress, kept in app.extensions"""
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.progress = {}
+        self.futures = {}
+
+
+class QuoteRepricer:
+    """Flask extension that reprices the stored quotes of a state after its params change.
+
+    REPRICING_WORKERS sets the size of the thread pool, 0 reprices inline in the request
+    that changed the params. REPRICING_CHUNK_SIZE quotes are repriced and committed at a time.
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("REPRICING_WORKERS", 2)
+        app.config.setdefault("REPRICING_CHUNK_SIZE", 1000)
+        app.extensions["quote_repricer"] = _RepricerState()
+
+    @property
+    def _state(self) -> _RepricerState:
+        return current_app.extensions["quote_repricer"]
+
+    def schedule(self, state):
+        """Schedules the repricing of all the quotes of a state with its current params
+
+        Args:
+            state (State | str): State enum or its value
+        """
+        state = State(state)
+        pricing = pricing_cache.get(state)
+        if pricing is None:
+            return
+        repricer = self._state
+        # the job only writes to its own progress, replaced here by the next job of the state
+        progress = {
+            "version": pricing.version,
+            "status": "pending",
+            "repriced": 0,
+            "total": None,
+            "started_at": None,
+            "finished_at": None,
+        }
+        with repricer.lock:
+            repricer.progress[state] = progress
+        app = current_app._get_current_object()
+        workers = int(app.config["REPRICING_WORKERS"])
+        if workers <= 0:
+            self._reprice(app, state, pricing.version, progress)
+            return
+        with repricer.lock:
+            if repricer.executor is None:
+                repricer.executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="repricer"
+                )
+            repricer.futures[state] = repricer.executor.submit(
+                self._reprice, app, state, pricing.version, progress
+            )
+
+    def progress(self) -> dict:
+        """Returns the repricing progress per state"""
+        repricer = self._state
+        with repricer.lock:
+            return {state.value: dict(p) for state, p in repricer.progress.items()}
+
+    def wait(self, timeout: float = None):
+        """Blocks until all the scheduled repricing is done"""
+        repricer = self._state
+        with repricer.lock:
+            futures = list(repricer.futures.values())
+        wait(futures, timeout=timeout)
+
+    def _reprice(self, app: Flask, state: State, version: int, progress: dict):
+        """Reprices the quotes of a state that were not priced under version, chunk by chunk"""
+        with app.app_context():
+            try:
+                self._reprice_chunks(state, version, progress)
+            except Exception:
+                db.session.rollback()
+                progress["status"] = "failed"
+                current_app.logger.exception("repricing of %s failed", state.value)
+
+    def _reprice_chunks(self, state: State, version: int, progress: dict):
+        """Reprices and commits REPRICING_CHUNK_SIZE quotes at a time, paginating on id"""
+        repricer = self._state
+        pricing = pricing_cache.get(state)
+        if pricing is None or pricing.version != version:
+            # a newer change was made, the job scheduled for it takes over
+            progress["status"] = "superseded"
+            return
+        is_stale = or_(
+            Quote.pricing_params_version.is_(None),
+            Quote.pricing_params_version != version,
+        )
+        progress["status"] = "running"
+        progress["started_at"] = time.time()
+        progress["total"] = db.session.scalar(
+            select(func.count(Quote.id)).where(Quote.state == state, is_stale)
+        )
+        dialect = db.session.get_bind().dialect
+        statement = text(_REPRICE_CHUNK.get(dialect.name, _REPRICE_CHUNK["sqlite"])).bindparams(
+            bindparam("version", type_=Integer),
+            bindparam("updated_at", type_=DateTime()),
+        )
+        # the read updated_at goes through the JSON document as the database stores it
+        updated_at_type = Quote.__table__.c.updated_at.type.dialect_impl(dialect)
+        to_db = updated_at_type.bind_processor(dialect) or datetime.isoformat
+        last_id = 0
+        while True:
+            if repricer.progress.get(state) is not progress:
+                progress["status"] = "superseded"
+                return
+            rows = db.session.execute(
+                select(
+                    Quote.id,
+                    Quote.coverage_type,
+                    Quote.extras,
+                    Quote.monthly_total,
+                    Quote.updated_at,
+                )
+                .where(Quote.state == state, is_stale, Quote.id > last_id)
+                .order_by(Quote.id)
+                .limit(int(current_app.config["REPRICING_CHUNK_SIZE"]))
+            ).all()
+            if not rows:
+                break
+            prices = {
+                row.id: pricing.plan.price(row.coverage_type, row.extras or [])
+                for row in rows
+            }
+            chunk = [
+                {
+                    "quote_id": row.id,
+                    "read_updated_at": row.updated_at and to_db(row.updated_at),
+                    "subtotal": prices[row.id]["monthly_subtotal"],
+                    "tax": prices[row.id]["monthly_tax"],
+                    "total": prices[row.id]["monthly_total"],
+                    "mask": extras_mask(row.extras, pricing.extra_bits),
+                }
+                for row in rows
+            ]
+            repriced = set(
+                db.session.scalars(
+                    statement,
+                    {
+                        "rows": json.dumps(chunk),
+                        "version": version,
+                        "updated_at": datetime.utcnow(),
+                    },
+                )
+            )
+            # the quotes keep their dimensions, only the totals move
+            deltas = RollupDeltas()
+            for row in rows:
+                if row.id not in repriced:
+                    continue
+                total = prices[row.id]["monthly_total"]
+                deltas.add(state, row.coverage_type, row.extras, row.monthly_total, -1)
+                deltas.add(state, row.coverage_type, row.extras, total)
+            apply_rollup_deltas(deltas)
+            db.session.commit()
+            last_id = rows[-1].id
+            progress["repriced"] += len(repriced)
+        progress["status"] = "done"
+        progress["finished_at"] = time.time()
+
+
+quote_repricer = QuoteRepricer()
@@ -0,0 +1,178 @@
+""" Incrementally maintained quote rollups.
+
+QuoteRollup holds, per (state, coverage_type, extra), the number of quotes and the sum of their
+stored monthly_total. Every write of a quote adds its contribution (and removes its previous one
+when it is updated) with an INSERT ... ON CONFLICT DO UPDATE of the deltas, in the same
+transaction as the quote, so the analytics read a few rows instead of scanning Quote.
+
+The extra dimension is the enabled extras of the quote JSON (each name once), which only change
+with the quote itself: repricing a state only moves the totals. rebuild_rollups recomputes
+everything from Quote and reports the drift of the maintained rows.
+
+The upsert write locks the rollup rows until the transaction commits, and every quote of a
+(state, coverage_type) moves the same (state, coverage_type, "") row: the quote writes of a
+state and coverage type are serialized on that row for the time between their upsert and their
+commit (the upsert is the last statement before the commit to keep it short). A batch upserts
+each row once, with the deltas of all its quotes.
+"""
+from collections import defaultdict
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from server.api.db import db
+from server.database.models import CoverageType, Quote, QuoteRollup, State
+
+# sums are compared to the cent when checking for drift
+DRIFT_TOLERANCE = 0.005
+
+
+class RollupDeltas:
+    """Changes to apply to QuoteRollup, (state, coverage_type, extra) -> [quotes, monthly_total]"""
+
+    def __init__(self):
+        self.rows = defaultdict(lambda: [0, 0.0])
+
+    def add(self, state, coverage_type, extras, monthly_total, sign: int = 1):
+        """Adds (sign=1) or removes (sign=-1) the contribution of a quote
+
+        Args:
+            state (State | str): quote state
+            coverage_type (CoverageType | str): quote coverage type
+            extras (list): quote extras ({"name": ..., "value": bool})
+            monthly_total (float): stored price of the quote, None counts as 0
+            sign (int, optional): 1 to add the quote, -1 to remove it. Defaults to 1.
+        """
+        key = (State(state), CoverageType(coverage_type))
+        total = (monthly_total or 0.0) * sign
+        for extra in ("", *enabled_extras(extras)):
+            row = self.rows[(*key, extra)]
+            row[0] += sign
+            row[1] += total
+
+    def params(self) -> list:
+        """Returns the non zero deltas as the parameters of the upsert, sorted by key so that
+        concurrent transactions lock the rollup rows in the same order (no deadlock)
+        """
+        return [
+            {
+                "state": state,
+                "coverage_type": coverage_type,
+                "extra": extra,
+                "quotes": quotes,
+                "monthly_total": monthly_total,
+            }
+            for (state, coverage_type, extra), (quotes, monthly_total) in sorted(
+                self.rows.items()
+            )
+            if quotes or monthly_total
+        ]
+
+
+def enabled_extras(extras: list) -> list:
+    """Returns the names of the enabled extras, each name once"""
+    return list(dict.fromkeys(extra["name"] for extra in extras or [] if extra["value"]))
+
+
+def upsert_statement(dialect: str):
+    """Returns the INSERT ... ON CONFLICT DO UPDATE adding deltas to QuoteRollup"""
+    table = QuoteRollup.__table__
+    statement = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.state, table.c.coverage_type, table.c.extra],
+        set_={
+            "quotes": table.c.quotes + statement.excluded.quotes,
+            "monthly_total": table.c.monthly_total + statement.excluded.monthly_total,
+        },
+    )
+
+
+def apply_rollup_deltas(deltas: RollupDeltas, session=None):
+    """Adds the deltas to QuoteRollup in the transaction of session (not committed)
+
+    Args:
+        deltas (RollupDeltas): changes to apply
+        session (Session, optional): Defaults to db.session.
+    """
+    session = session or db.session
+    params = deltas.params()
+    if params:
+        session.execute(upsert_statement(session.get_bind().dialect.name), params)
+
+
+async def apply_rollup_deltas_async(deltas: RollupDeltas, session):
+    """apply_rollup_deltas for an AsyncSession"""
+    params = deltas.params()
+    if params:
+        await session.execute(upsert_statement(session.bind.dialect.name), params)
+
+
+def read_rollups(state=None, coverage_type=None) -> list:
+    """Returns the rollup rows, optionally of one state and/or coverage type"""
+    stmt = select(QuoteRollup).order_by(
+        QuoteRollup.state, QuoteRollup.coverage_type, QuoteRollup.extra
+    )
+    if state is not None:
+        stmt = stmt.where(QuoteRollup.state == state)
+    if coverage_type is not None:
+        stmt = stmt.where(QuoteRollup.coverage_type == coverage_type)
+    return db.session.scalars(stmt).all()
+
+
+def compute_rollups(chunk_size: int = 1000) -> dict:
+    """Recomputes the rollups from Quote, streaming the quotes in chunks
+
+    Returns:
+        dict: (state, coverage_type, extra) -> [quotes, monthly_total]
+    """
+    deltas = RollupDeltas()
+    stmt = select(Quote.state, Quote.coverage_type, Quote.extras, Quote.monthly_total)
+    for row in db.session.execute(stmt.execution_options(yield_per=chunk_size)):
+        deltas.add(row.state, row.coverage_type, row.extras, row.monthly_total)
+    return dict(deltas.rows)
+
+
+def rebuild_rollups(check_only: bool = False) -> list:
+    """Recomputes the rollups from Quote and replaces the maintained ones
+
+    Args:
+        check_only (bool, optional): only report the drift. Defaults to False.
+
+    Returns:
+        list: the rows that drifted, with their maintained (actual) and recomputed (expected) values
+    """
+    expected = compute_rollups()
+    actual = {
+        (row.state, row.coverage_type, row.extra): [row.quotes, row.monthly_total]
+        for row in read_rollups()
+    }
+    drift = []
+    for key in sorted(expected.keys() | actual.keys()):
+        want = expected.get(key, [0, 0.0])
+        have = actual.get(key, [0, 0.0])
+        if want[0] != have[0] or abs(want[1] - have[1]) > DRIFT_TOLERANCE:
+            state, coverage_type, extra = key
+            drift.append(
+                {
+                    "state": state.value,
+                    "coverage_type": coverage_type.value,
+                    "extra": extra,
+                    "actual": {"quotes": have[0], "monthly_total": have[1]},
+                    "expected": {"quotes": want[0], "monthly_total": want[1]},
+                }
+            )
+    if not check_only:
+        db.session.execute(delete(QuoteRollup))
+        rows = [
+            {
+                "state": state,
+                "coverage_type": coverage_type,
+                "extra": extra,
+                "quotes": quotes,
+                "monthly_total": monthly_total,
+            }
+            for (state, coverage_type, extra), (quotes, monthly_total) in expected.items()
+            if quotes
+        ]
+        if rows:
+            db.session.execute(insert(QuoteRollup), rows)
+        db.session.commit()
+    return drift
@@ -1,12 +1,41 @@
 import os
 import json
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, Response, request, jsonify, abort, stream_with_context
+from sqlalchemy import select
 from server.api.db import db
+from server.api.conditional import conditional_response, make_etag
+from server.api.cache import pricing_cache
+from server.api.simulation import simulate_repricing
+from server.api.repricing import quote_repricer
+from server.api.params_io import import_params, iter_params_ndjson, read_params_records
+from server.api.params_updates import (
+    AmbiguousExtraError,
+    StaleVersionError,
+    update_coverage,
+    update_extras,
+)
 from server.database.models import PricingParams, State
-from server.api.helpers import validate_pricing_data, validate_extras
+from server.api.helpers import validate_pricing_data, validate_coverage_update, validate_extras
 
 pricing_params_blueprint = Blueprint("pricing_params", __name__)
 
+# what the conditional GET /get_all reads instead of the full rows
+VERSION_COLUMNS = (
+    PricingParams.id,
+    PricingParams.version,
+    PricingParams.created_at,
+    PricingParams.updated_at,
+)
+
+
+def versions_etag(versions: list) -> str:
+    """ETag of GET /get_all: every change bumps the version of the row"""
+    return make_etag(*sorted(f"{row.id}.{row.version}" for row in versions))
+
+
+def versions_last_modified(versions: list):
+    return max((row.updated_at or row.created_at for row in versions), default=None)
+
 
 @pricing_params_blueprint.route("/", methods=["GET", "POST"])
 def pricing():
@@ -34,6 +63,7 @@ def pricing():
             )
             db.session.add(new_pricing)
             db.session.commit()
+            pricing_cache.invalidate(new_pricing.state)
             return "Success", 201
         else:
             return f"Data formated incorrectly: {error}", 422
@@ -41,66 +71,143 @@ def pricing():
 
 @pricing_params_blueprint.route("/get_all", methods=["GET"])
 def get_all_pricing():
-    """Returns all PricingParams
+    """Returns all PricingParams, answers 304 to If-None-Match/If-Modified-Since when none of them
+    changed (checked on their versions only)
 
     Returns:
         Response
     """
     if request.method == "GET":
-        pricings = PricingParams.query.all()
-        return jsonify(pricings)
+        versions = db.session.execute(select(*VERSION_COLUMNS)).all()
+        return conditional_response(
+            versions_etag(versions),
+            versions_last_modified(versions),
+            lambda: jsonify(PricingParams.query.all()),
+        )
+
+
+@pricing_params_blueprint.route("/simulate", methods=["POST"])
+def simulate_pricing():
+    """Simulates the revenue impact of proposed PricingParams (same JSON as POST /) on all
+    the stored quotes of the state, nothing is saved
+
+    Returns:
+        Response with current, proposed and delta totals and the delta distribution
+    """
+    if request.method == "POST":
+        data = request.json
+        valid, error = validate_pricing_data(data)
+        if valid:
+            current = pricing_cache.get_or_404(data["state"])
+            proposed = PricingParams(
+                state=data["state"],
+                tax=data["tax"],
+                coverage_type_prices=data["coverage_type_prices"],
+                extras=data["extras"],
+            )
+            return jsonify(simulate_repricing(current, proposed))
+        else:
+            return f"Data formated incorrectly: {error}", 422
+
+
+@pricing_params_blueprint.route("/import", methods=["POST"])
+def import_pricing():
+    """Upserts many PricingParams at once from a JSON array or NDJSON body, in one transaction.
+    With dry_run=1 it only reports what would change
+
+    Returns:
+        Response with the created, updated and unchanged states, 422 with the errors of the
+        invalid records (then nothing is written)
+    """
+    if request.method == "POST":
+        records, parse_errors = read_params_records(request.stream)
+        dry_run = request.args.get("dry_run") in ("1", "true")
+        report = import_params(records, dry_run=dry_run, parse_errors=parse_errors)
+        return jsonify(report), 422 if report["errors"] else 200
+
+
+@pricing_params_blueprint.route("/export", methods=["GET"])
+def export_pricing():
+    """Streams all PricingParams as NDJSON, in the format of /import
+
+    Returns:
+        Streamed response
+    """
+    if request.method == "GET":
+        return Response(
+            stream_with_context(iter_params_ndjson()), mimetype="application/x-ndjson"
+        )
+
+
+@pricing_params_blueprint.route("/repricing_status", methods=["GET"])
+def get_repricing_status():
+    """Returns the progress of the background repricing of the stored quote prices, per state
+
+    Returns:
+        Response
+    """
+    if request.method == "GET":
+        return jsonify(quote_repricer.progress())
+
+
+@pricing_params_blueprint.route("/cache_stats", methods=["GET"])
+def get_cache_stats():
+    """Returns the PricingParams cache counters (hits, misses, stale, version_checks, size)
+
+    Returns:
+        Response
+    """
+    if request.method == "GET":
+        return jsonify(pricing_cache.stats())
 
 
 @pricing_params_blueprint.route("/add_or_update_coverage", methods=["POST"])
 def add_or_update_coverage():
-    """Adds or updates PricingParams coverage (coverage_type (basic, premium) and values)
+    """Adds or updates PricingParams coverage (coverage_type (basic, premium) and values).
+    With the version parameter the update only applies if the params are still at that version
 
     Returns:
         Response
     """
     if request.method == "POST":
         args = request.args
-        pricing = PricingParams.query.filter_by(
-            state=State[str(request.args.get("state")).upper()]
-        ).first_or_404()
+        state = State[str(args.get("state")).upper()]
         data = request.json
-        for k, v in data.items():
-            if k in pricing.coverage_type_prices:
-                pricing.coverage_type_prices[k] = v
-        db.session.commit()
+        valid, err = validate_coverage_update(data)
+        if not valid:
+            return f"Data formated incorrectly: {err}", 422
+        try:
+            update_coverage(state, data, args.get("version", type=int))
+        except StaleVersionError as error:
+            return f"Conflict: {error}", 409
+        pricing_cache.invalidate(state)
+        quote_repricer.schedule(state)
         return "Success", 200
 
 
 @pricing_params_blueprint.route("/add_or_update_extras", methods=["POST"])
 def add_or_update_extras():
-    """Adds or updates PricingParams extras
+    """Adds or updates PricingParams extras, one extra or a list of extras applied at once.
+    With the version parameter the update only applies if the params are still at that version
 
     Returns:
         Response
     """
     if request.method == "POST":
         args = request.args
-        pricing = PricingParams.query.filter_by(
-            state=State[str(request.args.get("state")).upper()]
-        ).first_or_404()
+        state = State[str(args.get("state")).upper()]
         data = request.json
-        valid, err = validate_extras([data])
-        extras = [extra["name"] for extra in pricing.extras]
+        extras = data if isinstance(data, list) else [data]
+        valid, err = validate_extras(extras)
         if valid:
-            # Here we update the extra
-            if data["name"] in extras:
-                # we iterate through the extras in PricingParams to find the one with the matching name
-                for extra in pricing.extras:
-                    if data["name"] == extra["name"]:
-                        if "type" in data:
-                            extra["type"] = data["type"]
-                        if "value" in data:
-                            extra["value"] = data["value"]
-                        break  # if the names match we then break because we found the one we need to update
-            # Here we add the extra because it is not in the list
-            else:
-                pricing.extras.append(data)
-            db.session.commit()
+            try:
+                update_extras(state, extras, args.get("version", type=int))
+            except StaleVersionError as error:
+                return f"Conflict: {error}", 409
+            except AmbiguousExtraError as error:
+                return f"Data formated incorrectly: {error}", 422
+            pricing_cache.invalidate(state)
+            quote_repricer.schedule(state)
             return "Success", 200
 
         else:
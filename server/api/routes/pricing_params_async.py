@@ -0,0 +1,63 @@
+""" Async versions of the pricing_params read endpoints and creation, used by create_async_app.
+The coverage/extras updates are rare admin calls and keep their sync views
+"""
+from flask import request, jsonify, abort
+from sqlalchemy import select
+from server.api.async_db import async_db
+from server.api.cache import pricing_cache
+from server.api.conditional import conditional_response, not_modified
+from server.api.routes.pricing_params import (
+    VERSION_COLUMNS,
+    versions_etag,
+    versions_last_modified,
+)
+from server.database.models import PricingParams
+from server.api.helpers import validate_pricing_data
+
+
+async def pricing():
+    """Async GET and POST methods for pricing params, see server.api.routes.pricing_params.pricing"""
+    async with async_db.session() as session:
+        if request.method == "GET":
+            pricing = await session.scalar(
+                select(PricingParams).where(PricingParams.id == request.args.get("id"))
+            )
+            if pricing is None:
+                abort(404)
+            return jsonify(pricing)
+
+        if request.method == "POST":
+            data = request.json
+            valid, error = validate_pricing_data(data)
+            if valid:
+                new_pricing = PricingParams(
+                    state=data["state"],
+                    tax=data["tax"],
+                    coverage_type_prices=data["coverage_type_prices"],
+                    extras=data["extras"],
+                )
+                session.add(new_pricing)
+                await session.commit()
+                pricing_cache.invalidate(new_pricing.state)
+                return "Success", 201
+            else:
+                return f"Data formated incorrectly: {error}", 422
+
+
+async def get_all_pricing():
+    """Async version of server.api.routes.pricing_params.get_all_pricing"""
+    async with async_db.session() as session:
+        versions = (await session.execute(select(*VERSION_COLUMNS))).all()
+        etag = versions_etag(versions)
+        last_modified = versions_last_modified(versions)
+        if not_modified(etag, last_modified):
+            return conditional_response(etag, last_modified, None)
+        pricings = (await session.scalars(select(PricingParams))).all()
+        return conditional_response(etag, last_modified, lambda: jsonify(pricings))
+
+
+# endpoint -> async view, replacing the sync views of the pricing_params blueprint
+ASYNC_VIEWS = {
+    "pricing_params.pricing": pricing,
+    "pricing_params.get_all_pricing": get_all_pricing,
+}
@@ -1,13 +1,62 @@
-import os
 import json
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, Response, request, jsonify, abort, current_app, g, stream_with_context
+from sqlalchemy import insert, select
+from sqlalchemy.orm.exc import StaleDataError
 from server.api.db import db
-from server.database.models import PricingParams, Quote, State
-from server.api.helpers import validate_quotes_data, calculate_pricing, validate_extra
+from server.api.cache import pricing_cache
+from server.api.export import iter_quotes_ndjson
+from server.api.repricing import stored_price, store_price
+from server.api.group_commit import quote_writer
+from server.api.extras_mask import extras_mask
+from server.api.conditional import conditional_response, make_etag
+from server.api.rollups import RollupDeltas, apply_rollup_deltas, read_rollups
+from server.api.idempotency import (
+    idempotency_keys,
+    parse_idempotency_key,
+    replay,
+    request_hash,
+    store_response,
+)
+from server.api.queries import (
+    parse_quote_filters,
+    apply_quote_filters,
+    apply_keyset,
+    encode_cursor,
+)
+from server.database.models import CoverageType, Quote, State
+from server.api.helpers import (
+    validate_quotes_data,
+    calculate_pricing,
+    parse_extra_changes,
+    apply_extra_changes,
+)
+from server.api.validation import QUOTE_VALIDATOR
 
 
 quotes_blueprint = Blueprint("quote", __name__)
 
+# the columns GET /api/quote/price needs when the stored price is current
+PRICE_COLUMNS = (
+    Quote.id,
+    Quote.state,
+    Quote.created_at,
+    Quote.updated_at,
+    Quote.monthly_subtotal,
+    Quote.monthly_tax,
+    Quote.monthly_total,
+    Quote.pricing_params_version,
+)
+
+
+def price_etag(pricing: dict) -> str:
+    """ETag of a quote price response"""
+    return make_etag(
+        pricing["id"],
+        pricing["monthly_subtotal"],
+        pricing["monthly_tax"],
+        pricing["monthly_total"],
+    )
+
 
 @quotes_blueprint.route("/", methods=["GET", "POST"])
 def quote():
@@ -25,63 +74,268 @@ def quote():
     if request.method == "POST":
         data = request.json
         valid, error = validate_quotes_data(data)
-        if valid:
-            state_pricing = PricingParams.query.filter_by(
-                state=State[str(data["state"]).upper()]
-            ).first_or_404()
+        key, key_error = parse_idempotency_key(request.headers)
+        if valid and key_error is None:
+            state_pricing = pricing_cache.get_or_404(data["state"])
+            if key is not None:
+                # a retry gets the response of the first request with this key
+                stored = idempotency_keys.claim(key, request_hash(data))
+                if stored is not None:
+                    return replay(stored)
+            extras = data.get("extras", [])
             quote = Quote(
                 firstname=data["firstname"],
                 lastname=data["lastname"],
                 state=data["state"],
                 coverage_type=data["coverage_type"],
-                extras=data["extras"],
+                extras=extras,
             )
+            pricing = state_pricing.plan.price(quote.coverage_type, quote.extras)
+            if current_app.config["GROUP_COMMIT"] and key is None:
+                # committed together with the quotes of the concurrent requests
+                quote_id = quote_writer.insert(
+                    {
+                        "firstname": data["firstname"],
+                        "lastname": data["lastname"],
+                        "state": State(data["state"]),
+                        "coverage_type": data["coverage_type"],
+                        "extras": extras,
+                        "extras_mask": extras_mask(extras, state_pricing.extra_bits),
+                        "pricing_params_version": state_pricing.version,
+                        **pricing,
+                    }
+                )
+                return jsonify({"id": quote_id, **pricing}), 201
+            store_price(quote, pricing, state_pricing)
             db.session.add(quote)
+            if key is not None:
+                # the response is committed with the quote
+                db.session.flush()
+                store_response(db.session, key, 201, {"id": quote.id, **pricing})
+            # last before the commit, the rollup row stays locked until then
+            deltas = RollupDeltas()
+            deltas.add(quote.state, quote.coverage_type, quote.extras, quote.monthly_total)
+            apply_rollup_deltas(deltas)
             db.session.commit()
-            pricing = calculate_pricing(quote, state_pricing)
-            return jsonify(pricing), 201
+            # stored with its response, the key has nothing left to release at teardown
+            g.pop("idempotency_key", None)
+            return jsonify({"id": quote.id, **pricing}), 201
 
         else:
+            return f"Data formated incorrectly: {error or key_error}", 422
+
+
+@quotes_blueprint.route("/batch", methods=["POST"])
+def quote_batch():
+    """POST function that creates many quotes at once with a JSON array as input.
+    Every quote is validated on its own (all its field errors are returned), the pricing params of all the states are loaded in
+    one query and the valid quotes are inserted with a single bulk insert and commit
+
+    Returns:
+        Response with a list (same order as the input) of pricing and quote id, or error, per quote
+    """
+    if request.method == "POST":
+        data = request.json
+        if not isinstance(data, list):
+            return "Data formated incorrectly: expected a list of quotes", 422
+        if len(data) > current_app.config["QUOTE_BATCH_MAX_SIZE"]:
+            return "Data formated incorrectly: too many quotes in batch", 422
+        results = [None] * len(data)
+        valid_items = []
+        for i, (item, errors) in enumerate(zip(data, QUOTE_VALIDATOR.validate_many(data))):
+            if not errors:
+                valid_items.append((i, item))
+            else:
+                error = next(iter(errors.values()))
+                results[i] = {
+                    "index": i,
+                    "error": f"Data formated incorrectly: {error}",
+                    "errors": errors,
+                }
+
+        pricings = pricing_cache.get_many(item["state"] for _, item in valid_items)
+        rows = []
+        priced_items = []
+        for i, item in valid_items:
+            state_pricing = pricings.get(State(item["state"]))
+            if state_pricing is None:
+                results[i] = {"index": i, "error": "pricing not found for state"}
+                continue
+            extras = item.get("extras", [])
+            pricing = state_pricing.plan.price(item["coverage_type"], extras)
+            priced_items.append((i, pricing))
+            rows.append(
+                {
+                    "firstname": item["firstname"],
+                    "lastname": item["lastname"],
+                    "state": State(item["state"]),
+                    "coverage_type": item["coverage_type"],
+                    "extras": extras,
+                    "extras_mask": extras_mask(extras, state_pricing.extra_bits),
+                    "pricing_params_version": state_pricing.version,
+                    **pricing,
+                }
+            )
+        if rows:
+            ids = db.session.scalars(
+                insert(Quote).returning(Quote.id, sort_by_parameter_order=True), rows
+            ).all()
+            deltas = RollupDeltas()
+            for row in rows:
+                deltas.add(row["state"], row["coverage_type"], row["extras"], row["monthly_total"])
+            apply_rollup_deltas(deltas)
+            db.session.commit()
+            for (i, pricing), quote_id in zip(priced_items, ids):
+                results[i] = {"index": i, "id": quote_id, **pricing}
+        return jsonify(results), 201 if rows else 422
+
+
+@quotes_blueprint.route("/list", methods=["GET"])
+def list_quotes():
+    """GET function that lists quotes ordered by creation, using keyset pagination.
+    Optional parameters: state, coverage_type, lastname (prefix), created_from and
+    created_to (ISO 8601), limit and the cursor returned by the previous page
+
+    Returns:
+        Response with the quotes and the next_cursor (null on the last page) as JSON
+    """
+    if request.method == "GET":
+        args = request.args
+        filters, error = parse_quote_filters(args)
+        if filters is None:
             return f"Data formated incorrectly: {error}", 422
+        limit = args.get("limit", 50, type=int)
+        if not 0 < limit <= current_app.config["QUOTE_LIST_MAX_LIMIT"]:
+            return "Data formated incorrectly: invalid limit", 422
+        try:
+            stmt = apply_keyset(
+                apply_quote_filters(select(Quote), filters), args.get("cursor"), limit
+            )
+        except ValueError as e:
+            return f"Data formated incorrectly: {e}", 422
+        quotes = db.session.scalars(stmt).all()
+        next_cursor = encode_cursor(quotes[limit - 1]) if len(quotes) > limit else None
+        return jsonify({"quotes": quotes[:limit], "next_cursor": next_cursor})
+
+
+@quotes_blueprint.route("/export", methods=["GET"])
+def export_quotes():
+    """GET function that streams all quotes with their pricing as NDJSON.
+    Optional parameters: state, coverage_type, lastname (prefix), created_from and
+    created_to (ISO 8601) and gzip=1
+
+    Returns:
+        Streamed response
+    """
+    if request.method == "GET":
+        args = request.args
+        filters, error = parse_quote_filters(args)
+        if filters is None:
+            return f"Data formated incorrectly: {error}", 422
+        compress = args.get("gzip") in ("1", "true")
+        response = Response(
+            stream_with_context(iter_quotes_ndjson(filters, compress=compress)),
+            mimetype="application/x-ndjson",
+        )
+        if compress:
+            response.headers["Content-Encoding"] = "gzip"
+        return response
 
 
 @quotes_blueprint.route("/price", methods=["GET"])
 def get_quote_price():
-    """GET function that calculates quote price for quote with id (parameter)
+    """GET function that calculates quote price for quote with id (parameter).
+    Answers 304 to If-None-Match/If-Modified-Since when the price did not change
 
     Returns:
         Response
     """
     if request.method == "GET":
         args = request.args
-        quote = Quote.query.filter_by(id=args.get("id")).first_or_404()
-        state_pricing = PricingParams.query.filter_by(state=quote.state).first_or_404()
-        pricing = calculate_pricing(quote, state_pricing)
-        return jsonify(pricing)
+        # only the stored price is read, the full quote is loaded when it has to be repriced
+        row = db.session.execute(
+            select(*PRICE_COLUMNS).where(Quote.id == args.get("id"))
+        ).first()
+        if row is None:
+            abort(404)
+        state_pricing = pricing_cache.get_or_404(row.state)
+        # the stored price is served while it was priced under the current params version
+        pricing = stored_price(row, state_pricing)
+        if pricing is None:
+            pricing = calculate_pricing(db.session.get(Quote, row.id), state_pricing)
+        return conditional_response(
+            price_etag(pricing),
+            max(row.updated_at or row.created_at, state_pricing.updated_at),
+            lambda: jsonify(pricing),
+            private=True,
+        )
 
 
 @quotes_blueprint.route("/add_extra_or_update", methods=["POST"])
 def add_extra():
-    """POST function that adds or updates extra to existing quote
+    """POST function that adds or updates extras of an existing quote, in one update. Accepts
+    one extra, a list of extras or {"extras": [...], "remove": [names]}
 
     Returns:
-        Response
+        Response with the new pricing (id, monthly_subtotal, monthly_tax ,monthly_total)
     """
     if request.method == "POST":
         args = request.args
         data = request.json
-        quote = Quote.query.filter_by(id=args.get("id")).first_or_404()
-        valid, err = validate_extra(data)
-        # we create a dictionary of extra name to its iindex to easily update JSON
-        extras = {extra["name"]: i for i, extra in enumerate(quote.extras)}
-        if valid:
-            # if we are updating an existing extra
-            if data["name"] in extras:
-                quote.extras[extras[data["name"]]] = data
-                # new extra
-            else:
-                quote.extras.append(data)
-            db.session.commit()
-            return "Success", 200
+        # locked until the commit, the update also checks the quote version (updated_at)
+        quote = Quote.query.filter_by(id=args.get("id")).with_for_update().first_or_404()
+        changes, removals, err = parse_extra_changes(data)
+        if err is None:
+            deltas = RollupDeltas()
+            deltas.add(quote.state, quote.coverage_type, quote.extras, quote.monthly_total, -1)
+            quote.extras = apply_extra_changes(quote.extras, changes, removals)
+            state_pricing = pricing_cache.get_or_404(quote.state)
+            pricing = calculate_pricing(quote, state_pricing)
+            store_price(quote, pricing, state_pricing)
+            deltas.add(quote.state, quote.coverage_type, quote.extras, quote.monthly_total)
+            try:
+                apply_rollup_deltas(deltas)
+                db.session.commit()
+            except StaleDataError:
+                db.session.rollback()
+                return f"Conflict: quote {args.get('id')} was updated concurrently, retry", 409
+            return jsonify(pricing), 200
         else:
             return f"Data formated incorrectly: {err}", 422
+
+
+@quotes_blueprint.route("/analytics", methods=["GET"])
+def quote_analytics():
+    """GET function that returns the quote count and expected monthly revenue per state and
+    coverage type, with the count and revenue of the quotes having each extra enabled.
+    Optional parameters: state and coverage_type. Read from the maintained rollups, not the quotes
+
+    Returns:
+        Response with a list of {state, coverage_type, quotes, monthly_total, extras} as JSON
+    """
+    if request.method == "GET":
+        args = request.args
+        filters = {}
+        for name, enum in (("state", State), ("coverage_type", CoverageType)):
+            if args.get(name) is not None:
+                try:
+                    filters[name] = enum(args[name])
+                except ValueError:
+                    return f"Data formated incorrectly: invalid {name}", 422
+        groups = {}
+        for row in read_rollups(**filters):
+            key = (row.state, row.coverage_type)
+            if key not in groups:
+                groups[key] = {
+                    "state": row.state.value,
+                    "coverage_type": row.coverage_type.value,
+                    "quotes": 0,
+                    "monthly_total": 0.0,
+                    "extras": {},
+                }
+            values = {"quotes": row.quotes, "monthly_total": round(row.monthly_total, 2)}
+            if row.extra:
+                groups[key]["extras"][row.extra] = values
+            else:
+                groups[key].update(values)
+        return jsonify(list(groups.values()))
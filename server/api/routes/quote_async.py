@@ -0,0 +1,144 @@
+""" Async versions of the hot quote endpoints, used by create_async_app.
+They share the models, validators, cache and pricing with server/api/routes/quote.py
+"""
+from flask import g, request, jsonify, abort
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+from server.api.async_db import async_db
+from server.api.cache import pricing_cache
+from server.api.repricing import stored_price, store_price
+from server.api.conditional import conditional_response
+from server.api.rollups import RollupDeltas, apply_rollup_deltas_async
+from server.api.idempotency import (
+    idempotency_keys,
+    parse_idempotency_key,
+    replay,
+    request_hash,
+    store_response,
+)
+from server.api.routes.quote import PRICE_COLUMNS, price_etag
+from server.database.models import Quote
+from server.api.helpers import (
+    validate_quotes_data,
+    calculate_pricing,
+    parse_extra_changes,
+    apply_extra_changes,
+)
+
+
+async def _get_quote_or_404(session, quote_id, for_update: bool = False) -> Quote:
+    stmt = select(Quote).where(Quote.id == quote_id)
+    if for_update:
+        stmt = stmt.with_for_update()
+    quote = await session.scalar(stmt)
+    if quote is None:
+        abort(404)
+    return quote
+
+
+async def _get_pricing_or_404(session, state):
+    state_pricing = await pricing_cache.get_async(state, session)
+    if state_pricing is None:
+        abort(404)
+    return state_pricing
+
+
+async def quote():
+    """Async GET and POST methods for quote, see server.api.routes.quote.quote"""
+    async with async_db.session() as session:
+        if request.method == "GET":
+            return jsonify(await _get_quote_or_404(session, request.args.get("id")))
+        if request.method == "POST":
+            data = request.json
+            valid, error = validate_quotes_data(data)
+            key, key_error = parse_idempotency_key(request.headers)
+            if valid and key_error is None:
+                state_pricing = await _get_pricing_or_404(session, data["state"])
+                if key is not None:
+                    stored = await idempotency_keys.claim_async(session, key, request_hash(data))
+                    if stored is not None:
+                        return replay(stored)
+                quote = Quote(
+                    firstname=data["firstname"],
+                    lastname=data["lastname"],
+                    state=data["state"],
+                    coverage_type=data["coverage_type"],
+                    extras=data.get("extras", []),
+                )
+                pricing = state_pricing.plan.price(quote.coverage_type, quote.extras)
+                store_price(quote, pricing, state_pricing)
+                session.add(quote)
+                if key is not None:
+                    await session.flush()
+                    await session.run_sync(
+                        store_response, key, 201, {"id": quote.id, **pricing}
+                    )
+                # last before the commit, the rollup row stays locked until then
+                deltas = RollupDeltas()
+                deltas.add(quote.state, quote.coverage_type, quote.extras, quote.monthly_total)
+                await apply_rollup_deltas_async(deltas, session)
+                await session.commit()
+                # stored with its response, the key has nothing left to release at teardown
+                g.pop("idempotency_key", None)
+                return jsonify({"id": quote.id, **pricing}), 201
+            else:
+                return f"Data formated incorrectly: {error or key_error}", 422
+
+
+async def get_quote_price():
+    """Async GET function that calculates quote price, see server.api.routes.quote.get_quote_price"""
+    async with async_db.session() as session:
+        row = (
+            await session.execute(
+                select(*PRICE_COLUMNS).where(Quote.id == request.args.get("id"))
+            )
+        ).first()
+        if row is None:
+            abort(404)
+        state_pricing = await _get_pricing_or_404(session, row.state)
+        pricing = stored_price(row, state_pricing)
+        if pricing is None:
+            quote = await _get_quote_or_404(session, row.id)
+            pricing = calculate_pricing(quote, state_pricing)
+        return conditional_response(
+            price_etag(pricing),
+            max(row.updated_at or row.created_at, state_pricing.updated_at),
+            lambda: jsonify(pricing),
+            private=True,
+        )
+
+
+async def add_extra():
+    """Async POST function that adds or updates extras of an existing quote, see
+    server.api.routes.quote.add_extra
+    """
+    async with async_db.session() as session:
+        data = request.json
+        quote_id = request.args.get("id")
+        quote = await _get_quote_or_404(session, quote_id, for_update=True)
+        changes, removals, err = parse_extra_changes(data)
+        if err is None:
+            deltas = RollupDeltas()
+            deltas.add(quote.state, quote.coverage_type, quote.extras, quote.monthly_total, -1)
+            quote.extras = apply_extra_changes(quote.extras, changes, removals)
+            state_pricing = await _get_pricing_or_404(session, quote.state)
+            pricing = calculate_pricing(quote, state_pricing)
+            store_price(quote, pricing, state_pricing)
+            deltas.add(quote.state, quote.coverage_type, quote.extras, quote.monthly_total)
+            try:
+                await apply_rollup_deltas_async(deltas, session)
+                await session.commit()
+            except StaleDataError:
+                await session.rollback()
+                return f"Conflict: quote {quote_id} was updated concurrently, retry", 409
+            return jsonify(pricing), 200
+        else:
+            return f"Data formated incorrectly: {err}", 422
+
+
+# endpoint -> async view, replacing the sync views of the quote blueprint
+ASYNC_VIEWS = {
+    "quote.quote": quote,
+    "quote.get_quote_price": get_quote_price,
+    "quote.add_extra": add_extra,
+}
@@ -0,0 +1,185 @@
+""" Pricing rules: the PricingParams.extras format beyond plain add/multiply extras.
+
+Every entry of PricingParams.extras is a rule with a name, a type and a value. The plain
+{"name", "type": "add" | "multiply", "value"} extras keep their meaning, these optional keys
+make them conditional, tiered or bounded:
+
+    coverage_types  the rule only applies to these coverage types, e.g. ["premium"]
+    requires        the rule only applies when these quote extras are enabled too
+    excludes        the rule doesn't apply when one of these quote extras is enabled
+    tiers           [{"above": 50, "value": 0.05}, ...] ascending, the value of the last tier
+                    the running subtotal is above replaces value
+    min, max        bounds of the amount an add or multiply rule adds to the subtotal
+
+and two types of rules that don't depend on a quote extra (their name only identifies them):
+
+    cap             the subtotal is at most value
+    floor           the subtotal is at least value
+
+A quote is priced in three passes: the add rules of its enabled extras (in quote order), then
+their multiply rules (in quote order), then the caps and floors (in params order). Several rules
+can share a name, e.g. a flood add on basic and a flood multiply on premium. add_or_update_extras
+tells them apart by type and coverage_types (see server/api/params_updates.match_extra).
+
+compile_rules turns the rules into closures once per PricingParams version (the PricingPlan of
+the cache), so pricing a quote never walks the JSON. Params without any of these keys or types
+are priced by PricingPlan exactly as before.
+"""
+import bisect
+from dataclasses import dataclass
+from types import MappingProxyType
+
+# rule types that apply to the subtotal instead of a quote extra
+BOUND_TYPES = frozenset({"cap", "floor"})
+# keys that make an add/multiply extra a rule
+RULE_KEYS = frozenset({"coverage_types", "requires", "excludes", "tiers", "min", "max"})
+
+
+def is_rule_set(extras: list) -> bool:
+    """Returns True when the extras use the rule format, False for plain add/multiply extras"""
+    return any(extra["type"] in BOUND_TYPES or not RULE_KEYS.isdisjoint(extra) for extra in extras)
+
+
+@dataclass(frozen=True, eq=False)
+class RuleSet:
+    """Rules of a state compiled into closures
+
+    Attributes:
+        add (Mapping): extra name -> ((applies, step), ...) of its add rules
+        multiply (Mapping): extra name -> ((applies, step), ...) of its multiply rules
+        bounds (tuple): (applies, step) of the caps and floors, in params order
+        names (tuple): the quote extras the price depends on, add rules first then multiply rules
+            then the extras only used in conditions, in params order
+        conditional (bool): some rule depends on the other enabled extras
+    """
+
+    add: MappingProxyType
+    multiply: MappingProxyType
+    bounds: tuple
+    names: tuple
+    conditional: bool
+
+    def subtotal(self, amount: float, coverage_type, extras) -> float:
+        """Applies the rules to the base price of a quote
+
+        Args:
+            amount (float): base price of the coverage type
+            coverage_type (CoverageType | str): coverage type of the quote
+            extras (list): quote extras ({"name": ..., "value": bool})
+
+        Returns:
+            float: the untruncated subtotal
+        """
+        enabled = [extra["name"] for extra in extras if extra["value"]]
+        enabled_set = frozenset(enabled) if self.conditional else None
+        for rules in (self.add, self.multiply):
+            for name in enabled:
+                for applies, step in rules.get(name, ()):
+                    if applies is None or applies(coverage_type, enabled_set):
+                        amount = step(amount)
+        for applies, step in self.bounds:
+            if applies is None or applies(coverage_type, enabled_set):
+                amount = step(amount)
+        return amount
+
+
+def compile_rules(extras: list) -> RuleSet:
+    """Compiles validated rules (see the module docstring)
+
+    Args:
+        extras (list): PricingParams extras
+
+    Returns:
+        RuleSet: the compiled rules
+    """
+    add, multiply, bounds = {}, {}, []
+    conditions = []
+    conditional = False
+    for rule in extras:
+        applies = _condition(rule)
+        step = _step(rule)
+        if rule["type"] in BOUND_TYPES:
+            bounds.append((applies, step))
+        else:
+            rules = add if rule["type"] == "add" else multiply
+            rules.setdefault(rule["name"], []).append((applies, step))
+        conditions += [*rule.get("requires", ()), *rule.get("excludes", ())]
+        conditional = conditional or bool(rule.get("requires") or rule.get("excludes"))
+    return RuleSet(
+        add=MappingProxyType({name: tuple(rules) for name, rules in add.items()}),
+        multiply=MappingProxyType({name: tuple(rules) for name, rules in multiply.items()}),
+        bounds=tuple(bounds),
+        names=tuple(dict.fromkeys([*add, *multiply, *conditions])),
+        conditional=conditional,
+    )
+
+
+def _condition(rule: dict):
+    """Returns the predicate (coverage_type, enabled extras) of a rule, None if it always applies"""
+    coverage_types = frozenset(rule.get("coverage_types", ()))
+    requires = frozenset(rule.get("requires", ()))
+    excludes = frozenset(rule.get("excludes", ()))
+    if requires or excludes:
+
+        def applies(coverage_type, enabled):
+            return (
+                (not coverage_types or coverage_type in coverage_types)
+                and requires <= enabled
+                and excludes.isdisjoint(enabled)
+            )
+
+        return applies
+    if coverage_types:
+        return lambda coverage_type, enabled: coverage_type in coverage_types
+    return None
+
+
+def _step(rule: dict):
+    """Returns the closure applying a rule to the running subtotal"""
+    kind = rule["type"]
+    value = float(rule["value"])
+    low = None if rule.get("min") is None else float(rule["min"])
+    high = None if rule.get("max") is None else float(rule["max"])
+    tiers = rule.get("tiers")
+
+    if tiers:
+        thresholds = [float(tier["above"]) for tier in tiers]
+        values = [value, *(float(tier["value"]) for tier in tiers)]
+
+        def value_of(amount):
+            # the number of thresholds strictly below amount is the index of its value
+            return values[bisect.bisect_left(thresholds, amount)]
+
+    else:
+        value_of = None
+
+    if kind == "cap":
+        if value_of is None:
+            return lambda amount: min(amount, value)
+        return lambda amount: min(amount, value_of(amount))
+    if kind == "floor":
+        if value_of is None:
+            return lambda amount: max(amount, value)
+        return lambda amount: max(amount, value_of(amount))
+
+    if low is None and high is None:
+        # same float operations as PricingPlan.subtotal
+        if kind == "add":
+            if value_of is None:
+                return lambda amount: amount + value
+            return lambda amount: amount + value_of(amount)
+        if value_of is None:
+            factor = 1 + value
+            return lambda amount: amount * factor
+        return lambda amount: amount * (1 + value_of(amount))
+
+    def contribution(amount):
+        rate = value if value_of is None else value_of(amount)
+        added = rate if kind == "add" else amount * rate
+        if low is not None and added < low:
+            return low
+        if high is not None and added > high:
+            return high
+        return added
+
+    return lambda amount: amount + contribution(amount)
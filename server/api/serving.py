@@ -0,0 +1,181 @@
+""" Production serving: a preforking gunicorn server with warmed up workers.
+
+`python app.py serve` loads the app once in the master process (preload), fills the pricing
+cache there, disposes of the database connections and freezes the heap before forking, so the
+workers share the imported code, the compiled pricing plans and their price tables copy on
+write. Each worker then opens its connection pool and refreshes the pricing of every State
+before it accepts connections, so the first requests don't pay for them.
+
+Every worker reports the time from the creation of the app to its first response as the
+cold_start_seconds histogram of /metrics and in its log.
+"""
+import gc
+import os
+import threading
+import time
+from flask import Flask, current_app
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from server.api.db import db
+from server.api.cache import pricing_cache
+from server.api.metrics import registry
+from server.database.models import State
+
+
+class _WarmupState:
+    """Per app start time and first response, kept in app.extensions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created_at = time.time()
+        self.warmup_seconds = None
+        self.first_response_pid = None
+
+
+class Warmup:
+    """Flask extension warming up a worker (connection pool, pricing cache) and reporting the
+    cold start of each process, from the creation of the app to its first response.
+
+    WARMUP_CONNECTIONS sets the connections opened by the warmup, by default the pool size.
+    """
+
+    def __init__(self, app: Flask = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("WARMUP_CONNECTIONS", None)
+        app.extensions["warmup"] = _WarmupState()
+        app.after_request(self._after_request)
+
+    def warm_up(self, app: Flask) -> float:
+        """Opens the connection pools and loads the pricing params of every State
+
+        Args:
+            app (Flask): the app of this process
+
+        Returns:
+            float: seconds spent
+        """
+        start = time.perf_counter()
+        with app.app_context():
+            engines = [db.engine]
+            if "db_replica" in app.extensions:
+                engines.append(app.extensions["db_replica"])
+            for engine in engines:
+                open_connections(engine, app.config["WARMUP_CONNECTIONS"])
+            pricing_cache.get_many(list(State))
+        seconds = time.perf_counter() - start
+        app.extensions["warmup"].warmup_seconds = seconds
+        return seconds
+
+    def after_fork(self, app: Flask) -> float:
+        """Starts a worker process forked from the preloaded master: its cold start and metrics
+        begin now, the connections of the master are left to it, then the worker warms up
+
+        Args:
+            app (Flask): the app, preloaded in the master
+
+        Returns:
+            float: seconds spent in the warmup
+        """
+        app.extensions["warmup"].created_at = time.time()
+        # the observations of the master (its warmup queries...) would be counted by every worker
+        registry.clear()
+        # connections opened before the fork must not be shared by the processes
+        with app.app_context():
+            db.engine.dispose(close=False)
+        if "db_replica" in app.extensions:
+            app.extensions["db_replica"].dispose(close=False)
+        return self.warm_up(app)
+
+    def _after_request(self, response):
+        state = current_app.extensions["warmup"]
+        pid = os.getpid()
+        if state.first_response_pid != pid:
+            with state.lock:
+                if state.first_response_pid != pid:
+                    state.first_response_pid = pid
+                    seconds = time.time() - state.created_at
+                    registry.observe("cold_start_seconds", seconds)
+                    current_app.logger.info(
+                        "process %d: first response %.3fs after start (warmup %ss)",
+                        pid,
+                        seconds,
+                        state.warmup_seconds and round(state.warmup_seconds, 3),
+                    )
+        return response
+
+
+def open_connections(engine: Engine, count: int = None):
+    """Opens count connections of the pool of engine (by default its size) and returns them to it
+
+    Args:
+        engine (Engine): the engine
+        count (int, optional): connections to open. Defaults to the pool size, 1 without one.
+    """
+    if count is None:
+        count = engine.pool.size() if hasattr(engine.pool, "size") else 1
+    connections = []
+    try:
+        for _ in range(count):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.execute(text("SELECT 1"))
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def serve(app: Flask, bind: str, workers: int, threads: int, timeout: int):
+    """Runs app with gunicorn, preloaded in the master and warmed up in every worker
+
+    Args:
+        app (Flask): the app, created in this (master) process
+        bind (str): host:port to listen on
+        workers (int): worker processes
+        threads (int): threads per worker
+        timeout (int): seconds a silent worker is given before it is restarted
+    """
+    # imported here, gunicorn only runs on unix and is only needed to serve
+    from gunicorn.app.base import BaseApplication
+
+    def post_fork(server, worker):
+        # the app logs (slow queries, cold start...) go to the gunicorn error log
+        app.logger.handlers = server.log.error_log.handlers
+        app.logger.setLevel(server.log.error_log.level)
+        try:
+            seconds = warmup.after_fork(app)
+            server.log.info("worker %d warmed up in %.3fs", worker.pid, seconds)
+        except Exception:
+            # the worker can still serve once the database is reachable
+            server.log.exception("warmup of worker %d failed", worker.pid)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for name, value in {
+                "bind": bind,
+                "workers": workers,
+                "threads": threads,
+                "timeout": timeout,
+                "preload_app": True,
+                "post_fork": post_fork,
+            }.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return app
+
+    with app.app_context():
+        # compiled once here and shared copy on write by the workers
+        pricing_cache.get_many(list(State))
+        db.engine.dispose()
+        if "db_replica" in app.extensions:
+            app.extensions["db_replica"].dispose()
+    # keeps the objects loaded so far out of the collections, which would otherwise touch (and
+    # copy) their pages in every worker
+    gc.freeze()
+    Application().run()
+
+
+warmup = Warmup()
@@ -0,0 +1,114 @@
+""" What-if repricing of the stored quotes of a state under proposed PricingParams.
+
+The database groups the quotes by (coverage_type, extras) so a state with millions of quotes
+comes back as a few hundred rows. Each group is then reduced to a pricing signature (coverage
+type and the enabled extras, in quote order) and priced once per plan, which gives exactly the
+result calculate_pricing would give for every quote in the group, format_float truncation included.
+"""
+import json
+import math
+from collections import Counter
+from sqlalchemy import Text, cast, func, select
+from server.api.db import db
+from server.api.pricing import PricingPlan
+from server.database.models import Quote, State
+
+
+def simulate_repricing(current_params, proposed_params) -> dict:
+    """Reprices every stored quote of a state with the current and the proposed params
+
+    Args:
+        current_params (PricingParams): params the quotes are priced with today
+        proposed_params (PricingParams): proposed params (or anything with the same attributes)
+
+    Returns:
+        dict: quote count, current/proposed/delta totals and the distribution of the per quote
+        monthly_total delta
+    """
+    current_plan = getattr(current_params, "plan", None) or PricingPlan.compile(
+        current_params
+    )
+    proposed_plan = PricingPlan.compile(proposed_params)
+    priced_names = {*current_plan.priced_names, *proposed_plan.priced_names}
+
+    # signature -> number of quotes
+    signatures = Counter()
+    extras_text = cast(Quote.extras, Text)
+    rows = db.session.execute(
+        select(Quote.coverage_type, extras_text, func.count())
+        .where(Quote.state == State(current_params.state))
+        .group_by(Quote.coverage_type, extras_text)
+    )
+    for coverage_type, extras, count in rows:
+        enabled = tuple(
+            extra["name"]
+            for extra in json.loads(extras or "[]")
+            if extra["value"] and extra["name"] in priced_names
+        )
+        signatures[(coverage_type.value, enabled)] += count
+
+    totals = {
+        "current": _empty_totals(),
+        "proposed": _empty_totals(),
+    }
+    deltas = Counter()
+    for (coverage_type, enabled), count in signatures.items():
+        extras = [{"name": name, "value": True} for name in enabled]
+        current = current_plan.price(coverage_type, extras)
+        proposed = proposed_plan.price(coverage_type, extras)
+        for key in current:
+            totals["current"][key] += current[key] * count
+            totals["proposed"][key] += proposed[key] * count
+        deltas[round(proposed["monthly_total"] - current["monthly_total"], 2)] += count
+
+    result = {
+        "state": State(current_params.state).value,
+        "quotes": sum(signatures.values()),
+        "current": {k: round(v, 2) for k, v in totals["current"].items()},
+        "proposed": {k: round(v, 2) for k, v in totals["proposed"].items()},
+    }
+    result["delta"] = {
+        k: round(result["proposed"][k] - result["current"][k], 2)
+        for k in result["current"]
+    }
+    result["distribution"] = _distribution(deltas)
+    return result
+
+
+def _empty_totals() -> dict:
+    return {"monthly_subtotal": 0.0, "monthly_tax": 0.0, "monthly_total": 0.0}
+
+
+def _distribution(deltas: Counter) -> dict:
+    """Summarizes the per quote monthly_total deltas
+
+    Args:
+        deltas (Counter): monthly_total delta -> number of quotes
+
+    Returns:
+        dict: min, max, percentiles and the count of quotes per delta value
+    """
+    ordered = sorted(deltas.items())
+    total = sum(deltas.values())
+    distribution = {
+        "min": ordered[0][0] if ordered else None,
+        "max": ordered[-1][0] if ordered else None,
+        "histogram": [
+            {"monthly_total_delta": delta, "quotes": count} for delta, count in ordered
+        ],
+    }
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        distribution[name] = _percentile(ordered, total, fraction)
+    return distribution
+
+
+def _percentile(ordered: list, total: int, fraction: float):
+    """Nearest rank percentile over (value, count) pairs sorted by value"""
+    if not total:
+        return None
+    rank = max(1, math.ceil(total * fraction))
+    seen = 0
+    for value, count in ordered:
+        seen += count
+        if seen >= rank:
+            return value
@@ -0,0 +1,292 @@
+""" Precompiled request validators.
+
+Each payload shape is described once with the small building blocks below and compiled at
+import into a Validator. The allowed State/CoverageType values are frozensets built once, and a
+Validator reports every field error at once as a dict of field path -> message (in the order the
+hand-written validators used to check them, so the first message is the one they returned).
+"""
+import typing as t
+from server.database.models import State, CoverageType
+
+# a check gets the value, its path and the errors dict to fill
+Check = t.Callable[[t.Any, str, dict], None]
+
+
+class Validator:
+    """A compiled validator for one payload shape"""
+
+    def __init__(self, check: Check):
+        self._check = check
+
+    def errors(self, data) -> dict:
+        """Returns all the errors of data
+
+        Args:
+            data (json): data needed to be validated
+
+        Returns:
+            dict: field path -> error message, empty if data is valid
+        """
+        errors = {}
+        self._check(data, "", errors)
+        return errors
+
+    def validate(self, data) -> (bool, str):
+        """Same contract as the hand-written validators in helpers
+
+        Returns:
+            bool: Returns True is data is valid else False
+            str: If data is not valid, it returns the (first) error str
+        """
+        errors = self.errors(data)
+        if errors:
+            return False, next(iter(errors.values()))
+        return True, None
+
+    def validate_many(self, items: list) -> list:
+        """Validates a batch of payloads, returns the errors dict of each item"""
+        return [self.errors(item) for item in items]
+
+
+def _join(path: str, name) -> str:
+    if isinstance(name, int):
+        return f"{path}[{name}]"
+    return f"{path}.{name}" if path else name
+
+
+def present(value, path: str, errors: dict):
+    """Any value is accepted, the field only has to be there"""
+
+
+def one_of(values, message: str) -> Check:
+    allowed = frozenset(values)
+
+    def check(value, path, errors):
+        try:
+            valid = value in allowed
+        except TypeError:  # unhashable values can't be in the set
+            valid = False
+        if not valid:
+            errors[path] = message
+
+    return check
+
+
+def number(message: str) -> Check:
+    def check(value, path, errors):
+        try:
+            float(value)
+        except (TypeError, ValueError):
+            errors[path] = message
+
+    return check
+
+
+def price(message: str) -> Check:
+    """A JSON number (not a numeric string) that is not negative"""
+
+    def check(value, path, errors):
+        if type(value) not in (int, float) or not value >= 0:
+            errors[path] = message
+
+    return check
+
+
+def boolean(message: str) -> Check:
+    def check(value, path, errors):
+        if type(value) != bool:
+            errors[path] = message
+
+    return check
+
+
+def flag(message: str) -> Check:
+    """A boolean, or a number used as one"""
+
+    def check(value, path, errors):
+        if type(value) not in (bool, int, float):
+            errors[path] = message
+
+    return check
+
+
+def exact_keys(keys, message: str, value_check: Check) -> Check:
+    """An object with exactly these keys, each value checked with value_check"""
+    expected = frozenset(keys)
+
+    def check(value, path, errors):
+        if not isinstance(value, dict) or value.keys() != expected:
+            errors[path] = message
+            return
+        for key, item in value.items():
+            value_check(item, _join(path, key), errors)
+
+    return check
+
+
+def some_keys(keys, message: str, value_check: Check) -> Check:
+    """An object with some of these keys, each value checked with value_check"""
+    allowed = frozenset(keys)
+
+    def check(value, path, errors):
+        if not isinstance(value, dict) or not value.keys() <= allowed:
+            errors[path] = message
+            return
+        for key, item in value.items():
+            value_check(item, _join(path, key), errors)
+
+    return check
+
+
+def list_of(item_check: Check, message: str) -> Check:
+    def check(value, path, errors):
+        if not isinstance(value, list):
+            errors[path] = message
+            return
+        for i, item in enumerate(value):
+            item_check(item, _join(path, i), errors)
+
+    return check
+
+
+def string(message: str) -> Check:
+    def check(value, path, errors):
+        if not isinstance(value, str):
+            errors[path] = message
+
+    return check
+
+
+def fields(
+    checks: t.Dict[str, Check],
+    missing: str,
+    not_object: str,
+    optional: t.Dict[str, Check] = None,
+) -> Check:
+    """An object with required fields, missing fields are reported before invalid ones.
+    The optional fields are checked when they are there, after the required ones
+    """
+    required = tuple(checks.items())
+    present_checks = required + tuple((optional or {}).items())
+
+    def check(value, path, errors):
+        if not isinstance(value, dict):
+            errors[path] = not_object
+            return
+        for name, _ in required:
+            if name not in value:
+                errors[_join(path, name)] = missing
+        for name, field_check in present_checks:
+            if name in value:
+                field_check(value[name], _join(path, name), errors)
+
+    return check
+
+
+def ascending_tiers(message: str) -> Check:
+    """A list of {"above": number, "value": number} with strictly ascending thresholds"""
+    tier = exact_keys(("above", "value"), message, number(message))
+
+    def check(value, path, errors):
+        if not isinstance(value, list) or not value:
+            errors[path] = message
+            return
+        count = len(errors)
+        for i, item in enumerate(value):
+            tier(item, _join(path, i), errors)
+        if len(errors) == count:
+            thresholds = [float(item["above"]) for item in value]
+            if any(a >= b for a, b in zip(thresholds, thresholds[1:])):
+                errors[path] = message
+
+    return check
+
+
+STATES = frozenset(state.value for state in State)
+COVERAGE_TYPES = frozenset(coverage_type.value for coverage_type in CoverageType)
+# cap and floor bound the subtotal, see server/api/rules.py for the rule keys
+EXTRA_TYPES = frozenset({"add", "multiply", "cap", "floor"})
+
+
+def _coverage_check(prefix: str) -> Check:
+    return exact_keys(
+        COVERAGE_TYPES, f"{prefix}[coverage_name]", number(f"{prefix}[value]")
+    )
+
+
+def _extras_check(prefix: str) -> Check:
+    extra = fields(
+        {
+            "name": present,
+            "type": one_of(EXTRA_TYPES, f"{prefix}[type]"),
+            "value": number(f"{prefix}[value]"),
+        },
+        missing=f"{prefix} key missing, ensure you have name, type, and value",
+        not_object=f"{prefix} key missing, ensure you have name, type, and value",
+        optional={
+            "coverage_types": list_of(
+                one_of(COVERAGE_TYPES, f"{prefix}[coverage_types]"), f"{prefix}[coverage_types]"
+            ),
+            "requires": list_of(string(f"{prefix}[requires]"), f"{prefix}[requires]"),
+            "excludes": list_of(string(f"{prefix}[excludes]"), f"{prefix}[excludes]"),
+            "tiers": ascending_tiers(f"{prefix}[tiers]"),
+            "min": number(f"{prefix}[min]"),
+            "max": number(f"{prefix}[max]"),
+        },
+    )
+    return list_of(extra, f"{prefix}[list]")
+
+
+PRICING_VALIDATOR = Validator(
+    fields(
+        {
+            "state": one_of(STATES, "invalid state"),
+            "coverage_type_prices": _coverage_check("coverage_type_prices"),
+            "extras": _extras_check("extras"),
+            "tax": number("tax should be a float"),
+        },
+        missing="missing pricing key",
+        not_object="pricing should be an object",
+    )
+)
+COVERAGE_VALIDATOR = Validator(_coverage_check(""))
+# add_or_update_coverage sets some of the prices, written to the JSON document as they are
+COVERAGE_UPDATE_VALIDATOR = Validator(
+    some_keys(COVERAGE_TYPES, "[coverage_name]", price("[value] should be a number >= 0"))
+)
+EXTRAS_VALIDATOR = Validator(_extras_check(""))
+EXTRA_VALIDATOR = Validator(
+    fields(
+        {
+            "name": present,
+            "value": boolean(" value is wrong format"),
+        },
+        missing=" key missing, ensure you have name, type, and value",
+        not_object=" key missing, ensure you have name, type, and value",
+    )
+)
+QUOTE_VALIDATOR = Validator(
+    fields(
+        {
+            "firstname": present,
+            "lastname": present,
+            "state": one_of(STATES, "invalid state"),
+            "coverage_type": one_of(COVERAGE_TYPES, "invalid coverage_type"),
+        },
+        missing="missing quote key",
+        not_object="quote should be an object",
+        optional={
+            "extras": list_of(
+                fields(
+                    {
+                        "name": string("extras[name] should be a string"),
+                        "value": flag("extras[value] should be a boolean"),
+                    },
+                    missing="extras key missing, ensure you have name and value",
+                    not_object="extras should be a list of objects",
+                ),
+                "extras should be a list",
+            ),
+        },
+    )
+)
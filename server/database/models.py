@@ -2,7 +2,7 @@ import enum
 import json
 from datetime import datetime
 from dataclasses import dataclass
-from sqlalchemy import Enum, Integer, String, Float, DateTime
+from sqlalchemy import JSON, BigInteger, Enum, Integer, String, Float, DateTime, Index
 from sqlalchemy_json import NestedMutableJson
 from server.api.db import db
 
@@ -27,7 +27,9 @@ class CoverageType(str, enum.Enum):
 
 @dataclass
 class Quote(db.Model):
-    """The Quote table has needed columns including the extras column that is used to calculate price"""
+    """The Quote table has needed columns including the extras column that is used to calculate price
+    The indexes match the filters of GET /api/quote/list, all ending with the (created_at, id) keyset
+    """
 
     id: int = db.Column(Integer, primary_key=True)
     created_at: datetime = db.Column(DateTime(), default=datetime.utcnow)
@@ -36,6 +38,35 @@ class Quote(db.Model):
     state: State = db.Column(Enum(State))
     coverage_type: CoverageType = db.Column(Enum(CoverageType))
     extras: json = db.Column(NestedMutableJson)
+    # materialized price and the PricingParams version it was priced under, these are not
+    # dataclass fields so they are not part of the quote JSON
+    monthly_subtotal = db.Column(Float)
+    monthly_tax = db.Column(Float)
+    monthly_total = db.Column(Float)
+    pricing_params_version = db.Column(Integer)
+    # bits of the enabled extras in the registry of the state (see server/api/extras_mask.py)
+    extras_mask = db.Column(BigInteger)
+    # Last-Modified of the quote price, not part of the quote JSON either. Also the version of
+    # the row: an ORM update of a quote changed since it was loaded raises StaleDataError
+    updated_at = db.Column(DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __mapper_args__ = {
+        "version_id_col": updated_at,
+        "version_id_generator": lambda version: datetime.utcnow(),
+    }
+    __table_args__ = (
+        Index("ix_quote_created_at_id", "created_at", "id"),
+        Index("ix_quote_state_created_at_id", "state", "created_at", "id"),
+        Index(
+            "ix_quote_state_coverage_type_created_at_id",
+            "state",
+            "coverage_type",
+            "created_at",
+            "id",
+        ),
+        Index("ix_quote_lastname_created_at_id", "lastname", "created_at", "id"),
+        Index("ix_quote_state_extras_mask", "state", "extras_mask"),
+    )
 
 
 @dataclass
@@ -48,3 +79,39 @@ class PricingParams(db.Model):
     tax: float = db.Column(Float)
     coverage_type_prices: json = db.Column(NestedMutableJson)
     extras: json = db.Column(NestedMutableJson)
+    # bumped by SQLAlchemy on every UPDATE, used to detect stale cached params
+    version: int = db.Column(Integer, nullable=False)
+    # Last-Modified of the params, not part of the params JSON
+    updated_at = db.Column(DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+@dataclass
+class QuoteRollup(db.Model):
+    """Quote count and expected monthly revenue (sum of the stored monthly_total) per state,
+    coverage type and enabled extra, extra is "" for the row counting all the quotes.
+    Maintained incrementally by the quote writes and the repricing (see server/api/rollups.py)
+    """
+
+    state: State = db.Column(Enum(State), primary_key=True)
+    coverage_type: CoverageType = db.Column(Enum(CoverageType), primary_key=True)
+    extra: str = db.Column(String, primary_key=True, default="")
+    quotes: int = db.Column(Integer, nullable=False, default=0)
+    monthly_total: float = db.Column(Float, nullable=False, default=0.0)
+
+
+@dataclass
+class IdempotencyKey(db.Model):
+    """Idempotency-Key of a POST /api/quote/ with the response it got, replayed to the retries
+    until expires_at. A key without a response is claimed by a request in progress
+    (see server/api/idempotency.py)
+    """
+
+    key: str = db.Column(String(255), primary_key=True)
+    # sha256 of the request body, a key can't be reused for another request
+    request_hash: str = db.Column(String(64), nullable=False)
+    status_code: int = db.Column(Integer)
+    response: json = db.Column(JSON)
+    created_at: datetime = db.Column(DateTime(), nullable=False)
+    expires_at: datetime = db.Column(DateTime(), nullable=False, index=True)
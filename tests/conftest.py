@@ -1,18 +1,36 @@
 import pytest
 import json
 from server.database.models import PricingParams
-from server.api.index import create_app
+from server.api.index import create_app, create_async_app
 from server.api.db import db
+from server.api.async_db import async_db
 from server.api.helpers import db_seed
 
 
-@pytest.fixture()
-def basic_app():
+def make_app(mode, tmp_path):
+    """Creates the app in sync or async mode, the async engine needs a database file"""
+    if mode == "async":
+        app = create_async_app(f"sqlite:///{tmp_path}/test.db")
+    else:
+        app = create_app("sqlite://")
+    # the in memory database is a single shared connection, so reprice inline
+    app.config["REPRICING_WORKERS"] = 0
+    return app
+
+
+def teardown_app(app):
+    if "async_db" in app.extensions:
+        async_db.dispose(app)
+
+
+@pytest.fixture(params=["sync", "async"])
+def basic_app(request, tmp_path):
     """This fixture is used for testing and it creates the app, the database"""
-    basic_app = create_app("sqlite://")
+    basic_app = make_app(request.param, tmp_path)
     with basic_app.app_context():
         db.create_all()
     yield basic_app
+    teardown_app(basic_app)
 
 
 @pytest.fixture()
@@ -21,14 +39,15 @@ def basic_client(basic_app):
     return basic_app.test_client()
 
 
-@pytest.fixture()
-def app():
+@pytest.fixture(params=["sync", "async"])
+def app(request, tmp_path):
     """This fixture is used for testing and it creates the app, the database and seeds it"""
-    app = create_app("sqlite://")
+    app = make_app(request.param, tmp_path)
     with app.app_context():
         db.create_all()
         db_seed(db)
     yield app
+    teardown_app(app)
 
 
 @pytest.fixture()
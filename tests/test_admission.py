@@ -0,0 +1,85 @@
+import threading
+import time
+import pytest
+from flask import g
+from sqlalchemy import select
+from server.api.admission import DeadlineExceeded, Limiter, admission_control
+from server.api.db import db
+from server.api.metrics import registry
+from server.database.models import PricingParams
+
+QUOTE = {
+    "firstname": "Name",
+    "lastname": "Lastname",
+    "state": "texas",
+    "coverage_type": "basic",
+    "extras": [],
+}
+
+
+def test_limiter_priority_and_shedding():
+    """test that reads are admitted before writes and take the place of queued writes"""
+    limiter = Limiter("quote", concurrency=1, queue=1, timeout=1, retry_after=1)
+    assert limiter.acquire(1, timeout=1) is None
+    results = {}
+
+    def acquire(name, priority):
+        results[name] = limiter.acquire(priority, timeout=2)
+
+    write = threading.Thread(target=acquire, args=("write", 1))
+    write.start()
+    while not limiter.waiters:
+        time.sleep(0.001)
+    read = threading.Thread(target=acquire, args=("read", 0))
+    read.start()
+    write.join()
+    # the queue is full: the queued write gives its place to the read
+    assert results == {"write": "shed"}
+    assert limiter.acquire(1, timeout=0.01) == "queue_full"
+    limiter.release()
+    read.join()
+    assert results["read"] is None
+    limiter.release()
+    assert limiter.active == 0
+
+
+def test_admission_rejects_over_limit(app, client):
+    """test that a request over the limit gets a fast 503 with Retry-After"""
+    app.config["ADMISSION_LIMITS"] = {"quote": {"concurrency": 1, "queue": 0, "retry_after": 2}}
+    registry.clear()
+    with app.test_request_context():
+        limiter = admission_control.limiter("quote.quote")
+    assert limiter.acquire(0, timeout=0) is None
+    response = client.post("/api/quote/", json=QUOTE)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+    # the other blueprints are not limited
+    assert client.get("/api/pricing_params/get_all").status_code == 200
+    limiter.release()
+    assert client.post("/api/quote/", json=QUOTE).status_code == 201
+    assert limiter.active == 0
+    counters = registry.snapshot()["counters"]
+    assert [value for name, labels, value in counters if name == "admission_rejected_total"] == [1]
+
+
+def test_admission_deadline(app, client):
+    """test that the requests past their deadline are not served"""
+    past = str(time.time() - 1)
+    response = client.post("/api/quote/", json=QUOTE, headers={"X-Request-Deadline": past})
+    assert response.status_code == 503
+    assert "deadline" in response.text
+    future = str(time.time() + 60)
+    response = client.post("/api/quote/", json=QUOTE, headers={"X-Request-Deadline": future})
+    assert response.status_code == 201
+
+
+def test_deadline_stops_sql(app):
+    """test that the SQL statements of a request past its deadline are not run"""
+    with app.test_request_context(headers={"X-Request-Deadline": str(time.time() + 60)}):
+        app.preprocess_request()
+        assert db.session.scalar(select(PricingParams.id).limit(1)) == 1
+    with app.test_request_context():
+        app.preprocess_request()
+        g.deadline = time.time() - 1
+        with pytest.raises(DeadlineExceeded):
+            db.session.scalar(select(PricingParams.id).limit(1))
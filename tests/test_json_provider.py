@@ -0,0 +1,30 @@
+from flask.json.provider import DefaultJSONProvider
+from server.database.models import PricingParams, Quote
+
+
+def test_json_provider_same_output(client, app):
+    """test that the fast json provider gives the same output as flask's default provider"""
+    input_json = {
+        "firstname": "Zoë",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [{"name": "pet", "value": True}],
+    }
+    assert client.post("/api/quote/", json=input_json).status_code == 201
+    input_json["firstname"] = "Name"
+    assert client.post("/api/quote/", json=input_json).status_code == 201
+    default = DefaultJSONProvider(app)
+    with app.app_context():
+        for obj in (PricingParams.query.all(), Quote.query.all(), Quote.query.all()[1:]):
+            for kwargs in ({"separators": (",", ":")}, {"indent": 2}, {}):
+                assert app.json.dumps(obj, **kwargs) == default.dumps(obj, **kwargs)
+        # floats that orjson writes differently, alone and next to None
+        floats = [1e16, 1e-7, 1e-5, 1.5e300, float("nan"), float("inf"), -float("inf")]
+        for obj in (*floats, {"value": 1e16, "other": None}, [None, {"x": float("nan")}]):
+            for kwargs in ({"separators": (",", ":")}, {}):
+                assert app.json.dumps(obj, **kwargs) == default.dumps(obj, **kwargs)
+    response = client.get("/api/pricing_params/get_all")
+    assert response.text == default.dumps(
+        response.json, separators=(",", ":")
+    ) + "\n"
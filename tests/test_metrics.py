@@ -0,0 +1,55 @@
+import os
+from server.api.metrics import Registry, merge_snapshots, render, registry
+
+
+def test_metrics_endpoint(client, app):
+    """test that the quote endpoints are counted and timed, with pricing and db time apart"""
+    registry.clear()
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [],
+    }
+    assert client.post("/api/quote/", json=input_json).status_code == 201
+    assert client.get("/api/quote/price?id=1").status_code == 200
+    assert client.get("/api/quote/price?id=99").status_code == 404
+    text = client.get("/metrics").text
+    assert (
+        'http_requests_total{endpoint="quote.get_quote_price",method="GET",status="404"} 1'
+        in text
+    )
+    assert (
+        'http_requests_total{endpoint="quote.quote",method="POST",status="201"} 1'
+        in text
+    )
+    assert 'http_request_duration_seconds_count{endpoint="quote.quote"} 1' in text
+    assert 'http_requests_in_flight{endpoint="quote.quote"} 0' in text
+    assert "pricing_duration_seconds_count 1" in text
+    assert "db_query_duration_seconds_count" in text
+
+
+def test_metrics_merged_across_processes():
+    """test that the snapshots of several processes add up"""
+    first, second = Registry(buckets=(0.1, 1)), Registry(buckets=(0.1, 1))
+    first.inc("http_requests_total", {"endpoint": "quote.quote"})
+    second.inc("http_requests_total", {"endpoint": "quote.quote"}, 2)
+    first.observe("pricing_duration_seconds", 0.05)
+    second.observe("pricing_duration_seconds", 0.5)
+    snapshots = [first.snapshot(), second.snapshot()]
+    text = render(merge_snapshots(snapshots), (0.1, 1))
+    assert 'http_requests_total{endpoint="quote.quote"} 3' in text
+    assert 'pricing_duration_seconds_bucket{le="0.1"} 1' in text
+    assert 'pricing_duration_seconds_bucket{le="+Inf"} 2' in text
+    assert "pricing_duration_seconds_sum 0.55" in text
+
+
+def test_metrics_dir(client, app, tmp_path):
+    """test that with METRICS_DIR the process snapshot is written and read back"""
+    app.config["METRICS_DIR"] = str(tmp_path / "metrics")
+    registry.clear()
+    client.get("/api/pricing_params/get_all")
+    text = client.get("/metrics").text
+    assert os.listdir(tmp_path / "metrics") == [f"metrics_{os.getpid()}.json"]
+    assert 'endpoint="pricing_params.get_all_pricing",method="GET",status="200"} 1' in text
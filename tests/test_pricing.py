@@ -0,0 +1,219 @@
+import pytest
+from server.api.pricing import PricingPlan, format_float
+from server.api.helpers import calculate_pricing
+from server.database.models import PricingParams, Quote
+
+
+def make_params():
+    return PricingParams(
+        state="new_york",
+        tax=0.02,
+        coverage_type_prices={"basic": 20, "premium": 40},
+        extras=[
+            {"name": "pet", "type": "add", "value": 20},
+            {"name": "flood", "type": "multiply", "value": 0.1},
+            {"name": "fire", "type": "add", "value": 10},
+        ],
+    )
+
+
+def test_pricing_plan_compile():
+    """test that the plan splits the extras by type and is read only"""
+    plan = PricingPlan.compile(make_params())
+    assert dict(plan.additive) == {"pet": 20, "fire": 10}
+    assert dict(plan.multipliers) == {"flood": 0.1}
+    assert plan.tax == 0.02
+    with pytest.raises(TypeError):
+        plan.additive["pet"] = 0
+
+
+def test_pricing_plan_matches_calculate_pricing():
+    """test that pricing through the plan gives the same result as calculate_pricing"""
+    params = make_params()
+    plan = PricingPlan.compile(params)
+    extras = [
+        {"name": "flood", "value": True},
+        {"name": "pet", "value": True},
+        {"name": "unknown", "value": True},
+        {"name": "fire", "value": False},
+    ]
+    quote = Quote(id=7, coverage_type="premium", extras=extras)
+    # Premium (40) + Pet (20) + Flood (10%) = 66
+    assert calculate_pricing(quote, params) == {
+        "id": 7,
+        "monthly_subtotal": 66.0,
+        "monthly_tax": 1.32,
+        "monthly_total": 67.32,
+    }
+    assert plan.price("premium", extras) == {
+        "monthly_subtotal": 66.0,
+        "monthly_tax": 1.32,
+        "monthly_total": 67.32,
+    }
+
+
+def test_format_float_truncates():
+    """test that format_float truncates instead of rounding"""
+    assert format_float(0.408) == 0.40
+    assert format_float(61.819) == 61.81
+
+
+def make_many_extras_params(count):
+    extras = [
+        {"name": f"extra_{i}", "type": "add" if i % 3 else "multiply", "value": 0.37 * i + 0.013}
+        for i in range(count)
+    ]
+    return PricingParams(
+        state="new_york",
+        tax=0.0175,
+        coverage_type_prices={"basic": 20.3, "premium": 40.7},
+        extras=extras,
+    )
+
+
+@pytest.mark.parametrize("count,full", [(5, True), (13, False)])
+def test_price_table_matches_plan(count, full):
+    """test that the table (full or LRU) gives exactly the plan prices, for every extras order"""
+    import random
+
+    plan = PricingPlan.compile(make_many_extras_params(count))
+    tabled = plan.with_table()
+    assert (tabled.table.prices is not None) == full
+    rng = random.Random(count)
+    for _ in range(500):
+        extras = [
+            {"name": f"extra_{i}", "value": rng.random() < 0.5}
+            for i in rng.sample(range(count + 2), count)
+        ]
+        if rng.random() < 0.5:
+            extras.sort(key=lambda extra: extra["name"].split("_")[1].zfill(3))
+        for coverage_type in ("basic", "premium"):
+            assert tabled.price(coverage_type, extras) == plan.price(coverage_type, extras)
+
+
+def test_price_table_out_of_order_falls_back():
+    """test that quotes with extras out of the params order or repeated aren't looked up"""
+    table = PricingPlan.compile(make_params()).with_table().table
+    assert table.mask([{"name": "pet", "value": True}, {"name": "fire", "value": True}]) == 0b11
+    assert table.mask([{"name": "fire", "value": True}, {"name": "pet", "value": True}]) is None
+    assert table.mask([{"name": "pet", "value": True}, {"name": "pet", "value": True}]) is None
+    assert table.lookup("gold", []) is None
+
+
+def make_rule_params(extras):
+    return PricingParams(
+        state="new_york",
+        tax=0.02,
+        coverage_type_prices={"basic": 20, "premium": 40},
+        extras=extras,
+    )
+
+
+def test_rule_plan_matches_legacy_plan():
+    """test that plain add/multiply extras priced as rules give exactly the legacy prices"""
+    import random
+
+    from server.api.rules import compile_rules
+
+    params = make_many_extras_params(9)
+    plan = PricingPlan.compile(params)
+    assert plan.rules is None
+    rules = compile_rules(params.extras)
+    rng = random.Random(9)
+    for _ in range(200):
+        extras = [{"name": f"extra_{i}", "value": rng.random() < 0.5} for i in range(9)]
+        for coverage_type in ("basic", "premium"):
+            assert rules.subtotal(
+                plan.base_prices[coverage_type], coverage_type, extras
+            ) == plan.subtotal(coverage_type, extras)
+
+
+def test_rule_plan_conditions():
+    """test per coverage type, requires and excludes rules"""
+    plan = PricingPlan.compile(
+        make_rule_params(
+            [
+                {"name": "flood", "type": "add", "value": 5, "coverage_types": ["basic"]},
+                {"name": "flood", "type": "multiply", "value": 0.1, "coverage_types": ["premium"]},
+                {"name": "pet", "type": "add", "value": 20, "excludes": ["flood"]},
+                {"name": "fire", "type": "add", "value": 10, "requires": ["pet"]},
+            ]
+        )
+    )
+    assert plan.rules is not None
+    assert plan.priced_names == ("flood", "pet", "fire")
+    flood = [{"name": "flood", "value": True}]
+    assert plan.subtotal("basic", flood) == 25
+    assert plan.subtotal("premium", flood) == 44
+    pet_fire = [{"name": "pet", "value": True}, {"name": "fire", "value": True}]
+    assert plan.subtotal("basic", pet_fire) == 50
+    assert plan.subtotal("basic", pet_fire + flood) == 35
+    assert plan.subtotal("basic", [{"name": "fire", "value": True}]) == 20
+
+
+def test_rule_plan_tiers_and_bounds():
+    """test tiered values, min/max of a rule and the caps and floors of the subtotal"""
+    plan = PricingPlan.compile(
+        make_rule_params(
+            [
+                {"name": "pet", "type": "add", "value": 20},
+                {
+                    "name": "flood",
+                    "type": "multiply",
+                    "value": 0.1,
+                    "tiers": [{"above": 30, "value": 0.2}, {"above": 50, "value": 0.5}],
+                    "max": 15,
+                },
+                {"name": "fire", "type": "multiply", "value": 0.01, "min": 1},
+                {"name": "limit", "type": "cap", "value": 70},
+                {"name": "minimum", "type": "floor", "value": 25},
+            ]
+        )
+    )
+    assert plan.priced_names == ("pet", "flood", "fire")
+    flood = {"name": "flood", "value": True}
+    pet = {"name": "pet", "value": True}
+    # 20 is not above 30 -> 10% = 22, then floored to 25
+    assert plan.subtotal("basic", [flood]) == 25
+    # 40 above 30 -> 20% = 48
+    assert plan.subtotal("premium", [flood]) == 48
+    # 60 above 50 -> 50% = 30, at most 15 -> 75, capped to 70
+    assert plan.subtotal("premium", [pet, flood]) == 70
+    # 1% of 40 is less than the min of 1
+    assert plan.subtotal("premium", [{"name": "fire", "value": True}]) == 41
+    assert plan.price("premium", [flood]) == {
+        "monthly_subtotal": 48.0,
+        "monthly_tax": 0.96,
+        "monthly_total": 48.96,
+    }
+
+
+def test_rule_plan_price_table():
+    """test that the table of a rule plan gives exactly the rule prices"""
+    import itertools
+
+    from server.api.extras_mask import extra_bits
+
+    extras = [
+        {"name": "pet", "type": "add", "value": 20.3, "excludes": ["fire"]},
+        {
+            "name": "flood",
+            "type": "multiply",
+            "value": 0.13,
+            "tiers": [{"above": 50, "value": 0.3}],
+        },
+        {"name": "fire", "type": "add", "value": 7.1, "coverage_types": ["premium"]},
+        {"name": "limit", "type": "cap", "value": 70},
+    ]
+    plan = PricingPlan.compile(make_rule_params(extras))
+    tabled = plan.with_table()
+    assert tabled.table.prices is not None
+    assert dict(extra_bits(extras)) == {"pet": 0, "flood": 1, "fire": 2}
+    for values in itertools.product((True, False), repeat=3):
+        quote_extras = [
+            {"name": name, "value": value} for name, value in zip(("pet", "flood", "fire"), values)
+        ]
+        for coverage_type in ("basic", "premium"):
+            assert tabled.price(coverage_type, quote_extras) == plan.price(
+                coverage_type, quote_extras
+            )
@@ -1,5 +1,6 @@
 import json
 from server.database.models import PricingParams, Quote, State
+from server.api.db import db
 
 
 def test_creating_pricing_params(basic_client, basic_app):
@@ -182,3 +183,341 @@ def test_creating_pricing_params_add_or_update_extras_update(basic_client, basic
         assert pricing_param.extras[0]["name"] == new_extra["name"]
         assert pricing_param.extras[0]["type"] == new_extra["type"]
         assert pricing_param.extras[0]["value"] == new_extra["value"]
+
+
+def test_pricing_params_cache_hits(client, app):
+    """test that the quote endpoints read the PricingParams from the cache after the first miss"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [{"name": "pet", "value": True}],
+    }
+    for _ in range(3):
+        response = client.post("/api/quote/", json=input_json)
+        assert response.status_code == 201
+    stats = client.get("/api/pricing_params/cache_stats").json
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+    assert stats["size"] == 1
+
+
+def test_pricing_params_cache_invalidated_on_update(client, app):
+    """test that updating the extras through the api is visible right away to the quote endpoints"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "premium",
+        "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+    }
+    response = client.post("/api/quote/", json=input_json)
+    assert response.json["monthly_subtotal"] == 90.0
+    update_response = client.post(
+        "/api/pricing_params/add_or_update_extras?state=texas",
+        json={"name": "pet", "type": "add", "value": 30},
+    )
+    assert update_response.status_code == 200
+    price = client.get(f'/api/quote/price?id={response.json["id"]}')
+    # Premium (40) + Pet (30) + Flood (50%) = 105
+    assert price.json["monthly_subtotal"] == 105.0
+
+
+def test_pricing_params_cache_detects_other_process_update(client, app):
+    """test that a change made outside of this process (no invalidate call) is picked up through
+    the version check once the ttl expires
+    """
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [],
+    }
+    response = client.post("/api/quote/", json=input_json)
+    assert response.json["monthly_subtotal"] == 20.0
+    app.extensions["pricing_cache"].ttl = 0
+    with app.app_context():
+        pricing = PricingParams.query.filter_by(state=State.TEXAS).first()
+        pricing.coverage_type_prices["basic"] = 25
+        db.session.commit()
+        assert pricing.version == 2
+    price = client.get(f'/api/quote/price?id={response.json["id"]}')
+    assert price.json["monthly_subtotal"] == 25.0
+    assert client.get("/api/pricing_params/cache_stats").json["stale"] == 1
+
+
+def test_simulate_pricing(client, app):
+    """test the /api/pricing_params/simulate method by raising the new york flood multiplier to 20%"""
+    quotes = [
+        ("premium", [{"name": "pet", "value": True}, {"name": "flood", "value": True}]),
+        ("premium", [{"name": "pet", "value": True}, {"name": "flood", "value": True}]),
+        ("basic", [{"name": "pet", "value": True}, {"name": "flood", "value": False}]),
+    ]
+    for coverage_type, extras in quotes:
+        response = client.post(
+            "/api/quote/",
+            json={
+                "firstname": "Name",
+                "lastname": "Lastname",
+                "state": "new_york",
+                "coverage_type": coverage_type,
+                "extras": extras,
+            },
+        )
+        assert response.status_code == 201
+    proposed = {
+        "state": "new_york",
+        "tax": 0.02,
+        "coverage_type_prices": {"basic": 20, "premium": 40},
+        "extras": [
+            {"name": "pet", "type": "add", "value": 20},
+            {"name": "flood", "type": "multiply", "value": 0.2},
+        ],
+    }
+    response = client.post("/api/pricing_params/simulate", json=proposed)
+    assert response.status_code == 200
+    result = response.json
+    assert result["quotes"] == 3
+    # 2 x 67.32 + 40.8
+    assert result["current"]["monthly_total"] == 175.44
+    # 2 x (Premium (40) + Pet (20) + Flood (20%) = 72 + 1.44 tax) + 40.8
+    assert result["proposed"]["monthly_total"] == 187.68
+    assert result["delta"]["monthly_total"] == 12.24
+    assert result["distribution"]["histogram"] == [
+        {"monthly_total_delta": 0.0, "quotes": 1},
+        {"monthly_total_delta": 6.12, "quotes": 2},
+    ]
+    assert result["distribution"]["p50"] == 6.12
+    # nothing is saved
+    with app.app_context():
+        pricing_param = PricingParams.query.filter_by(state=State.NEW_YORK).first()
+        assert pricing_param.extras[1]["value"] == 0.1
+
+
+def test_add_or_update_extras_bulk(client, app):
+    """test that a list of extras is applied in one update: existing names updated in place,
+    new ones appended in order"""
+    changes = [
+        {"name": "fire", "type": "add", "value": 10},
+        {"name": "flood", "type": "multiply", "value": 0.5},
+        {"name": "hurricane", "type": "multiply", "value": 0.1},
+    ]
+    response = client.post(
+        "/api/pricing_params/add_or_update_extras?state=texas", json=changes
+    )
+    assert response.status_code == 200
+    with app.app_context():
+        pricing_param = PricingParams.query.filter_by(state=State.TEXAS).first()
+        names = [extra["name"] for extra in pricing_param.extras]
+        assert names == ["pet", "flood", "fire", "hurricane"]
+        assert pricing_param.extras[1] == changes[1]
+        assert pricing_param.coverage_type_prices == {"basic": 20, "premium": 40}
+
+
+def test_add_or_update_version_conflict(client, app):
+    """test that an update made at a stale version gets a 409 and changes nothing"""
+    with app.app_context():
+        version = PricingParams.query.filter_by(state=State.TEXAS).first().version
+    response = client.post(
+        f"/api/pricing_params/add_or_update_coverage?state=texas&version={version}",
+        json={"premium": 45},
+    )
+    assert response.status_code == 200
+    # a second writer that read the same version loses
+    response = client.post(
+        f"/api/pricing_params/add_or_update_extras?state=texas&version={version}",
+        json={"name": "pet", "type": "add", "value": 1},
+    )
+    assert response.status_code == 409
+    response = client.post(
+        f"/api/pricing_params/add_or_update_coverage?state=texas&version={version}",
+        json={"basic": 1},
+    )
+    assert response.status_code == 409
+    with app.app_context():
+        pricing_param = PricingParams.query.filter_by(state=State.TEXAS).first()
+        assert pricing_param.version == version + 1
+        assert pricing_param.coverage_type_prices == {"basic": 20, "premium": 45}
+        assert pricing_param.extras[0] == {"name": "pet", "type": "add", "value": 20}
+    response = client.post(
+        f"/api/pricing_params/add_or_update_coverage?state=texas&version={version + 1}",
+        json={"basic": 25},
+    )
+    assert response.status_code == 200
+
+
+def test_add_or_update_missing_state(basic_client, basic_app):
+    """test that updating the params of a state without params is a 404"""
+    response = basic_client.post(
+        "/api/pricing_params/add_or_update_coverage?state=texas", json={"basic": 1}
+    )
+    assert response.status_code == 404
+
+
+def test_get_all_conditional(client, app):
+    """test that get_all answers 304 until one of the PricingParams changes"""
+    response = client.get("/api/pricing_params/get_all")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+    assert "no-cache" in response.headers["Cache-Control"]
+    response = client.get("/api/pricing_params/get_all", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+    response = client.get(
+        "/api/pricing_params/get_all", headers={"If-Modified-Since": last_modified}
+    )
+    assert response.status_code == 304
+    client.post(
+        "/api/pricing_params/add_or_update_coverage?state=texas", json={"premium": 45}
+    )
+    response = client.get("/api/pricing_params/get_all", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json) == 3
+
+
+def test_pricing_params_import_export(client, app):
+    """test the NDJSON export, a dry run and the upsert of the edited export"""
+    response = client.get("/api/pricing_params/export")
+    assert response.mimetype == "application/x-ndjson"
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert [record["state"] for record in records] == ["california", "new_york", "texas"]
+    # the export imports as is
+    body = "\n".join(json.dumps(record) for record in records)
+    response = client.post("/api/pricing_params/import", data=body)
+    assert response.json["unchanged"] == ["california", "new_york", "texas"]
+
+    records[2]["tax"] = 0.01
+    records[2]["extras"].append({"name": "fire", "type": "add", "value": 10})
+    body = "\n".join(json.dumps(record) for record in records)
+    response = client.post("/api/pricing_params/import?dry_run=1", data=body)
+    assert response.status_code == 200
+    assert response.json["updated"] == {"texas": ["tax", "extras"]}
+    with app.app_context():
+        assert PricingParams.query.filter_by(state=State.TEXAS).first().tax == 0.005
+
+    response = client.post("/api/pricing_params/import", data=body)
+    assert response.status_code == 200
+    with app.app_context():
+        texas = PricingParams.query.filter_by(state=State.TEXAS).first()
+        assert texas.tax == 0.01
+        assert texas.extras[-1]["name"] == "fire"
+        assert texas.version == 2
+        assert PricingParams.query.filter_by(state=State.CALIFORNIA).first().version == 1
+
+
+def test_pricing_params_import_all_or_nothing(basic_client, basic_app):
+    """test that a JSON array is created in one go, and that one invalid record rejects all"""
+    with open("seed.json") as json_file:
+        seed_data = json.load(json_file)
+    invalid = [*seed_data, {**seed_data[0], "tax": "high"}]
+    response = basic_client.post("/api/pricing_params/import", json=invalid)
+    assert response.status_code == 422
+    assert response.json["errors"] == [
+        {"record": 3, "errors": {"tax": "tax should be a float"}}
+    ]
+    with basic_app.app_context():
+        assert PricingParams.query.count() == 0
+    response = basic_client.post("/api/pricing_params/import", json=seed_data)
+    assert response.status_code == 200
+    assert response.json["created"] == ["california", "new_york", "texas"]
+    with basic_app.app_context():
+        assert PricingParams.query.count() == 3
+
+
+def test_rule_extras_price_quotes(client, app):
+    """test that a cap added to the new york rules bounds the quote subtotals"""
+    response = client.post(
+        "/api/pricing_params/add_or_update_extras?state=new_york",
+        json=[{"name": "limit", "type": "cap", "value": 50}],
+    )
+    assert response.status_code == 200
+    response = client.post(
+        "/api/quote/",
+        json={
+            "firstname": "Name",
+            "lastname": "Lastname",
+            "state": "new_york",
+            "coverage_type": "premium",
+            "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+        },
+    )
+    assert response.status_code == 201
+    # Premium (40) + Pet (20) + Flood (10%) = 66, capped to 50
+    assert response.json["monthly_subtotal"] == 50.0
+    assert response.json["monthly_total"] == 51.0
+
+
+def test_add_or_update_coverage_invalid(client, app):
+    """test that invalid coverage updates get a 422 before anything is written"""
+    with app.app_context():
+        version = PricingParams.query.filter_by(state=State.TEXAS).first().version
+    for data in ({'basic"': 25}, {"gold": 25}, {"basic": "abc"}, {"basic": "25"}, {"basic": -1}):
+        response = client.post(
+            "/api/pricing_params/add_or_update_coverage?state=texas", json=data
+        )
+        assert response.status_code == 422
+    with app.app_context():
+        pricing_param = PricingParams.query.filter_by(state=State.TEXAS).first()
+        assert pricing_param.version == version
+        assert pricing_param.coverage_type_prices == {"basic": 20, "premium": 40}
+
+
+def test_coverage_document_postgres_binds_number():
+    """test that the Postgres coverage update sends the price as a JSON number, dumped once"""
+    from sqlalchemy.dialects.postgresql import psycopg2
+    from server.api.params_updates import coverage_document
+
+    compiled = coverage_document({"basic": 25, "premium": 40.5}, "postgresql").compile(
+        dialect=psycopg2.dialect()
+    )
+    processors = compiled._bind_processors
+    binds = [
+        processors[name](value) if name in processors else value
+        for name, value in compiled.construct_params().items()
+    ]
+    assert "25" in binds and "40.5" in binds
+    assert '"25"' not in binds
+
+
+def test_add_or_update_extras_rules_sharing_a_name(client, app):
+    """test that a change updates the one rule it matches when several rules share its name"""
+    rules = [
+        {"name": "flood", "type": "add", "value": 5, "coverage_types": ["basic"]},
+        {"name": "flood", "type": "multiply", "value": 0.5, "coverage_types": ["premium"]},
+    ]
+    url = "/api/pricing_params/add_or_update_extras?state=texas"
+    with app.app_context():
+        pricing_param = PricingParams.query.filter_by(state=State.TEXAS).first()
+        pricing_param.extras = [extra for extra in pricing_param.extras if extra["name"] != "flood"]
+        db.session.commit()
+    assert client.post(url, json=rules).status_code == 200
+    response = client.post(url, json={"name": "flood", "type": "multiply", "value": 0.2})
+    assert response.status_code == 200
+    with app.app_context():
+        extras = PricingParams.query.filter_by(state=State.TEXAS).first().extras
+        assert extras[1:] == [rules[0], {**rules[1], "value": 0.2}]
+    quote = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [{"name": "flood", "value": True}],
+    }
+    # Basic (20) + Flood (5) = 25, the add rule is left as it was
+    assert client.post("/api/quote/", json=quote).json["monthly_subtotal"] == 25.0
+    # a third flood rule, on both coverage types
+    both = {"name": "flood", "type": "add", "value": 1, "coverage_types": ["premium", "basic"]}
+    assert client.post(url, json=both).status_code == 200
+    # two add rules named flood now: the coverage types tell them apart
+    response = client.post(url, json={"name": "flood", "type": "add", "value": 2})
+    assert response.status_code == 422
+    response = client.post(url, json={**both, "coverage_types": ["basic", "premium"], "value": 3})
+    assert response.status_code == 200
+    with app.app_context():
+        extras = PricingParams.query.filter_by(state=State.TEXAS).first().extras
+        assert [extra["value"] for extra in extras[1:]] == [5, 0.2, 3]
@@ -0,0 +1,63 @@
+import logging
+from flask import g
+from server.api.db import db, statement_shape
+from server.database.models import Quote
+
+QUOTE = {
+    "firstname": "Name",
+    "lastname": "Lastname",
+    "state": "texas",
+    "coverage_type": "basic",
+    "extras": [],
+}
+
+
+def test_statement_shape():
+    """test that IN lists and whitespace don't change the shape of a statement"""
+    assert statement_shape("SELECT a\n  FROM t WHERE id IN (?, ?, ?)") == (
+        "SELECT a FROM t WHERE id IN (?)"
+    )
+    assert statement_shape("SELECT a FROM t WHERE id IN (%(id_1)s, %(id_2)s)") == (
+        "SELECT a FROM t WHERE id IN (?)"
+    )
+
+
+def test_query_headers(client, app):
+    """test that the statements and DB time of a request are returned as headers"""
+    app.config["SQL_QUERY_HEADERS"] = True
+    client.post("/api/quote/", json=QUOTE)
+    response = client.get("/api/quote/price?id=1")
+    assert int(response.headers["X-DB-Statements"]) >= 1
+    assert response.headers["X-DB-Time"].endswith("ms")
+    app.config["SQL_QUERY_HEADERS"] = False
+    assert "X-DB-Statements" not in client.get("/api/quote/price?id=1").headers
+
+
+def test_slow_query_logged(client, app, caplog):
+    """test that statements over the threshold are logged with their parameters"""
+    app.config["SQL_SLOW_QUERY_SECONDS"] = 0
+    with caplog.at_level(logging.WARNING):
+        client.get("/api/quote/price?id=1")
+    assert any(
+        "slow query" in record.getMessage() and "WHERE quote.id" in record.getMessage()
+        and "parameters: ('1'," in record.getMessage()
+        for record in caplog.records
+    )
+
+
+def test_repeated_statements_flagged(basic_app, caplog):
+    """test that a request running the same statement in a loop is flagged as N+1"""
+    basic_app.config["SQL_REPEATED_STATEMENT_LIMIT"] = 3
+    basic_app.config["SQL_QUERY_HEADERS"] = True
+
+    @basic_app.route("/per_row")
+    def per_row():
+        for quote_id in range(5):
+            db.session.get(Quote, quote_id)
+        return {"statements": g.query_stats.count}
+
+    with caplog.at_level(logging.WARNING):
+        response = basic_app.test_client().get("/per_row")
+    assert response.json["statements"] == 5
+    assert response.headers["X-DB-Repeated-Statements"] == "1"
+    assert any("executed 5 times" in record.getMessage() for record in caplog.records)
@@ -1,5 +1,23 @@
+import gzip
+import inspect
 import json
-from server.database.models import PricingParams, Quote
+import shutil
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event, func, select, text
+from sqlalchemy.engine import Engine
+from server.database.models import IdempotencyKey, PricingParams, Quote, State
+from server.api.index import create_app, create_async_app
+from server.api.async_db import async_db
+from server.api.db import db
+from server.api.helpers import db_seed
+from server.api.repricing import quote_repricer
+from server.api.metrics import registry
+from server.api.cache import pricing_cache
+from server.api.extras_mask import migrate_extras_mask
+from server.api.rollups import RollupDeltas, rebuild_rollups
+from server.api.idempotency import request_hash, sweep_expired_keys
 
 
 def test_quote_1(client, app):
@@ -104,6 +122,24 @@ def test_quote_6(client, app):
         assert response.json["monthly_total"] == 90.45
 
 
+def test_quote_extras_optional_and_validated(client, app):
+    """test that a quote without extras is priced and malformed extras get a 422"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "california",
+        "coverage_type": "basic",
+    }
+    response = client.post("/api/quote/", json=input_json)
+    assert response.status_code == 201
+    assert response.json["monthly_subtotal"] == 20.0
+    for extras in ("x", [{"name": "pet"}], [{"name": "pet", "value": "yes"}]):
+        response = client.post("/api/quote/", json={**input_json, "extras": extras})
+        assert response.status_code == 422
+    with app.app_context():
+        assert Quote.query.count() == 1
+
+
 def test_quote_after_adding_extra(client, app):
     """test case with a maxed out texas quote and adding the extra fire"""
     input_json = {
@@ -174,3 +210,786 @@ def test_quote_extra_updated(client, app):
     assert updated_quote_price.json["monthly_subtotal"] == 60.0
     assert updated_quote_price.json["monthly_tax"] == 0.3
     assert updated_quote_price.json["monthly_total"] == 60.3
+
+
+def test_quote_extras_bulk_update(client, app):
+    """test adding, updating and removing several extras in one request, the new price is returned"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "premium",
+        "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+    }
+    response = client.post("/api/quote/", json=input_json)
+    assert response.status_code == 201
+    quote_id = response.json["id"]
+    changes = {
+        "extras": [{"name": "pet", "value": False}, {"name": "fire", "value": True}],
+        "remove": ["flood"],
+    }
+    response = client.post(f"/api/quote/add_extra_or_update?id={quote_id}", json=changes)
+    assert response.status_code == 200
+    # Premium (40) + Pet (0), no flood multiplier, fire is not a texas extra
+    assert response.json == {
+        "id": quote_id,
+        "monthly_subtotal": 40.0,
+        "monthly_tax": 0.2,
+        "monthly_total": 40.2,
+    }
+    assert client.get(f"/api/quote/price?id={quote_id}").json == response.json
+    quote = client.get(f"/api/quote/?id={quote_id}").json
+    assert quote["extras"] == [
+        {"name": "pet", "value": False},
+        {"name": "fire", "value": True},
+    ]
+    # a list of extras is accepted too, and one invalid extra rejects the whole request
+    response = client.post(
+        f"/api/quote/add_extra_or_update?id={quote_id}",
+        json=[{"name": "pet", "value": True}, {"name": "flood", "value": "yes"}],
+    )
+    assert response.status_code == 422
+    assert client.get(f"/api/quote/?id={quote_id}").json["extras"] == quote["extras"]
+
+
+def test_quote_price_conditional(client, app):
+    """test that the price answers 304 until the quote or its state params change"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "premium",
+        "extras": [{"name": "pet", "value": True}],
+    }
+    quote_id = client.post("/api/quote/", json=input_json).json["id"]
+    response = client.get(f"/api/quote/price?id={quote_id}")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert "private" in response.headers["Cache-Control"]
+    response = client.get(
+        f"/api/quote/price?id={quote_id}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    client.post(
+        f"/api/quote/add_extra_or_update?id={quote_id}", json={"name": "pet", "value": False}
+    )
+    response = client.get(
+        f"/api/quote/price?id={quote_id}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json["monthly_subtotal"] == 40.0
+    etag = response.headers["ETag"]
+    client.post(
+        "/api/pricing_params/add_or_update_coverage?state=texas", json={"premium": 45}
+    )
+    response = client.get(
+        f"/api/quote/price?id={quote_id}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json["monthly_subtotal"] == 45.0
+    assert client.get("/api/quote/price?id=99").status_code == 404
+
+
+def test_quote_batch(client, app):
+    """test creating several quotes in one request, with one invalid quote in the middle"""
+    input_json = [
+        {
+            "firstname": "Name",
+            "lastname": "Lastname",
+            "state": "california",
+            "coverage_type": "basic",
+            "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+        },
+        {
+            "firstname": "Name",
+            "lastname": "Lastname",
+            "state": "nevada",
+            "coverage_type": "basic",
+            "extras": [],
+        },
+        {
+            "firstname": "Name",
+            "lastname": "Lastname",
+            "state": "texas",
+            "coverage_type": "premium",
+            "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+        },
+    ]
+    response = client.post("/api/quote/batch", json=input_json)
+    assert response.status_code == 201
+    results = response.json
+    assert len(results) == 3
+    assert results[0]["monthly_total"] == 41.20
+    assert "invalid state" in results[1]["error"]
+    assert results[2]["monthly_total"] == 90.45
+    # the stored quotes price the same as the batch response
+    for result in (results[0], results[2]):
+        price = client.get(f'/api/quote/price?id={result["id"]}')
+        assert price.json["monthly_total"] == result["monthly_total"]
+    with app.app_context():
+        assert Quote.query.count() == 2
+
+
+def test_quote_batch_bad_extras(client, app):
+    """test that an item with malformed extras gets its own error and the others are inserted"""
+    item = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "california",
+        "coverage_type": "basic",
+        "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+    }
+    input_json = [item, {**item, "extras": "x"}, {**item, "extras": [{"name": "pet"}]}, item]
+    response = client.post("/api/quote/batch", json=input_json)
+    assert response.status_code == 201
+    results = response.json
+    assert results[0]["monthly_total"] == results[3]["monthly_total"] == 41.20
+    assert results[1]["errors"] == {"extras": "extras should be a list"}
+    assert "extras[0].value" in results[2]["errors"]
+    with app.app_context():
+        assert Quote.query.count() == 2
+
+
+def test_quote_batch_all_invalid(client, app):
+    """test that a batch without any valid quote is rejected"""
+    response = client.post("/api/quote/batch", json=[{"firstname": "Name"}])
+    assert response.status_code == 422
+    assert "missing quote key" in response.json[0]["error"]
+    response = client.post("/api/quote/batch", json={"firstname": "Name"})
+    assert response.status_code == 422
+
+
+def test_quote_export(client, app):
+    """test the NDJSON export with a state filter and gzip"""
+    for state in ("california", "texas", "texas"):
+        input_json = {
+            "firstname": "Name",
+            "lastname": "Lastname",
+            "state": state,
+            "coverage_type": "premium",
+            "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+        }
+        assert client.post("/api/quote/", json=input_json).status_code == 201
+    response = client.get("/api/quote/export")
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["state"] for line in lines] == ["california", "texas", "texas"]
+    assert lines[0]["monthly_total"] == 61.81
+    assert lines[1]["monthly_total"] == 90.45
+
+    response = client.get("/api/quote/export?state=texas&gzip=1")
+    assert response.headers["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(response.data).decode().splitlines()
+    assert len(lines) == 2
+
+    response = client.get("/api/quote/export?created_from=2999-01-01")
+    assert response.text == ""
+    response = client.get("/api/quote/export?created_from=yesterday")
+    assert response.status_code == 422
+
+
+def test_quote_list_pagination(client, app):
+    """test listing quotes with filters, walking the pages with the cursor"""
+    for lastname, state in [
+        ("Smith", "texas"),
+        ("Smithers", "texas"),
+        ("Jones", "texas"),
+        ("Smith", "california"),
+        ("Smithson", "texas"),
+    ]:
+        input_json = {
+            "firstname": "Name",
+            "lastname": lastname,
+            "state": state,
+            "coverage_type": "basic",
+            "extras": [],
+        }
+        assert client.post("/api/quote/", json=input_json).status_code == 201
+    ids = []
+    cursor = ""
+    while True:
+        response = client.get(
+            f"/api/quote/list?state=texas&lastname=Smith&limit=2&cursor={cursor}"
+        )
+        assert response.status_code == 200
+        ids += [quote["id"] for quote in response.json["quotes"]]
+        cursor = response.json["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == [1, 2, 5]
+
+    response = client.get("/api/quote/list?coverage_type=premium")
+    assert response.json == {"quotes": [], "next_cursor": None}
+    assert client.get("/api/quote/list?cursor=abc").status_code == 422
+    assert client.get("/api/quote/list?limit=0").status_code == 422
+
+
+def test_quote_price_materialized(client, app):
+    """test that the price is stored on the quote and repriced when the state params change"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "premium",
+        "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+    }
+    response = client.post("/api/quote/", json=input_json)
+    with app.app_context():
+        quote = db.session.get(Quote, response.json["id"])
+        assert quote.monthly_total == 90.45
+        assert quote.pricing_params_version == 1
+    response = client.post(
+        "/api/pricing_params/add_or_update_coverage?state=texas", json={"premium": 50}
+    )
+    assert response.status_code == 200
+    with app.app_context():
+        quote = db.session.get(Quote, 1)
+        # Premium (50) + Pet (20) + Flood (50%) = 105
+        assert quote.monthly_subtotal == 105.0
+        assert quote.pricing_params_version == 2
+    status = client.get("/api/pricing_params/repricing_status").json
+    assert status["texas"]["status"] == "done"
+    assert status["texas"]["repriced"] == 1
+
+
+def test_superseded_repricing_keeps_current_progress(client, app):
+    """test that a job superseded by a newer change of its state doesn't touch the progress of
+    the newer job"""
+    response = client.post(
+        "/api/pricing_params/add_or_update_coverage?state=texas", json={"premium": 50}
+    )
+    assert response.status_code == 200
+    stale = {"version": 1, "status": "pending", "repriced": 0}
+    # the job of version 1 only starts now
+    quote_repricer._reprice(app, State.TEXAS, 1, stale)
+    assert stale["status"] == "superseded"
+    status = client.get("/api/pricing_params/repricing_status").json["texas"]
+    assert status["version"] == 2
+    assert status["status"] == "done"
+
+
+def test_quote_repricing_in_background(tmp_path):
+    """test the thread pool repricing against a file database"""
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db")
+    app.config["REPRICING_CHUNK_SIZE"] = 2
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    client = app.test_client()
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "new_york",
+        "coverage_type": "basic",
+        "extras": [{"name": "flood", "value": True}],
+    }
+    assert client.post("/api/quote/batch", json=[input_json] * 5).status_code == 201
+    response = client.post(
+        "/api/pricing_params/add_or_update_extras?state=new_york",
+        json={"name": "flood", "type": "multiply", "value": 0.2},
+    )
+    assert response.status_code == 200
+    with app.app_context():
+        quote_repricer.wait(timeout=10)
+    status = client.get("/api/pricing_params/repricing_status").json["new_york"]
+    assert status == {**status, "status": "done", "repriced": 5, "total": 5}
+    # Basic (20) + Flood (20%) = 24
+    assert client.get("/api/quote/price?id=5").json["monthly_subtotal"] == 24.0
+
+
+def concurrent_write(client, prefix, path, json):
+    """Engine listener posting to path from another thread (its own session) the first time a
+    statement starting with prefix is about to run, as a concurrent request would
+    """
+    done = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if not done and statement.lstrip().startswith(prefix):
+            done.append(None)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                done[0] = executor.submit(client.post, path, json=json).result()
+
+    return listener, done
+
+
+def test_rollups_concurrent_writes(tmp_path):
+    """test that a quote changed between the read and the write of the repricer or add_extra
+    moves its rollups once"""
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db")
+    app.config["REPRICING_WORKERS"] = 0
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    client = app.test_client()
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [{"name": "flood", "value": True}],
+    }
+    assert client.post("/api/quote/batch", json=[input_json] * 2).status_code == 201
+    pet = {"name": "pet", "value": True}
+    listener, done = concurrent_write(
+        client, "UPDATE quote SET", "/api/quote/add_extra_or_update?id=1", pet
+    )
+    event.listen(Engine, "before_cursor_execute", listener)
+    try:
+        response = client.post(
+            "/api/pricing_params/add_or_update_extras?state=texas",
+            json={"name": "flood", "type": "multiply", "value": 0.2},
+        )
+    finally:
+        event.remove(Engine, "before_cursor_execute", listener)
+    assert response.status_code == 200
+    assert done[0].status_code == 200
+    assert client.get("/api/pricing_params/repricing_status").json["texas"]["repriced"] == 1
+    with app.app_context():
+        assert rebuild_rollups(check_only=True) == []
+    # add_extra loses the race: the concurrent update wins, the stale one gets a 409
+    listener, done = concurrent_write(
+        client, "INSERT INTO quote_rollup", "/api/quote/add_extra_or_update?id=2", pet
+    )
+    event.listen(Engine, "before_cursor_execute", listener)
+    try:
+        response = client.post(
+            "/api/quote/add_extra_or_update?id=2", json={"name": "flood", "value": False}
+        )
+    finally:
+        event.remove(Engine, "before_cursor_execute", listener)
+    assert done[0].status_code == 200
+    assert response.status_code == 409
+    with app.app_context():
+        assert rebuild_rollups(check_only=True) == []
+        assert db.session.get(Quote, 2).extras == [{"name": "flood", "value": True}, pet]
+
+
+def test_async_app_concurrent_quotes(tmp_path):
+    """test the async app serving quotes from several threads on its shared event loop"""
+    app = create_async_app(f"sqlite:///{tmp_path}/quotes.db")
+    assert inspect.iscoroutinefunction(app.view_functions["quote.quote"])
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "premium",
+        "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+    }
+
+    def post_quote(_):
+        return app.test_client().post("/api/quote/", json=input_json)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(post_quote, range(20)))
+    assert [response.status_code for response in responses] == [201] * 20
+    assert {response.json["monthly_total"] for response in responses} == {90.45}
+    assert len({response.json["id"] for response in responses}) == 20
+    async_db.dispose(app)
+
+
+def test_quote_group_commit(tmp_path):
+    """test that concurrent POST /api/quote/ are committed in groups with the group commit on"""
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db")
+    app.config["GROUP_COMMIT"] = True
+    app.config["GROUP_COMMIT_MAX_BATCH"] = 8
+    app.config["GROUP_COMMIT_MAX_DELAY"] = 0.05
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "premium",
+        "extras": [{"name": "pet", "value": True}, {"name": "flood", "value": True}],
+    }
+    registry.clear()
+
+    def post_quote(_):
+        return app.test_client().post("/api/quote/", json=input_json)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(post_quote, range(24)))
+    assert [response.status_code for response in responses] == [201] * 24
+    ids = {response.json["id"] for response in responses}
+    assert ids == set(range(1, 25))
+    with app.app_context():
+        quote = db.session.get(Quote, responses[0].json["id"])
+        assert quote.monthly_total == 90.45
+        assert quote.extras == input_json["extras"]
+        assert rebuild_rollups(check_only=True) == []
+    batches = registry.snapshot()["histograms"]
+    sizes = next(value for name, _, value in batches if name == "group_commit_batch_size")
+    # [count per bucket..., above the last bucket, sum]
+    assert sizes[-1] == 24
+    assert sum(sizes[:-1]) < 24
+
+
+def test_app_without_replica_after_replica(tmp_path):
+    """test that an app with a replica doesn't change the tables of the apps created after it"""
+    create_app(
+        f"sqlite:///{tmp_path}/primary.db", replica_database_uri=f"sqlite:///{tmp_path}/replica.db"
+    )
+    app = create_app(f"sqlite:///{tmp_path}/other.db")
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    assert app.test_client().get("/api/pricing_params/get_all").status_code == 200
+
+
+def test_quote_reads_from_replica(tmp_path):
+    """test that GET requests read from the replica, except for a client that just wrote"""
+    primary, replica = tmp_path / "primary.db", tmp_path / "replica.db"
+    app = create_app(f"sqlite:///{primary}", replica_database_uri=f"sqlite:///{replica}")
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+
+    def replicate():
+        app.extensions["db_replica"].dispose()
+        shutil.copy(primary, replica)
+
+    replicate()
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [],
+    }
+    writer = app.test_client()
+    response = writer.post("/api/quote/", json=input_json)
+    assert response.status_code == 201
+    # the writer reads its own write from the primary
+    assert writer.get("/api/quote/?id=1").status_code == 200
+    # other clients read from the replica, which doesn't have it yet
+    assert app.test_client().get("/api/quote/?id=1").status_code == 404
+    replicate()
+    assert app.test_client().get("/api/quote/?id=1").status_code == 200
+    # once the pin expires the writer reads from the replica too
+    app.config["READ_REPLICA_PIN_SECONDS"] = 0
+    writer.post("/api/quote/", json=input_json)
+    assert writer.get("/api/quote/?id=2").status_code == 404
+
+
+def test_quote_extras_mask_filter(client, app):
+    """test that the enabled extras are stored as a bitmask and can be filtered on"""
+    quotes = [
+        ("texas", [{"name": "pet", "value": True}, {"name": "flood", "value": True}]),
+        ("texas", [{"name": "pet", "value": True}, {"name": "flood", "value": False}]),
+        ("new_york", [{"name": "flood", "value": True}]),
+        ("texas", [{"name": "fire", "value": True}]),
+    ]
+    input_json = [
+        {
+            "firstname": "Name",
+            "lastname": "Lastname",
+            "state": state,
+            "coverage_type": "basic",
+            "extras": extras,
+        }
+        for state, extras in quotes
+    ]
+    assert client.post("/api/quote/", json=input_json[0]).status_code == 201
+    assert client.post("/api/quote/batch", json=input_json[1:]).status_code == 201
+    with app.app_context():
+        # texas registry: pet -> bit 0, flood -> bit 1, fire is not a texas extra
+        masks = db.session.scalars(select(Quote.extras_mask).order_by(Quote.id)).all()
+        assert masks == [0b11, 0b01, 0b10, 0]
+
+    def listed(query):
+        response = client.get(f"/api/quote/list?{query}")
+        assert response.status_code == 200
+        return [quote["id"] for quote in response.json["quotes"]]
+
+    assert listed("state=texas&extra=flood") == [1]
+    assert listed("extra=flood") == [1, 3]
+    assert listed("extra=pet") == [1, 2]
+    assert listed("extra=fire") == []
+    # removing the extra updates the mask
+    client.post("/api/quote/add_extra_or_update?id=1", json={"remove": ["flood"]})
+    assert listed("extra=flood") == [3]
+
+
+def test_quote_extras_mask_migration(tmp_path):
+    """test adding extras_mask to a database created before it and backfilling it"""
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db")
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    client = app.test_client()
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [{"name": "flood", "value": True}],
+    }
+    assert client.post("/api/quote/batch", json=[input_json] * 3).status_code == 201
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_quote_state_extras_mask"))
+            connection.execute(text("ALTER TABLE quote DROP COLUMN extras_mask"))
+        assert migrate_extras_mask(pricing_cache.get_many(list(State)), chunk_size=2) == 3
+        masks = db.session.scalars(select(Quote.extras_mask)).all()
+        assert masks == [0b10] * 3
+        assert migrate_extras_mask(pricing_cache.get_many(list(State))) == 0
+
+
+def test_quote_analytics_rollups(client, app):
+    """test that the rollups follow the quote writes and the repricing, without drift"""
+    quote = {"firstname": "Name", "lastname": "Lastname", "state": "texas"}
+    assert client.post(
+        "/api/quote/",
+        json={**quote, "coverage_type": "basic", "extras": [{"name": "pet", "value": True}]},
+    ).status_code == 201
+    assert client.post(
+        "/api/quote/batch",
+        json=[
+            {**quote, "coverage_type": "basic", "extras": [{"name": "flood", "value": True}]},
+            {**quote, "coverage_type": "premium", "extras": []},
+            {**quote, "state": "california", "coverage_type": "basic", "extras": []},
+        ],
+    ).status_code == 201
+    client.post("/api/quote/add_extra_or_update?id=2", json={"name": "pet", "value": True})
+
+    def analytics(query=""):
+        response = client.get(f"/api/quote/analytics?{query}")
+        assert response.status_code == 200
+        return response.json
+
+    with app.app_context():
+        totals = dict(
+            db.session.execute(
+                select(Quote.coverage_type, func.sum(Quote.monthly_total))
+                .where(Quote.state == State("texas"))
+                .group_by(Quote.coverage_type)
+            ).all()
+        )
+    texas = analytics("state=texas")
+    assert [(row["coverage_type"], row["quotes"]) for row in texas] == [
+        ("basic", 2),
+        ("premium", 1),
+    ]
+    assert texas[0]["monthly_total"] == round(totals["basic"], 2)
+    assert {name: extra["quotes"] for name, extra in texas[0]["extras"].items()} == {
+        "flood": 1,
+        "pet": 2,
+    }
+    assert texas[1]["monthly_total"] == round(totals["premium"], 2)
+    assert analytics("coverage_type=basic&state=california")[0]["quotes"] == 1
+    assert client.get("/api/quote/analytics?state=ohio").status_code == 422
+
+    # repricing moves the totals, not the counts
+    response = client.post(
+        "/api/pricing_params/add_or_update_extras?state=texas",
+        json={"name": "pet", "type": "add", "value": 30},
+    )
+    assert response.status_code == 200
+    repriced = analytics("state=texas&coverage_type=basic")[0]
+    assert repriced["quotes"] == 2
+    assert repriced["extras"]["pet"]["monthly_total"] > texas[0]["extras"]["pet"]["monthly_total"]
+    with app.app_context():
+        assert rebuild_rollups(check_only=True) == []
+
+
+def test_quote_rollups_rebuild(client, app):
+    """test that the rebuild reports and repairs drifted rollups"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [{"name": "flood", "value": True}],
+    }
+    assert client.post("/api/quote/batch", json=[input_json] * 2).status_code == 201
+    with app.app_context():
+        db.session.execute(text("UPDATE quote_rollup SET quotes = 5 WHERE extra = 'flood'"))
+        db.session.execute(text("DELETE FROM quote_rollup WHERE extra = ''"))
+        db.session.commit()
+        drift = rebuild_rollups()
+        assert [(row["extra"], row["actual"]["quotes"]) for row in drift] == [("", 0), ("flood", 5)]
+        assert {row["expected"]["quotes"] for row in drift} == {2}
+        assert rebuild_rollups(check_only=True) == []
+    assert client.get("/api/quote/analytics").json[0]["quotes"] == 2
+
+
+def test_rollup_deltas_lock_order():
+    """test that the deltas are upserted in key order, whatever the order they were added in"""
+    deltas = RollupDeltas()
+    deltas.add("texas", "premium", [{"name": "pet", "value": True}], 10.0)
+    deltas.add("california", "basic", [{"name": "flood", "value": True}], 20.0)
+    deltas.add("texas", "basic", [], 30.0)
+    assert [(row["state"], row["coverage_type"], row["extra"]) for row in deltas.params()] == [
+        ("california", "basic", ""),
+        ("california", "basic", "flood"),
+        ("texas", "basic", ""),
+        ("texas", "premium", ""),
+        ("texas", "premium", "pet"),
+    ]
+
+
+def test_quote_idempotency_key(client, app):
+    """test that a retried POST with the same Idempotency-Key gets the first response back"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [{"name": "flood", "value": True}],
+    }
+    headers = {"Idempotency-Key": "retry-1"}
+    first = client.post("/api/quote/", json=input_json, headers=headers)
+    assert first.status_code == 201
+    assert "Idempotent-Replayed" not in first.headers
+    retry = client.post("/api/quote/", json=input_json, headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json == first.json
+    # the key can't be reused for another quote
+    other = client.post("/api/quote/", json={**input_json, "lastname": "Other"}, headers=headers)
+    assert other.status_code == 422
+    assert client.post(
+        "/api/quote/", json=input_json, headers={"Idempotency-Key": "retry-2"}
+    ).json["id"] == first.json["id"] + 1
+    with app.app_context():
+        assert db.session.scalar(select(func.count(Quote.id))) == 2
+
+
+def test_quote_idempotency_key_in_progress(client, app, caplog):
+    """test that a retry waits for the request holding the key, and takes over an abandoned one"""
+    app.config["IDEMPOTENCY_WAIT_SECONDS"] = 0.05
+    app.config["IDEMPOTENCY_POLL_INTERVAL"] = 0.005
+    app.config["SQL_REPEATED_STATEMENT_LIMIT"] = 2
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [],
+    }
+    now = datetime.utcnow()
+    with app.app_context():
+        db.session.add(
+            IdempotencyKey(
+                key="retry-1",
+                request_hash=request_hash(input_json),
+                created_at=now,
+                expires_at=now + timedelta(days=1),
+            )
+        )
+        db.session.commit()
+    headers = {"Idempotency-Key": "retry-1"}
+    response = client.post("/api/quote/", json=input_json, headers=headers)
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    # polling the key is not an N+1
+    assert "N+1" not in caplog.text
+    app.config["IDEMPOTENCY_LOCK_SECONDS"] = 0
+    response = client.post("/api/quote/", json=input_json, headers=headers)
+    assert response.status_code == 201
+    assert client.post("/api/quote/", json=input_json, headers=headers).json == response.json
+
+
+def test_quote_idempotency_key_deadline_released(client, app):
+    """test that a request answered 503 past its deadline releases its key for the retry"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [],
+    }
+
+    def slow_insert(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO quote "):
+            time.sleep(0.3)
+
+    event.listen(Engine, "before_cursor_execute", slow_insert)
+    try:
+        response = client.post(
+            "/api/quote/",
+            json=input_json,
+            headers={"Idempotency-Key": "late", "X-Request-Deadline": str(time.time() + 0.2)},
+        )
+    finally:
+        event.remove(Engine, "before_cursor_execute", slow_insert)
+    assert response.status_code == 503
+    with app.app_context():
+        assert db.session.scalar(select(func.count(IdempotencyKey.key))) == 0
+    response = client.post("/api/quote/", json=input_json, headers={"Idempotency-Key": "late"})
+    assert response.status_code == 201
+    with app.app_context():
+        assert db.session.scalar(select(func.count(Quote.id))) == 1
+
+
+def test_quote_idempotency_key_not_released_on_success(client, app):
+    """test that a keyed request that stored its response doesn't run the release at teardown"""
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [],
+    }
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        response = client.post("/api/quote/", json=input_json, headers={"Idempotency-Key": "ok"})
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    assert response.status_code == 201
+    assert not [statement for statement in statements if statement.startswith("DELETE")]
+    with app.app_context():
+        assert db.session.get(IdempotencyKey, "ok").status_code == 201
+
+
+def test_quote_idempotency_key_concurrent(tmp_path):
+    """test that concurrent duplicates of a request insert one quote"""
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db")
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "premium",
+        "extras": [],
+    }
+
+    def post_quote(_):
+        return app.test_client().post(
+            "/api/quote/", json=input_json, headers={"Idempotency-Key": "storm"}
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(post_quote, range(16)))
+    assert [response.status_code for response in responses] == [201] * 16
+    assert {response.json["id"] for response in responses} == {1}
+    assert sum("Idempotent-Replayed" in response.headers for response in responses) == 15
+    with app.app_context():
+        assert db.session.scalar(select(func.count(Quote.id))) == 1
+
+
+def test_sweep_expired_idempotency_keys(app):
+    """test that the expired keys are deleted in batches"""
+    now = datetime.utcnow()
+    with app.app_context():
+        expired = [now - timedelta(seconds=1)] * 5
+        for i, expires_at in enumerate(expired + [now + timedelta(days=1)]):
+            db.session.add(
+                IdempotencyKey(
+                    key=f"key-{i}", request_hash="", created_at=now, expires_at=expires_at
+                )
+            )
+        db.session.commit()
+        assert sweep_expired_keys(batch_size=2) == 5
+        assert db.session.scalars(select(IdempotencyKey.key)).all() == ["key-5"]
@@ -0,0 +1,74 @@
+from server.api.index import create_app
+from server.api.db import db
+from server.api.cache import pricing_cache
+from server.api.helpers import db_seed
+from server.api.metrics import registry
+from server.api.serving import warmup
+
+
+def test_engine_pool_options(tmp_path, monkeypatch):
+    """test that the pool is configured from the env vars and the create_app options"""
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "1")
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db", engine_options={"pool_timeout": 2})
+    assert app.config["SQLALCHEMY_ENGINE_OPTIONS"] == {
+        "pool_size": 3,
+        "pool_pre_ping": True,
+        "pool_timeout": 2,
+    }
+    with app.app_context():
+        assert db.engine.pool.size() == 3
+        assert db.engine.pool._pre_ping
+        assert db.engine.pool._timeout == 2
+
+
+def test_worker_warm_up(tmp_path):
+    """test that the warmup fills the pool and the pricing cache before the first request"""
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db", engine_options={"pool_size": 3})
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+        db.engine.dispose()
+    assert warmup.warm_up(app) > 0
+    with app.app_context():
+        assert db.engine.pool.checkedin() == 3
+        assert pricing_cache.stats()["size"] == 3
+        misses = pricing_cache.stats()["misses"]
+    registry.clear()
+    client = app.test_client()
+    assert client.get("/api/quote/price?id=1").status_code == 404
+    input_json = {
+        "firstname": "Name",
+        "lastname": "Lastname",
+        "state": "texas",
+        "coverage_type": "basic",
+        "extras": [],
+    }
+    assert client.post("/api/quote/", json=input_json).status_code == 201
+    with app.app_context():
+        assert pricing_cache.stats()["misses"] == misses
+    # the cold start is reported once per process
+    histograms = registry.snapshot()["histograms"]
+    cold_start = [value for name, _, value in histograms if name == "cold_start_seconds"]
+    assert len(cold_start) == 1
+    # [count per bucket..., above the last bucket, sum]
+    assert sum(cold_start[0][:-1]) == 1
+
+
+def test_worker_after_fork(tmp_path):
+    """test that a forked worker measures its cold start from the fork and drops the metrics of
+    the master"""
+    app = create_app(f"sqlite:///{tmp_path}/quotes.db")
+    with app.app_context():
+        db.create_all()
+        db_seed(db)
+    # the master booted long ago and observed its own statements
+    app.extensions["warmup"].created_at -= 3600
+    registry.inc("http_requests_total", {"endpoint": "master"})
+    warmup.after_fork(app)
+    assert "master" not in str(registry.snapshot()["counters"])
+    assert app.test_client().get("/api/quote/price?id=1").status_code == 404
+    histograms = registry.snapshot()["histograms"]
+    cold_start = next(value for name, _, value in histograms if name == "cold_start_seconds")
+    # observed in the first bucket, not an hour after the master started
+    assert cold_start[-1] < 60
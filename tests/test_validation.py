@@ -0,0 +1,100 @@
+from server.api.validation import PRICING_VALIDATOR, QUOTE_VALIDATOR
+from server.api.helpers import validate_pricing_data, validate_extras, validate_extra
+
+
+def test_validator_reports_all_errors():
+    """test that the compiled validator returns every field error at once"""
+    data = {
+        "state": "nevada",
+        "coverage_type_prices": {"basic": "abc", "premium": 40},
+        "extras": [
+            {"name": "pet", "type": "subtract", "value": 20},
+            {"name": "flood", "value": "x"},
+        ],
+    }
+    assert PRICING_VALIDATOR.errors(data) == {
+        "tax": "missing pricing key",
+        "extras[1].type": "extras key missing, ensure you have name, type, and value",
+        "state": "invalid state",
+        "coverage_type_prices.basic": "coverage_type_prices[value]",
+        "extras[0].type": "extras[type]",
+        "extras[1].value": "extras[value]",
+    }
+
+
+def test_validator_missing_keys_no_key_error():
+    """test that missing top level keys are reported instead of raising KeyError"""
+    assert validate_pricing_data({"state": "texas"}) == (False, "missing pricing key")
+    assert validate_pricing_data([]) == (False, "pricing should be an object")
+
+
+def test_validator_same_messages():
+    """test that the helpers keep returning the messages of the hand-written validators"""
+    assert validate_extras([{"name": "fire", "type": "add"}]) == (
+        False,
+        " key missing, ensure you have name, type, and value",
+    )
+    assert validate_extras([{"name": "fire", "type": "add", "value": 1}]) == (True, None)
+    assert validate_extra({"name": "fire", "value": "yes"}) == (
+        False,
+        " value is wrong format",
+    )
+
+
+def test_validator_many():
+    """test validating a batch of quotes"""
+    quotes = [
+        {"firstname": "a", "lastname": "b", "state": "texas", "coverage_type": "basic"},
+        {"firstname": "a", "state": "texas", "coverage_type": "gold"},
+        "quote",
+    ]
+    assert QUOTE_VALIDATOR.validate_many(quotes) == [
+        {},
+        {"lastname": "missing quote key", "coverage_type": "invalid coverage_type"},
+        {"": "quote should be an object"},
+    ]
+
+
+def test_validator_rule_keys():
+    """test that the optional rule keys are checked and caps and floors are accepted"""
+    assert validate_extras(
+        [
+            {"name": "flood", "type": "multiply", "value": 0.1, "coverage_types": ["premium"]},
+            {"name": "pet", "type": "add", "value": 20, "requires": ["flood"], "min": 1},
+            {"name": "limit", "type": "cap", "value": 100, "tiers": [{"above": 50, "value": 80}]},
+            {"name": "minimum", "type": "floor", "value": 25},
+        ]
+    ) == (True, None)
+    assert validate_extras(
+        [{"name": "flood", "type": "add", "value": 1, "coverage_types": ["gold"]}]
+    ) == (False, "[coverage_types]")
+    assert validate_extras(
+        [{"name": "flood", "type": "add", "value": 1, "excludes": "pet"}]
+    ) == (False, "[excludes]")
+    tiers = [{"above": 50, "value": 1}, {"above": 10, "value": 2}]
+    assert validate_extras([{"name": "flood", "type": "add", "value": 1, "tiers": tiers}]) == (
+        False,
+        "[tiers]",
+    )
+    assert validate_extras([{"name": "flood", "type": "add", "value": 1, "max": "a"}]) == (
+        False,
+        "[max]",
+    )
+
+
+def test_validator_quote_extras():
+    """test that the optional quote extras are a list of {"name": str, "value": bool}"""
+    quote = {"firstname": "A", "lastname": "B", "state": "texas", "coverage_type": "basic"}
+    assert QUOTE_VALIDATOR.validate(quote) == (True, None)
+    assert QUOTE_VALIDATOR.validate({**quote, "extras": [{"name": "pet", "value": True}]}) == (
+        True,
+        None,
+    )
+    assert QUOTE_VALIDATOR.errors({**quote, "extras": "x"}) == {"extras": "extras should be a list"}
+    assert QUOTE_VALIDATOR.errors({**quote, "extras": [{"name": "pet"}]}) == {
+        "extras[0].value": "extras key missing, ensure you have name and value"
+    }
+    assert QUOTE_VALIDATOR.errors({**quote, "extras": [{"name": 1, "value": "yes"}]}) == {
+        "extras[0].name": "extras[name] should be a string",
+        "extras[0].value": "extras[value] should be a boolean",
+    }